@@ -0,0 +1,230 @@
+import json
+import sqlite3
+import sys
+import time
+from bisect import bisect_right
+from collections import Counter
+import numpy as np
+from gmail_client import DB_PATH, load_rules
+from label_registry import LabelRegistry
+from payload_codec import decode_payload
+from rule_engine import (BODY_FIELDS, BODY_MAX_BYTES, COLUMN_FIELDS, DATE_FIELDS, DateCondition, extract_body,
+                         rule_fields)
+from rule_filter_client import merge_actions
+
+# NOTE: Dry run of rules.json over the whole store, nothing is sent to Gmail. Headers and dates are copied once into
+# NumPy arrays and every condition is decided for all rows at once
+# Joins the values of a field into one string for contains, headers never hold it so a match can not span two rows
+SEPARATOR = '\0'
+# Rows looked at to tell whether a column repeats enough to be evaluated per distinct value
+SAMPLE_SIZE = 10000
+
+
+def factorize(items):
+    # (distinct items in first seen order, position of each item among them), a dict pass is much faster than
+    # np.unique, which sorts
+    codes = {}
+    inverse = np.fromiter((codes.setdefault(item, len(codes)) for item in items), dtype=np.int64, count=len(items))
+    return list(codes), inverse
+
+
+def combination_codes(matrix):
+    # Same code for emails matched by the same set of rules. The bits of 64 rules at a time are packed into one uint64
+    # per email, the codes of each block are folded into the running ones
+    codes = None
+    for start in range(0, len(matrix), 64):
+        block = np.zeros((matrix.shape[1], 8), dtype=np.uint8)
+        for offset, row in enumerate(matrix[start:start + 64]):
+            block[:, offset // 8] |= row.view(np.uint8) << (offset % 8)
+        distinct, bits = np.unique(block.view(np.uint64).ravel(), return_inverse=True)
+        if codes is None:
+            codes = bits.ravel()
+        else:
+            codes = np.unique(codes * len(distinct) + bits.ravel(), return_inverse=True)[1].ravel()
+    return codes if codes is not None else np.zeros(matrix.shape[1], dtype=np.int64)
+
+
+class Snapshot:
+    # Columnar copy of the emails table, one array per field the rules read. Missing headers are '' and missing
+    # dates NaN, the same values the per email evaluation sees
+
+    def __init__(self, ids, columns, received_at, label_ids):
+        self.ids = ids
+        self.columns = columns
+        self.received_at = received_at
+        self.label_ids = label_ids
+        self.distinct = {}
+        self.joined = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def values(self, field):
+        # (values, inverse) to evaluate a condition on. Senders and recipients repeat a lot, their conditions run once
+        # per distinct value and are mapped back through inverse. Columns with mostly distinct values are used as is
+        if field not in self.distinct:
+            column = self.columns[field]
+            if len(set(column[:SAMPLE_SIZE].tolist())) * 2 <= min(len(column), SAMPLE_SIZE):
+                distinct, inverse = factorize(column.tolist())
+                self.distinct[field] = np.array(distinct, dtype=np.dtypes.StringDType()), inverse
+            else:
+                self.distinct[field] = column, None
+        return self.distinct[field]
+
+    def select(self, field, mask):
+        inverse = self.values(field)[1]
+        return mask if inverse is None else mask[inverse]
+
+    def equals(self, field, literal):
+        return self.select(field, self.values(field)[0] == literal)
+
+    def contains(self, field, literal):
+        # Rows holding the literal. One str.find pass over the joined values per literal, much faster than a find per
+        # row, and after a hit the search resumes at the next value
+        values = self.values(field)[0]
+        if not literal or SEPARATOR in literal:
+            return self.select(field, np.strings.find(values, literal) >= 0)
+        if field not in self.joined:
+            starts = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(np.strings.str_len(values) + len(SEPARATOR), out=starts[1:])
+            self.joined[field] = SEPARATOR.join(values.tolist()), starts.tolist()
+        text, starts = self.joined[field]
+
+        mask = np.zeros(len(values), dtype=bool)
+        position = text.find(literal)
+        while position != -1:
+            row = bisect_right(starts, position) - 1
+            mask[row] = True
+            position = text.find(literal, starts[row + 1])
+        return self.select(field, mask)
+
+
+def load_snapshot(db_path, fields):
+    # Only the columns the rules need are read, the payload only for headers without a column and for the body
+    payload_fields = sorted(field for field in fields - DATE_FIELDS if field not in COLUMN_FIELDS)
+    columns = [COLUMN_FIELDS[field] for field in COLUMN_FIELDS if field in fields]
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        rows = conn.execute(f"SELECT {', '.join(['id', 'label_ids', 'received_at', *columns])}"
+                            f"{', payload' if payload_fields else ''} FROM emails ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+
+    values = {}
+    for position, field in enumerate(field for field in COLUMN_FIELDS if field in fields):
+        values[field] = [row[3 + position] or '' for row in rows]
+    if payload_fields:
+        for field in payload_fields:
+            values[field] = []
+        for row in rows:
+            payload = decode_payload(row[-1])
+            headers = {header['name'].lower(): header['value'] for header in payload.get('headers', [])}
+            for field in payload_fields:
+                values[field].append(extract_body(payload, BODY_MAX_BYTES) if field in BODY_FIELDS
+                                     else headers.get(field, ''))
+
+    string_type = np.dtypes.StringDType()
+    return Snapshot(np.array([row[0] for row in rows], dtype=object),
+                    {field: np.array(column, dtype=string_type) for field, column in values.items()},
+                    np.array([row[2] for row in rows], dtype=float),
+                    [row[1] for row in rows])
+
+
+def load_labels(db_path, rules):
+    # move_to actions resolved through the label map apply_rules cached in the metadata table, without an API call.
+    # Labels the map does not know yet would be created by apply_rules, their actions are left to the name
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        row = conn.execute("SELECT value FROM metadata WHERE key = 'labels'").fetchone()
+    finally:
+        conn.close()
+    # The cached map is used however old it is, marked fresh so resolving never lists labels again
+    registry = LabelRegistry(None)
+    registry.labels = json.loads(row[0])['labels'] if row else {}
+    registry.fresh = True
+    return {action: label_id for action, label_id in registry.resolve_actions(rules, create=False).items() if label_id}
+
+
+def condition_mask(condition, snapshot, now):
+    if isinstance(condition, DateCondition):
+        return condition.mask(snapshot.received_at, now)
+    if condition.predicate == 'contains':
+        return snapshot.contains(condition.field, condition.value)
+    elif condition.predicate == 'not_contains':
+        return ~snapshot.contains(condition.field, condition.value)
+    elif condition.predicate == 'equals':
+        return snapshot.equals(condition.field, condition.value)
+    return ~snapshot.equals(condition.field, condition.value)
+
+
+def evaluate_rules(snapshot, rules, now):
+    # Boolean matrix, one row per rule and one column per email. A condition shared by several rules is computed once
+    masks = {}
+    matrix = np.zeros((len(rules), len(snapshot)), dtype=bool)
+    for index, rule in enumerate(rules):
+        if not rule.conditions:
+            # all() of nothing holds, any() of nothing does not, like Rule.matches
+            matrix[index] = rule.match_all
+            continue
+        combine = np.logical_and if rule.match_all else np.logical_or
+        for position, condition in enumerate(rule.conditions):
+            key = (condition.field, condition.predicate, condition.value)
+            if key not in masks:
+                masks[key] = condition_mask(condition, snapshot, now)
+            if position:
+                combine(matrix[index], masks[key], out=matrix[index])
+            else:
+                matrix[index] = masks[key]
+    return matrix
+
+
+def backtest(snapshot, rules, now, labels=None):
+    # Returns {'emails', 'matched', 'hits', 'overlaps', 'plan'}. hits has one count per rule, overlaps maps a pair of
+    # rule indexes to the emails both match, plan maps a label diff to the emails it would change, with the actions
+    # merged the way apply_rules merges them and changes that would not alter the stored labels left out.
+    # labels maps move_to actions to label ids, see load_labels
+    matrix = evaluate_rules(snapshot, rules, now)
+    hits = matrix.sum(axis=1)
+
+    # Emails with the same matched rules and the same stored labels get the same diff, it is merged once per group.
+    # The groups also give the overlaps, every pair of rules in a group shares its emails
+    matched = np.flatnonzero(matrix.any(axis=0))
+    distinct_labels, label_codes = factorize([snapshot.label_ids[position] for position in matched.tolist()])
+    keys = combination_codes(matrix)[matched] * max(1, len(distinct_labels)) + label_codes
+    _, firsts, counts = np.unique(keys, return_index=True, return_counts=True)
+
+    plan, overlaps = Counter(), Counter()
+    for first, count in zip(matched[firsts].tolist(), counts.tolist()):
+        # The first email of a group stands for all of it
+        indexes, label_ids = np.flatnonzero(matrix[:, first]).tolist(), snapshot.label_ids[first]
+        for position, first in enumerate(indexes):
+            for second in indexes[position + 1:]:
+                overlaps[first, second] += count
+        actions = [action for index in indexes for action in rules[index].actions]
+        diff = merge_actions(actions, set(json.loads(label_ids)) if label_ids else None, labels)
+        if diff[0] or diff[1]:
+            plan[diff] += count
+
+    return {'emails': len(snapshot), 'matched': len(matched), 'hits': [int(count) for count in hits],
+            'overlaps': dict(overlaps), 'plan': dict(plan)}
+
+
+def print_report(report, rules):
+    print(f"{report['emails']} email(s), {report['matched']} matched by at least one rule")
+    for index, (rule, hits) in enumerate(zip(rules, report['hits'])):
+        print(f"  rule {index}: {hits} hit(s)  {', '.join(rule.actions)}")
+    for (first, second), count in sorted(report['overlaps'].items()):
+        print(f"  rules {first} and {second} overlap on {count} email(s)")
+    for (add, remove), count in sorted(report['plan'].items(), key=lambda item: -item[1]):
+        print(f"  would add {list(add)} remove {list(remove)} on {count} email(s)")
+
+
+if __name__ == '__main__':
+    # python backtest.py [rules file] [db], evaluates a changed rules.json before it is deployed
+    rules_file = sys.argv[1] if len(sys.argv) > 1 else 'rules.json'
+    db_path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+    compiled = load_rules(rules_file)
+    started = time.perf_counter()
+    print_report(backtest(load_snapshot(db_path, rule_fields(compiled)), compiled, time.time(),
+                          load_labels(db_path, compiled)), compiled)
+    print(f"Backtest took {time.perf_counter() - started:.2f}s, no changes were made")
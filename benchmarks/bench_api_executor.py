@@ -0,0 +1,41 @@
+# Actions per second of the async executor against one requests.post per action, local stub server with a fixed
+# per call latency standing in for the Gmail API
+# Run from the project root: python -m benchmarks.bench_api_executor
+import time
+
+from unittest.mock import patch
+
+import requests
+
+from rule_filter_api import ActionExecutor, modify_calls
+from test_gmail_client import unthrottled
+from test_rule_filter_api import start_stub_server
+
+ACTIONS = 500
+LATENCY = 0.02
+
+
+def sequential(url, calls):
+    # The previous transport, a new connection and a blocking round trip per action
+    for path, body in calls:
+        requests.post(f'{url}/{path}', json=body, headers={'Authorization': 'Bearer token'}).raise_for_status()
+
+
+def measure(label, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<16} {elapsed:6.2f}s {ACTIONS / elapsed:>8,.0f} actions/s")
+
+
+if __name__ == '__main__':
+    server, url = start_stub_server(delay=LATENCY)
+    calls = modify_calls([(f'msg{i}', ['mark_as_read']) for i in range(ACTIONS)])
+    print(f"{ACTIONS} modify calls, {LATENCY * 1000:.0f}ms server latency")
+    measure('sequential', lambda: sequential(url, calls))
+    # The stub has no quota, lift the scheduler's limit so transport speed is what gets measured
+    with patch('rule_filter_api.SCHEDULER', unthrottled()):
+        for concurrency in (10, 50):
+            measure(f'executor x{concurrency}',
+                    lambda: ActionExecutor('token', concurrency=concurrency, messages_url=url).execute(calls))
+    server.shutdown()
@@ -0,0 +1,53 @@
+# Dry run of 100 rules over the store: loading the columnar snapshot from emails.db, then evaluating every rule
+# over all rows, also over the snapshot repeated to 2M rows. The rule index evaluation of apply_rules is the baseline
+# Run from the project root: python -m benchmarks.bench_backtest
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from unittest.mock import patch
+
+import numpy as np
+
+from backtest import Snapshot, backtest, load_snapshot
+from benchmarks.bench_parallel import make_rules
+from benchmarks.bench_store import make_messages
+from gmail_client import store_emails_in_sqlite
+from rule_engine import compile_rules, rule_fields
+from rule_filter_client import match_rules
+
+MESSAGES = 200_000
+REPEAT = 10
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'emails.db')
+    with patch('gmail_client.DB_PATH', db_path):
+        store_emails_in_sqlite(make_messages(MESSAGES))
+    rules = compile_rules(make_rules(100))
+    now = time.time()
+
+    conn = sqlite3.connect(db_path)
+    (matched, _), indexed = timed(match_rules, conn.cursor(), rules, now, False)
+    conn.close()
+    print(f"{MESSAGES} messages, {len(rules)} rules: rule index {indexed:.2f}s, {len(matched)} matched")
+
+    snapshot, loaded = timed(load_snapshot, db_path, rule_fields(rules))
+    report, evaluated = timed(backtest, snapshot, rules, now)
+    print(f"{MESSAGES} messages, {len(rules)} rules: snapshot {loaded:.2f}s, backtest {evaluated:.2f}s, "
+          f"{report['matched']} matched")
+
+    large = Snapshot(np.tile(snapshot.ids, REPEAT), {field: np.tile(column, REPEAT)
+                                                     for field, column in snapshot.columns.items()},
+                     np.tile(snapshot.received_at, REPEAT), snapshot.label_ids * REPEAT)
+    report, evaluated = timed(backtest, large, rules, now)
+    print(f"{len(large)} messages, {len(rules)} rules: backtest {evaluated:.2f}s, {report['matched']} matched")
+    shutil.rmtree(directory)
@@ -0,0 +1,51 @@
+# Cost of the received_at conditions: the original per row dateutil parse against epochs stored at ingest, checked
+# one email at a time and as one NumPy comparison per condition over the batch
+# Run from the project root: python -m benchmarks.bench_dates
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+from dateutil import parser
+
+from rule_engine import ParsedEmail, compile_rules, parse_time_value
+from rule_index import RuleIndex
+
+EMAILS = 20_000
+VALUES = [('is_less_than', '2days'), ('is_less_than', '7days'), ('is_greater_than', '1month'),
+          ('is_greater_than', '6months')]
+
+
+def per_row_dateutil(dates, now):
+    # The path before rule compilation, every condition parses the header again against a fresh utcnow
+    matched = 0
+    for date in dates:
+        for predicate, value in VALUES:
+            received = parser.parse(date).replace(tzinfo=None)
+            age = datetime.utcnow() - received
+            matched += age < parse_time_value(value) if predicate == 'is_less_than' else age > parse_time_value(value)
+    return matched
+
+
+def measure(label, function):
+    start = time.perf_counter()
+    matched = function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<14} {elapsed:7.3f}s {elapsed / EMAILS * 1e6:8.2f}us/email  ({matched} condition hits)")
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    now = time.time()
+    epochs = [now - random.uniform(0, 365 * 86400) for _ in range(EMAILS)]
+    dates = [format_datetime(datetime.fromtimestamp(epoch, timezone.utc)) for epoch in epochs]
+    emails = [ParsedEmail(f'msg{i}', {}, epoch) for i, epoch in enumerate(epochs)]
+    index = RuleIndex(compile_rules([{'conditions': {'match': 'all', 'rules': [
+        {'field': 'received_at', 'predicate': predicate, 'value': value}]}, 'actions': ['mark_as_read']}
+        for predicate, value in VALUES]))
+    conditions = [rule.conditions[0] for rule in index.rules]
+
+    print(f"{EMAILS} emails, {len(VALUES)} date conditions")
+    measure('dateutil', lambda: per_row_dateutil(dates, now))
+    measure('epoch per row', lambda: sum(condition.matches(email, now) for email in emails for condition in conditions))
+    measure('numpy batch', lambda: sum(len(hits) for hits in index.date_hits_batch(emails, now)))
@@ -0,0 +1,55 @@
+# Bytes transferred and stored per message with format=full against the format=metadata projection used by sync
+# Run from the project root: python -m benchmarks.bench_fetch_format
+import base64
+import json
+import random
+
+from gmail_client import STORED_HEADERS, count_bytes, fetch_params, load_rules
+
+MESSAGES = 1_000
+
+
+def make_full_message(i):
+    # A typical newsletter: around 40 headers and a text plus html alternative body
+    random.seed(i)
+    headers = [{'name': f'X-Header-{n}', 'value': 'v' * random.randint(20, 120)} for n in range(36)]
+    headers += [
+        {'name': 'From', 'value': f'News <news{i % 50}@vendor.com>'},
+        {'name': 'To', 'value': 'me@example.com'},
+        {'name': 'Subject', 'value': f'Weekly digest {i}'},
+        {'name': 'Date', 'value': 'Sat, 31 Aug 2024 15:44:49 +0000'},
+    ]
+    text = ' '.join(random.choices(['lorem', 'ipsum', 'dolor', 'sit', 'amet'], k=800))
+    html = f'<html><body><table><tr><td>{text}</td></tr></table></body></html>' * 3
+
+    def part(mime_type, content):
+        data = base64.urlsafe_b64encode(content.encode()).decode()
+        return {'mimeType': mime_type, 'headers': [{'name': 'Content-Type', 'value': mime_type}],
+                'body': {'size': len(content), 'data': data}}
+
+    return {'id': f'msg{i}', 'threadId': f'thread{i}', 'labelIds': ['INBOX'], 'snippet': text[:200],
+            'payload': {'mimeType': 'multipart/alternative', 'headers': headers,
+                        'parts': [part('text/plain', text), part('text/html', html)]}}
+
+
+def as_metadata(message, header_names):
+    # What Gmail returns for format=metadata with metadataHeaders set
+    payload = message['payload']
+    wanted = {name.lower() for name in header_names}
+    headers = [header for header in payload['headers'] if header['name'].lower() in wanted]
+    return {'id': message['id'], 'threadId': message['threadId'], 'labelIds': message['labelIds'],
+            'snippet': message['snippet'], 'payload': {'mimeType': payload['mimeType'], 'headers': headers}}
+
+
+if __name__ == '__main__':
+    params = fetch_params(load_rules())
+    print(f"rules.json needs {params}")
+    full = [make_full_message(i) for i in range(MESSAGES)]
+    for label, messages in (('full', full),
+                            ('metadata', [as_metadata(message, params.get('metadataHeaders', STORED_HEADERS))
+                                          for message in full])):
+        stats = {'messages': 0, 'transferred': 0, 'stored': 0}
+        for _ in count_bytes(messages, stats):
+            pass
+        print(f"{label:<9} {stats['transferred'] / MESSAGES:10,.0f} bytes transferred/email "
+              f"{stats['stored'] / MESSAGES:10,.0f} bytes stored/email")
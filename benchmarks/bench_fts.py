@@ -0,0 +1,70 @@
+# Selective contains rules pushed down to SQL, answered by a scan of the columns vs the trigram FTS5 index, and the
+# ingest cost of keeping the index
+# Run from the project root: python -m benchmarks.bench_fts
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from unittest.mock import patch
+
+from gmail_client import set_fts, store_emails_in_sqlite
+from rule_engine import compile_rules
+from rule_filter_client import match_rules
+
+MESSAGES = 200_000
+RULES = 10
+
+
+def make_messages(count):
+    for i in range(count):
+        yield {'id': f'msg{i}', 'threadId': f'thread{i}', 'labelIds': ['INBOX'], 'payload': {'headers': [
+            {'name': 'From', 'value': f'sender{i % 5000}@domain{i % 97}.com'},
+            {'name': 'To', 'value': 'me@example.com'},
+            {'name': 'Subject', 'value': f'Order {i} update for account {i * 7919 % 100_000}'},
+        ]}}
+
+
+def make_rules():
+    return compile_rules([{'conditions': {'match': 'any', 'rules': [
+        {'field': 'subject', 'predicate': 'contains', 'value': f'account {i * 1000 + 17}'},
+        {'field': 'from', 'predicate': 'contains', 'value': f'sender{i * 100 + 3}@'}]},
+        'actions': ['mark_as_read']} for i in range(RULES)])
+
+
+def timed_store(db_path):
+    start = time.perf_counter()
+    with patch('gmail_client.DB_PATH', db_path):
+        store_emails_in_sqlite(make_messages(MESSAGES))
+    return time.perf_counter() - start
+
+
+def timed_match(db_path, rules):
+    conn = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    matched, _ = match_rules(conn.cursor(), rules, time.time())
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed, len(matched)
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    rules = make_rules()
+
+    indexed = os.path.join(directory, 'indexed.db')
+    with patch('gmail_client.DB_PATH', indexed):
+        set_fts(True)
+    stored = timed_store(indexed)
+    # The default store, without the index
+    plain = os.path.join(directory, 'plain.db')
+    stored_plain = timed_store(plain)
+
+    print(f"{MESSAGES} messages, {RULES} rules with 2 contains conditions each")
+    print(f"ingest       column scan {stored_plain:6.2f}s   trigram index {stored:6.2f}s")
+    scan, scan_matched = timed_match(plain, rules)
+    fts, fts_matched = timed_match(indexed, rules)
+    assert scan_matched == fts_matched
+    print(f"rule run     column scan {scan * 1000:6.0f}ms  trigram index {fts * 1000:6.0f}ms  "
+          f"({fts_matched} email(s) matched)")
+    shutil.rmtree(directory)
@@ -0,0 +1,47 @@
+# Time of a rule run before and after the ledger has recorded it, and after a small incremental sync
+# Run from the project root: python -m benchmarks.bench_ledger
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from unittest.mock import patch
+
+from benchmarks.bench_parallel import make_rules
+from benchmarks.bench_store import make_messages
+from gmail_client import store_emails_in_sqlite
+from rule_engine import compile_rules
+from rule_filter_client import find_new_matches, record_ledger
+
+MESSAGES = 100_000
+
+
+def run(db_path, rules):
+    conn = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    now = time.time()
+    matches, matched, checkpoint = find_new_matches(conn.cursor(), rules, now)
+    record_ledger(conn, matched, set(), checkpoint, now)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed, len(matches)
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'emails.db')
+    with patch('gmail_client.DB_PATH', db_path):
+        store_emails_in_sqlite(make_messages(MESSAGES))
+    rules = compile_rules(make_rules(100))
+
+    print(f"{MESSAGES} messages, {len(rules)} rules")
+    for label in ('first run', 'unchanged'):
+        elapsed, dispatched = run(db_path, rules)
+        print(f"{label:<14} {elapsed * 1000:9.1f}ms  {dispatched} email(s) to dispatch")
+
+    # An incremental sync re-stores 100 messages
+    with patch('gmail_client.DB_PATH', db_path):
+        store_emails_in_sqlite(make_messages(100))
+    elapsed, dispatched = run(db_path, rules)
+    print(f"{'after sync':<14} {elapsed * 1000:9.1f}ms  {dispatched} email(s) to dispatch")
+    shutil.rmtree(directory)
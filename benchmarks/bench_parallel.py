@@ -0,0 +1,48 @@
+# Rule evaluation throughput of find_matches as the worker count grows, on a store large enough to be CPU bound
+# Run from the project root: python -m benchmarks.bench_parallel
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+
+from benchmarks.bench_store import make_messages
+from gmail_client import connect_db, store_emails_in_sqlite
+from rule_engine import compile_rules
+from rule_filter_client import find_matches
+
+MESSAGES = 200_000
+RULES = 500
+
+
+def make_rules(count):
+    # One rule per sender, a tenth of them match the generated mail
+    return [{'conditions': {'match': 'any', 'rules': [
+        {'field': 'from', 'predicate': 'contains', 'value': f'news{i}@'},
+        {'field': 'subject', 'predicate': 'contains', 'value': f'Digest {i} '}]},
+        'actions': ['mark_as_read']} for i in range(count)]
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'emails.db')
+    with patch('gmail_client.DB_PATH', db_path):
+        store_emails_in_sqlite(make_messages(MESSAGES))
+
+    # Past PUSHDOWN_MAX_RULES every rule is evaluated in Python, the part the pool spreads out
+    rules = compile_rules(make_rules(RULES))
+    now = time.time()
+    print(f"{MESSAGES} messages, {RULES} rules, {os.cpu_count()} CPU core(s)")
+    baseline = None
+    for workers in sorted({1, 2, 4, os.cpu_count()}):
+        with patch('gmail_client.DB_PATH', db_path):
+            conn = connect_db()
+        start = time.perf_counter()
+        matches = find_matches(conn.cursor(), rules, now, workers=workers)
+        elapsed = time.perf_counter() - start
+        conn.close()
+
+        baseline = baseline or elapsed
+        print(f"{workers:>3} worker(s) {elapsed:6.2f}s {MESSAGES / elapsed:>10,.0f} emails/s  "
+              f"speedup {baseline / elapsed:4.1f}x  ({len(matches)} matched)")
+    shutil.rmtree(directory)
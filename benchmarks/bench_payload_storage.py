@@ -0,0 +1,76 @@
+# DB size and full scan time with plain JSON payloads against the compressed BLOBs, rule results must not change
+# Run from the project root: python -m benchmarks.bench_payload_storage
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from payload_codec import compress_database
+from rule_engine import compile_rules
+from rule_filter_client import find_matches
+
+MESSAGES = 20_000
+NOW = 1725200000.0
+
+
+def make_payload(i):
+    # Headers of a typical metadata fetch, Cc has no column of its own so rules on it scan the payload
+    random.seed(i)
+    relay = f'{random.randint(1, 254)}.{random.randint(1, 254)}.{random.randint(1, 254)}.{random.randint(1, 254)}'
+    return {'headers': [
+        {'name': 'Delivered-To', 'value': 'me@gmail.com'},
+        {'name': 'Received', 'value': f'by 2002:a05:6520:{i:x} with SMTP id {random.getrandbits(48):x}; '
+                                      'Sat, 31 Aug 2024 08:44:50 -0700 (PDT)'},
+        {'name': 'Received', 'value': f'from mail{i % 50}.vendor.com (mail{i % 50}.vendor.com. [{relay}]) by '
+                                      f'mx.google.com with ESMTPS id {random.getrandbits(64):x} for <me@gmail.com>'},
+        {'name': 'Authentication-Results', 'value': 'mx.google.com; spf=pass smtp.mailfrom=vendor.com; '
+                                                    'dkim=pass header.i=@vendor.com; dmarc=pass header.from=vendor.com'},
+        {'name': 'From', 'value': f'News <news{i % 50}@vendor.com>'},
+        {'name': 'To', 'value': 'me@gmail.com'},
+        {'name': 'Cc', 'value': f'team{i % 200}@example.com'},
+        {'name': 'Subject', 'value': f'Weekly digest {i}'},
+        {'name': 'Date', 'value': 'Sat, 31 Aug 2024 15:44:49 +0000'},
+        {'name': 'List-Unsubscribe', 'value': f'<https://vendor.com/unsubscribe?u={random.getrandbits(64):x}>'},
+        {'name': 'Message-ID', 'value': f'<{random.getrandbits(96):x}@vendor.com>'},
+    ]}
+
+
+def scan(db_path, rules):
+    conn = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    matches = find_matches(conn.cursor(), rules, NOW)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return matches, elapsed
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    json_db = os.path.join(directory, 'json.db')
+    conn = sqlite3.connect(json_db)
+    conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, payload TEXT, label_ids TEXT, from_addr TEXT, '
+                 'to_addr TEXT, subject TEXT, received_at REAL)')
+    conn.executemany('INSERT INTO emails (id, payload) VALUES (?, ?)',
+                     ((f'msg{i}', json.dumps(make_payload(i))) for i in range(MESSAGES)))
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+
+    compressed_db = os.path.join(directory, 'compressed.db')
+    shutil.copy(json_db, compressed_db)
+    start = time.perf_counter()
+    compress_database(compressed_db)
+    print(f"{MESSAGES} messages, migrated in {time.perf_counter() - start:.2f}s")
+
+    rules = compile_rules([{'conditions': {'match': 'all', 'rules': [
+        {'field': 'cc', 'predicate': 'contains', 'value': 'team7'}]}, 'actions': ['mark_as_read']}])
+    results = {}
+    for label, db_path in (('json', json_db), ('compressed', compressed_db)):
+        results[label], elapsed = scan(db_path, rules)
+        print(f"{label:<11} {os.path.getsize(db_path) / 1e6:7.2f} MB  full scan {elapsed:6.3f}s")
+
+    print(f"identical matches: {results['json'] == results['compressed']} ({len(results['json'])} emails)")
+    shutil.rmtree(directory)
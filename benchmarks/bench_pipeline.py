@@ -0,0 +1,62 @@
+# End to end apply time of the staged pipeline against evaluating everything first and dispatching afterwards,
+# with a fake Gmail service that takes a fixed time per batchModify call
+# Run from the project root: python -m benchmarks.bench_pipeline
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
+
+from benchmarks.bench_parallel import make_rules
+from benchmarks.bench_store import make_messages
+from gmail_client import store_emails_in_sqlite
+from rule_engine import compile_rules
+from rule_filter_client import batch_modify, find_matches, plan_actions, run_pipeline
+from test_gmail_client import unthrottled
+
+MESSAGES = 100_000
+CALL_LATENCY = 0.1
+
+
+def slow_service():
+    service = MagicMock()
+
+    def batch_modify_request(userId, body):
+        request = MagicMock()
+        request.execute.side_effect = lambda http=None: time.sleep(CALL_LATENCY)
+        return request
+    service.users().messages().batchModify.side_effect = batch_modify_request
+    return service
+
+
+def staged(db_path, rules, now):
+    # The default apply_rules flow, every stage finishes before the next one starts
+    conn = sqlite3.connect(db_path)
+    matches = find_matches(conn.cursor(), rules, now, pushdown=False)
+    conn.close()
+    batch_modify(slow_service(), plan_actions(
+        [(email_id, actions) for email_id, (actions, _) in matches.items()],
+        {email_id: set(json.loads(labels)) for email_id, (_, labels) in matches.items()}))
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'emails.db')
+    with patch('gmail_client.DB_PATH', db_path):
+        store_emails_in_sqlite(make_messages(MESSAGES))
+
+    # Half the senders map to a distinct label so the plan holds many batchModify calls
+    rules = compile_rules(make_rules(50) + [{'conditions': {'match': 'all', 'rules': [
+        {'field': 'from', 'predicate': 'equals', 'value': f'news{i}@vendor.com'}]},
+        'actions': [f'move_to_folder{i}']} for i in range(25)])
+    now = time.time()
+    print(f"{MESSAGES} messages, {CALL_LATENCY * 1000:.0f}ms per batchModify call")
+    with patch('rule_filter_client.SCHEDULER', unthrottled()):
+        for label, function in (('staged', lambda: staged(db_path, rules, now)),
+                                ('pipeline', lambda: run_pipeline(db_path, rules, now, slow_service()))):
+            start = time.perf_counter()
+            function()
+            print(f"{label:<9} {time.perf_counter() - start:6.2f}s")
+    shutil.rmtree(directory)
@@ -0,0 +1,72 @@
+# Rules per second at 10k emails x 100 rules, compiled engine vs compiling and re-parsing for every (email, rule) pair
+# Run from the project root: python -m benchmarks.bench_rule_engine
+import json
+import random
+import time
+
+from rule_engine import ParsedEmail, compile_rules, evaluate
+from rule_filter_client import match_rule
+
+EMAILS = 10_000
+RULES = 100
+
+
+def make_emails(count):
+    random.seed(0)
+    emails = []
+    for i in range(count):
+        headers = [
+            {'name': 'From', 'value': f'sender{random.randrange(500)}@vendor{random.randrange(50)}.com'},
+            {'name': 'To', 'value': 'me@example.com'},
+            {'name': 'Subject', 'value': f'Newsletter {random.randrange(1000)} about topic {random.randrange(200)}'},
+            {'name': 'Date', 'value': f'Sat, {random.randint(1, 28):02d} Aug 2024 15:44:49 +0000'},
+        ]
+        emails.append((f'email_id_{i}', json.dumps({'headers': headers})))
+    return emails
+
+
+def make_rules(count):
+    rules = []
+    for i in range(count):
+        rules.append({
+            'conditions': {
+                'match': 'all' if i % 2 else 'any',
+                'rules': [
+                    {'field': 'from', 'predicate': 'contains', 'value': f'vendor{i % 50}.com'},
+                    {'field': 'subject', 'predicate': 'contains', 'value': f'topic {i}'},
+                    {'field': 'received_at', 'predicate': 'is_less_than', 'value': f'{i % 30 + 1}days'},
+                ]
+            },
+            'actions': ['mark_as_read']
+        })
+    return rules
+
+
+def run_compiled(emails, rules):
+    compiled = compile_rules(rules)
+    now = time.time()
+    return sum(len(evaluate(compiled, ParsedEmail.from_payload(email_id, payload), now)) for email_id, payload in emails)
+
+
+def run_per_pair(emails, rules):
+    matched = 0
+    for email_id, payload in emails:
+        for rule in rules:
+            if match_rule({'id': email_id, 'payload': payload}, rule['conditions']['rules'],
+                          rule['conditions']['match'] == 'all'):
+                matched += 1
+    return matched
+
+
+def measure(label, function, emails, rules):
+    start = time.perf_counter()
+    matched = function(emails, rules)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {elapsed:8.2f}s {len(emails) * len(rules) / elapsed:>14,.0f} rules/s  matches={matched}")
+
+
+if __name__ == '__main__':
+    emails, rules = make_emails(EMAILS), make_rules(RULES)
+    print(f"{EMAILS} emails x {RULES} rules")
+    measure('compiled', run_compiled, emails, rules)
+    measure('per pair', run_per_pair, emails, rules)
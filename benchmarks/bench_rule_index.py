@@ -0,0 +1,41 @@
+# Per email cost of the rule index as the rule count grows, against checking every rule one by one
+# Run from the project root: python -m benchmarks.bench_rule_index
+import time
+
+from benchmarks.bench_rule_engine import make_emails
+from rule_engine import ParsedEmail, compile_rules
+from rule_index import RuleIndex
+
+EMAILS = 2_000
+
+
+def make_rules(count):
+    # One rule per vendor or mailing list, the shape rules.json grows into
+    return [{
+        'conditions': {'match': 'any', 'rules': [
+            {'field': 'from', 'predicate': 'contains', 'value': f'sender{i}@'},
+            {'field': 'subject', 'predicate': 'contains', 'value': f'Newsletter {i} '},
+        ]},
+        'actions': ['mark_as_read']
+    } for i in range(count)]
+
+
+if __name__ == '__main__':
+    emails = [ParsedEmail.from_payload(email_id, payload) for email_id, payload in make_emails(EMAILS)]
+    now = time.time()
+    print(f"{EMAILS} emails")
+    for rule_count in (10, 100, 1000, 5000):
+        rules = compile_rules(make_rules(rule_count))
+        index = RuleIndex(rules)
+
+        start = time.perf_counter()
+        indexed = sum(len(index.match(email, now)) for email in emails)
+        indexed_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linear = sum(rule.matches(email, now) for email in emails for rule in rules)
+        linear_time = time.perf_counter() - start
+
+        assert indexed == linear
+        print(f"{rule_count:>5} rules  index {indexed_time / EMAILS * 1e6:8.1f}us/email  "
+              f"rule by rule {linear_time / EMAILS * 1e6:10.1f}us/email")
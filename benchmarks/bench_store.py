@@ -0,0 +1,55 @@
+# Sustained ingest rate of store_emails_in_sqlite against the old one execute per row, rollback journal path
+# Run from the project root: python -m benchmarks.bench_store
+import os
+import sqlite3
+import tempfile
+import time
+from unittest.mock import patch
+
+from gmail_client import email_row, init_db, store_emails_in_sqlite
+
+MESSAGES = 50_000
+
+
+def make_messages(count):
+    for i in range(count):
+        yield {'id': f'msg{i}', 'threadId': f'thread{i}', 'labelIds': ['INBOX', 'UNREAD'], 'payload': {'headers': [
+            {'name': 'From', 'value': f'news{i % 50}@vendor.com'},
+            {'name': 'To', 'value': 'me@example.com'},
+            {'name': 'Subject', 'value': f'Weekly digest {i}'},
+            {'name': 'Date', 'value': 'Sat, 31 Aug 2024 15:44:49 +0000'},
+        ]}}
+
+
+def store_per_row(db_path, messages, chunk_size=500):
+    # The write path before the bulk writer, one execute per row and the default journal
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    init_db(cur)
+    for i, message in enumerate(messages, 1):
+        cur.execute("INSERT OR REPLACE INTO emails (id, payload, label_ids, thread_id, from_addr, to_addr, subject, "
+                    "received_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", email_row(message))
+        if i % chunk_size == 0:
+            conn.commit()
+    conn.commit()
+    conn.close()
+
+
+def measure(label, function):
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'emails.db')
+    start = time.perf_counter()
+    function(db_path)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {elapsed:6.2f}s {MESSAGES / elapsed:>10,.0f} messages/s")
+
+
+def bulk(db_path):
+    with patch('gmail_client.DB_PATH', db_path):
+        store_emails_in_sqlite(make_messages(MESSAGES))
+
+
+if __name__ == '__main__':
+    print(f"{MESSAGES} messages")
+    measure('per row', lambda db_path: store_per_row(db_path, make_messages(MESSAGES)))
+    measure('bulk', bulk)
@@ -1,13 +1,26 @@
 import json
 import os
-from google.auth.transport.requests import Request
+import sys
+from itertools import islice
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 import sqlite3
+from payload_codec import decode_payload, encode_payload
+from quota import SCHEDULER, is_retryable
+from rule_engine import (BODY_FIELDS, COLUMN_FIELDS, DATE_FIELDS, FTS_TABLE, compile_rules, gmail_query, parse_headers,
+                         parse_received_at, rule_fields)
+
+
+# One service per token file and scope for the whole process, credentials refresh themselves on the next request
+SERVICES = {}
 
 
 def authenticate_gmail_api(token_file, scope):
+    service = SERVICES.get((token_file, tuple(scope)))
+    if service is not None:
+        return service
+
     try:
         creds = None
 
@@ -16,9 +29,13 @@ def authenticate_gmail_api(token_file, scope):
             creds = Credentials.from_authorized_user_file(token_file, scope)
 
         if not creds or not creds.valid:
+            # NOTE: The transport and OAuth flow modules are slow to import and most runs reuse a valid token,
+            # they are only imported when a refresh or an interactive consent is needed
             if creds and creds.expired and creds.refresh_token:
+                from google.auth.transport.requests import Request
                 creds.refresh(Request())
             else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file('credentials.json', scope)
                 creds = flow.run_local_server(port=0, prompt='consent')
 
@@ -31,51 +48,474 @@ def authenticate_gmail_api(token_file, scope):
         return None
 
     try:
-        service = build('gmail', 'v1', credentials=creds)
+        # The discovery document shipped with the pinned client library is used, no network fetch and its version
+        # only changes with requirements.txt
+        service = build('gmail', 'v1', credentials=creds, static_discovery=True)
+        SERVICES[(token_file, tuple(scope))] = service
         return service
     except Exception as e:
         print(f"Failed to build Gmail API service: {e}")
         return None
 
 
-def fetch_emails():
-    email_data = []
+DB_PATH = 'emails.db'
+# NOTE: Gmail caps a list page at 500 ids, bigger pages mean fewer round trips while walking the mailbox
+PAGE_SIZE = 500
+# Messages written per transaction, keeps memory flat no matter how large the mailbox is
+STORE_CHUNK_SIZE = 2000
+# NOTE: WAL lets apply_rules read while ingest writes, NORMAL sync is safe with WAL and skips an fsync per commit
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+)
+# NOTE: Gmail accepts at most 100 calls in one batch request, anything above is rejected by the API
+BATCH_SIZE = 100
+# Attempts for a failed sub request of a batch before it is reported as skipped
+BATCH_RETRIES = 3
+# Headers always fetched, they fill the indexed columns of the emails table
+STORED_HEADERS = ['From', 'To', 'Subject', 'Date']
+
+
+# Columns pulled out of the payload at ingest so rule evaluation never has to decode the JSON
+EMAIL_COLUMNS = {
+    'label_ids': 'TEXT',
+    'thread_id': 'TEXT',
+    'from_addr': 'TEXT',
+    'to_addr': 'TEXT',
+    'subject': 'TEXT',
+    'received_at': 'REAL',
+    # Store call that last wrote the row, rule runs only re-evaluate rows written after their checkpoint
+    'sequence': 'INTEGER',
+}
+SCHEMA_VERSION = 2
+# Header columns covered by the trigram FTS5 index
+FTS_COLUMNS = ', '.join(COLUMN_FIELDS.values())
+# A message stored again updates its row in place
+UPSERT_EMAIL = ("INSERT INTO emails (id, payload, label_ids, thread_id, from_addr, to_addr, subject, received_at, "
+                "sequence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "payload = excluded.payload, label_ids = excluded.label_ids, thread_id = excluded.thread_id, "
+                "from_addr = excluded.from_addr, to_addr = excluded.to_addr, subject = excluded.subject, "
+                "received_at = excluded.received_at, sequence = excluded.sequence")
+
+
+def email_row(email):
+    # Flattens a Gmail message into the emails table columns, the raw payload stays available for other fields and is
+    # stored compressed, read it back through payload_codec.decode_payload
+    payload = email.get('payload', {})
+    headers = parse_headers(payload)
+    label_ids = json.dumps(email['labelIds']) if 'labelIds' in email else None
+    # internalDate is when Gmail received the message, epoch milliseconds that need no parsing and no timezone
+    # guessing. The Date header, set by the sender, is only the fallback
+    if 'internalDate' in email:
+        received_at = int(email['internalDate']) / 1000
+    else:
+        received_at = parse_received_at(headers.get('date'))
+    return (email['id'], encode_payload(payload), label_ids, email.get('threadId'), headers.get('from'),
+            headers.get('to'), headers.get('subject'), received_at)
+
+
+def connect_db():
+    # Connection tuned for bulk writes, open it once and pass it to store_emails_in_sqlite to reuse it across batches
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def init_db(cur):
+    # Creates the tables and brings older databases up to the current columns
+    # EMAIL_ID is set as primary key, this should deduplicate entries in the DB
+    cur.execute('CREATE TABLE IF NOT EXISTS emails (id TEXT PRIMARY KEY, payload TEXT)')
+    columns = {row[1] for row in cur.execute('PRAGMA table_info(emails)')}
+    for column, column_type in EMAIL_COLUMNS.items():
+        if column not in columns:
+            cur.execute(f'ALTER TABLE emails ADD COLUMN {column} {column_type}')
+    for column in ('from_addr', 'to_addr', 'subject', 'received_at', 'thread_id', 'sequence'):
+        cur.execute(f'CREATE INDEX IF NOT EXISTS idx_emails_{column} ON emails ({column})')
+    cur.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)')
+    # Rule matches whose actions were applied, so later runs do not send them again
+    cur.execute('CREATE TABLE IF NOT EXISTS ledger (email_id TEXT, rule_hash TEXT, actions TEXT, applied_at REAL, '
+                'PRIMARY KEY (email_id, rule_hash))')
+
+    # The trigram index is opt in, see set_fts. It is created or dropped here to follow the flag
+    row = cur.execute("SELECT value FROM metadata WHERE key = 'fts'").fetchone()
+    indexed = cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone() is not None
+    if row and row[0] == '1' and not indexed:
+        try:
+            create_fts(cur)
+        except sqlite3.OperationalError:
+            # NOTE: fts5 with the trigram tokenizer needs SQLite 3.34+, without it contains conditions scan the column
+            pass
+        cur.connection.commit()
+    elif indexed and not (row and row[0] == '1'):
+        drop_fts(cur)
+        cur.connection.commit()
+
+    row = cur.execute("SELECT value FROM metadata WHERE key = 'schema_version'").fetchone()
+    if int(row[0] if row else 1) < SCHEMA_VERSION:
+        migrate_email_columns(cur.connection)
+        cur.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('schema_version', ?)",
+                    (str(SCHEMA_VERSION),))
+
+
+def create_fts(cur):
+    # Trigram index over the header columns, kept in step with the emails table by triggers so every write path
+    # (ingest, deletes, migrations) updates it. Rows already in the table are indexed once here
+    new = ', '.join(f'new.{column}' for column in COLUMN_FIELDS.values())
+    old = ', '.join(f'old.{column}' for column in COLUMN_FIELDS.values())
+    cur.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5({FTS_COLUMNS}, content='emails', content_rowid='rowid', "
+                f"tokenize='trigram case_sensitive 1')")
+    cur.execute(f"CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON emails BEGIN "
+                f"INSERT INTO {FTS_TABLE} (rowid, {FTS_COLUMNS}) VALUES (new.rowid, {new}); END")
+    cur.execute(f"CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON emails BEGIN "
+                f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {FTS_COLUMNS}) VALUES ('delete', old.rowid, {old}); END")
+    cur.execute(f"CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF {FTS_COLUMNS} ON emails BEGIN "
+                f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {FTS_COLUMNS}) VALUES ('delete', old.rowid, {old}); "
+                f"INSERT INTO {FTS_TABLE} (rowid, {FTS_COLUMNS}) VALUES (new.rowid, {new}); END")
+    cur.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def drop_fts(cur):
+    for trigger in ('insert', 'delete', 'update'):
+        cur.execute(f'DROP TRIGGER IF EXISTS {FTS_TABLE}_{trigger}')
+    cur.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def set_fts(enabled):
+    # NOTE: The index makes selective contains rules about 4x faster, but the triggers slow every ingest write by
+    # about 2.6x and it is only read when rules are pushed down to SQL (PUSHDOWN_MAX_RULES or fewer). Off by default,
+    # python gmail_client.py --fts turns it on and --no-fts drops it
+    conn = connect_db()
+    try:
+        cur = conn.cursor()
+        init_db(cur)
+        cur.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('fts', ?)", ('1' if enabled else '0',))
+        init_db(cur)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def migrate_email_columns(conn, chunk_size=STORE_CHUNK_SIZE):
+    # One time backfill of the header columns for rows stored before they existed
+    for chunk in chunked(conn.execute('SELECT id, payload FROM emails'), chunk_size):
+        updates = []
+        for email_id, payload in chunk:
+            headers = parse_headers(decode_payload(payload))
+            updates.append((headers.get('from'), headers.get('to'), headers.get('subject'),
+                            parse_received_at(headers.get('date')), email_id))
+        conn.executemany('UPDATE emails SET from_addr = ?, to_addr = ?, subject = ?, received_at = ? WHERE id = ?',
+                         updates)
+    conn.commit()
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def list_message_ids(service, query=''):
+    # Walk every page of the mailbox by following nextPageToken, yielding ids as each page arrives
+    page_token = None
+    while True:
+        results = SCHEDULER.execute('list', service.users().messages().list(userId='me', maxResults=PAGE_SIZE, q=query,
+                                                                             pageToken=page_token))
+        for message in results.get('messages', []):
+            yield message['id']
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+
+def get_messages(service, message_ids, failed_ids, params=None):
+    # One round trip per message
+    for message_id in message_ids:
+        try:
+            message = SCHEDULER.execute('get', service.users().messages().get(userId='me', id=message_id,
+                                                                             **(params or {})))
+        except Exception as e:
+            # A single bad message should not end the walk, record it and keep paginating
+            print(f"Failed to fetch email {message_id}: {e}")
+            failed_ids.append(message_id)
+            continue
+        yield message
+
+
+def get_messages_batched(service, message_ids, failed_ids, params=None, batch_size=BATCH_SIZE, retries=BATCH_RETRIES):
+    # Groups up to batch_size get calls into a single multipart request, one round trip per batch
+    for chunk in chunked(message_ids, batch_size):
+        pending = chunk
+        errors = {}
+
+        for attempt in range(retries):
+            if attempt:
+                # Failed sub requests are mostly rate limits, give the quota time to refill before the retry
+                SCHEDULER.sleep(SCHEDULER.backoff(attempt - 1))
+            responses = {}
+            errors = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors[request_id] = exception
+                else:
+                    responses[request_id] = response
+
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(service.users().messages().get(userId='me', id=message_id, **(params or {})),
+                          request_id=message_id)
+            # Every sub request of a batch counts against the quota on its own
+            SCHEDULER.acquire('get', len(pending) - 1)
+            SCHEDULER.execute('get', batch)
+
+            # Keep the listing order, the callbacks can arrive in any order
+            for message_id in pending:
+                if message_id in responses:
+                    yield responses[message_id]
+
+            # Only the sub requests that failed with a retryable error go into the next batch, a 404 stays a 404
+            failed = [message_id for message_id in pending if message_id in errors]
+            pending = [message_id for message_id in failed if is_retryable(errors[message_id])]
+            for message_id in failed:
+                if not is_retryable(errors[message_id]):
+                    print(f"Failed to fetch email {message_id}: {errors[message_id]}")
+                    failed_ids.append(message_id)
+            if not pending:
+                break
+
+        for message_id in pending:
+            print(f"Failed to fetch email {message_id}: {errors[message_id]}")
+            failed_ids.append(message_id)
+
+
+def load_rules(rules_file='rules.json'):
+    if not os.path.exists(rules_file):
+        return []
+    with open(rules_file, 'r') as f:
+        return compile_rules(json.load(f))
+
+
+def fetch_params(rules):
+    # Only the headers the rules read are requested, the body and MIME tree are skipped unless a rule needs them
+    fields = rule_fields(rules)
+    if fields & BODY_FIELDS:
+        return {'format': 'full'}
+    headers = STORED_HEADERS + sorted(field.title() for field in fields - DATE_FIELDS
+                                      if field.title() not in STORED_HEADERS)
+    return {'format': 'metadata', 'metadataHeaders': headers}
+
+
+def covers(stored_params, params):
+    # True when messages fetched with stored_params hold everything params asks for
+    if not stored_params:
+        return False
+    if stored_params['format'] == 'full':
+        return True
+    return params['format'] == 'metadata' and set(params['metadataHeaders']) <= set(stored_params['metadataHeaders'])
+
+
+def count_bytes(messages, stats):
+    # Tallies the size of each message as received and of the compressed payload BLOB written to the DB
+    for message in messages:
+        stats['transferred'] += len(json.dumps(message))
+        stats['stored'] += len(encode_payload(message.get('payload', {})))
+        stats['messages'] += 1
+        yield message
+
+
+def fetch_emails(batched=False, query='', params=None):
     # NOTE: ReadOnly should suffice to fetch the emails
     gmail_service = authenticate_gmail_api('read_token.json', ['https://www.googleapis.com/auth/gmail.readonly'])
+    failed_ids = []
     try:
-        # NOTE: Emails fetched currently capped at 10, change maxResults accordingly
-        results = gmail_service.users().messages().list(userId='me', maxResults=10, q='').execute()
-        messages = results.get('messages', [])
-
-        for message in messages:
-            msg = gmail_service.users().messages().get(userId='me', id=message['id']).execute()
-            email_data.append(msg)
+        message_ids = list_message_ids(gmail_service, query)
+        if batched:
+            yield from get_messages_batched(gmail_service, message_ids, failed_ids, params)
+        else:
+            yield from get_messages(gmail_service, message_ids, failed_ids, params)
 
     except Exception as e:
+        # Without the next page token the rest of the mailbox is unreachable, surface it instead of truncating silently
         print(f"Failed to fetch email: {e}")
+        raise
 
-    return email_data
+    finally:
+        if failed_ids:
+            print(f"Skipped {len(failed_ids)} email(s) that failed to fetch: {', '.join(failed_ids)}")
 
 
-def store_emails_in_sqlite(emails):
+def store_emails_in_sqlite(emails, chunk_size=STORE_CHUNK_SIZE, conn=None):
+    # A caller owned connection is reused and left open, otherwise one is opened for this call only
+    owns_connection = conn is None
     try:
-        conn = sqlite3.connect('emails.db')
-        cur = conn.cursor()
+        if owns_connection:
+            conn = connect_db()
+        try:
+            cur = conn.cursor()
+            init_db(cur)
+            row = cur.execute("SELECT value FROM metadata WHERE key = 'store_sequence'").fetchone()
+            sequence = int(row[0]) + 1 if row else 1
+            cur.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('store_sequence', ?)", (str(sequence),))
 
-        # EMAIL_ID is set as primary key, this should deduplicate entries in the DB
-        cur.execute('CREATE TABLE IF NOT EXISTS emails (id TEXT PRIMARY KEY, payload TEXT)')
-        for email in emails:
+            # Emails can be a generator, only one chunk is held in memory and committed at a time
+            for chunk in chunked(emails, chunk_size):
 
-            # Dumping the entire payload so any property can be used in the rule set, can scope down based on requirement
-            cur.execute("INSERT OR REPLACE INTO emails (id, payload) VALUES (?, ?)",
-                        (email['id'], json.dumps(email.get('payload', {}))))
+                # Dumping the entire payload so any property can be used in the rule set, can scope down based on requirement
+                # labelIds are kept so actions that would not change anything can be skipped
+                # An upsert keeps the rowid of a re-stored message, REPLACE would delete the row without firing the
+                # triggers that keep the FTS index in step
+                cur.executemany(UPSERT_EMAIL, [email_row(email) + (sequence,) for email in chunk])
+                conn.commit()
 
-        conn.commit()
-        conn.close()
+            # Rule runs reading during ingest see the sequence before its last chunk is in, their checkpoint only
+            # moves past a sequence once it is marked done
+            cur.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('store_sequence_done', ?)",
+                        (str(sequence),))
+            conn.commit()
+
+        finally:
+            # The generator can fail mid-stream, the connection must not outlive the call
+            if owns_connection:
+                conn.close()
+        return True
     except Exception as e:
         print(f"An error occurred while updating the DB: {e}")
+        return False
+
+
+def delete_emails_from_sqlite(email_ids):
+    conn = connect_db()
+    try:
+        init_db(conn.cursor())
+        conn.executemany('DELETE FROM emails WHERE id = ?', [(email_id,) for email_id in email_ids])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_metadata(key):
+    # The metadata table holds the sync state, a missing row means no full sync has completed yet
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        init_db(conn.cursor())
+        row = conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def save_metadata(key, value):
+    conn = connect_db()
+    try:
+        init_db(conn.cursor())
+        conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, str(value)))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_history_id():
+    return load_metadata('history_id')
+
+
+def save_history_id(history_id):
+    save_metadata('history_id', history_id)
+
+
+def list_history_changes(service, start_history_id):
+    # Walks every history page since the checkpoint, a message that was changed and later deleted counts as deleted
+    changed_ids, deleted_ids = {}, set()
+    history_id = start_history_id
+    page_token = None
+    while True:
+        results = SCHEDULER.execute('history', service.users().history().list(
+            userId='me', startHistoryId=start_history_id, pageToken=page_token,
+            historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']))
+
+        for record in results.get('history', []):
+            for change in record.get('messagesAdded', []) + record.get('labelsAdded', []) + \
+                    record.get('labelsRemoved', []):
+                changed_ids[change['message']['id']] = True
+            for change in record.get('messagesDeleted', []):
+                deleted_ids.add(change['message']['id'])
+
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    return [message_id for message_id in changed_ids if message_id not in deleted_ids], deleted_ids, history_id
+
+
+def sync_emails(prefilter=False, gmail_service=None, rules=None):
+    # Incremental sync, only messages touched since the stored historyId are fetched, full sync on first run or expiry
+    # With prefilter the full sync only lists the candidates the rules could match, rules are still checked locally
+    # A long running caller passes its own service and compiled rules, returns the fetch stats with the deleted count
+    if gmail_service is None:
+        gmail_service = authenticate_gmail_api('read_token.json', ['https://www.googleapis.com/auth/gmail.readonly'])
+    if rules is None:
+        rules = load_rules()
+    params = fetch_params(rules)
+    start_history_id = load_history_id()
+    message_ids, deleted_ids = None, set()
+
+    stored_params = load_metadata('fetch_params')
+    if start_history_id and not covers(json.loads(stored_params) if stored_params else None, params):
+        # Stored messages lack headers the rules now read, they have to be fetched again
+        print("Rules need headers that were not fetched before, running a full sync")
+        start_history_id = None
+
+    # '' lists the whole mailbox, which holds every candidate of any query
+    query = (gmail_query(rules) or '') if prefilter else ''
+    stored_query = load_metadata('sync_query')
+    if start_history_id and stored_query != '' and stored_query != query:
+        # History only reports changes, messages the previous query left out are never listed again otherwise
+        print("Rules changed the sync query, running a full sync")
+        start_history_id = None
+
+    if start_history_id:
+        try:
+            message_ids, deleted_ids, history_id = list_history_changes(gmail_service, start_history_id)
+        except HttpError as e:
+            # NOTE: Gmail keeps history for a limited time, a 404 means the checkpoint is too old to resume from
+            if e.resp.status != 404:
+                raise
+            print("History checkpoint expired, falling back to a full sync")
+
+    full_sync = message_ids is None
+    if full_sync:
+        # Capture the checkpoint before listing so changes made during the full walk are picked up next run
+        history_id = SCHEDULER.execute('getProfile', gmail_service.users().getProfile(userId='me'))['historyId']
+        message_ids = list_message_ids(gmail_service, query)
+
+    failed_ids = []
+    stats = {'messages': 0, 'transferred': 0, 'stored': 0}
+    stored = store_emails_in_sqlite(count_bytes(get_messages_batched(gmail_service, message_ids, failed_ids, params),
+                                                stats))
+    if deleted_ids:
+        delete_emails_from_sqlite(deleted_ids)
+    print(f"Fetched {stats['messages']} email(s) with format={params['format']}, "
+          f"{stats['transferred']} bytes transferred, {stats['stored']} bytes stored")
+
+    # Advancing past skipped messages would lose them for good, keep the old checkpoint so they are retried
+    if stored and not failed_ids:
+        save_history_id(history_id)
+        save_metadata('fetch_params', json.dumps(params))
+        if full_sync:
+            save_metadata('sync_query', query)
+    else:
+        print(f"Sync incomplete, {len(failed_ids)} email(s) skipped, checkpoint left at {start_history_id}")
+
+    stats['deleted'] = len(deleted_ids)
+    return stats
 
 
 if __name__ == '__main__':
-    mails = fetch_emails()
-    store_emails_in_sqlite(mails)
+    # Full sync on the first run, afterwards only the changes since the last stored historyId are pulled
+    if '--fts' in sys.argv or '--no-fts' in sys.argv:
+        set_fts('--fts' in sys.argv)
+    sync_emails(prefilter='--prefilter' in sys.argv)
@@ -0,0 +1,88 @@
+import json
+import time
+from gmail_client import load_metadata, save_metadata
+from quota import SCHEDULER
+
+# NOTE: Labels rarely change, the name to id map is listed again once it is older than a day. A name missing from a
+# cached map is always checked against a fresh listing before a label is created
+LABELS_TTL = 24 * 60 * 60
+# System labels are addressed by their fixed upper case id, move_to_inbox -> INBOX
+SYSTEM_LABELS = {
+    'INBOX', 'STARRED', 'IMPORTANT', 'UNREAD', 'SPAM', 'TRASH', 'SENT', 'DRAFT', 'CHAT', 'CATEGORY_PERSONAL',
+    'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS',
+}
+MOVE_PREFIX = 'move_to_'
+
+
+def label_name(action):
+    # Everything after the prefix is the name, labels may contain underscores themselves
+    return action[len(MOVE_PREFIX):]
+
+
+class LabelRegistry:
+    # Label name to id map of the mailbox, cached in the metadata table of emails.db so a run costs at most one
+    # labels.list call. Subclasses swap the transport by overriding fetch and create
+
+    def __init__(self, service, ttl=LABELS_TTL):
+        self.service = service
+        self.ttl = ttl
+        self.labels = None
+        self.fresh = False
+
+    def fetch(self):
+        response = SCHEDULER.execute('labels', self.service.users().labels().list(userId='me'))
+        return {label['name']: label['id'] for label in response.get('labels', [])}
+
+    def create(self, name):
+        label = SCHEDULER.execute('createLabel', self.service.users().labels().create(
+            userId='me', body={'name': name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}))
+        return label['id']
+
+    def save(self):
+        save_metadata('labels', json.dumps({'fetched_at': time.time(), 'labels': self.labels}))
+
+    def load(self):
+        if self.labels is not None:
+            return
+        cached = load_metadata('labels')
+        if cached:
+            cached = json.loads(cached)
+            if time.time() - cached['fetched_at'] < self.ttl:
+                self.labels = cached['labels']
+                return
+        self.refresh()
+
+    def refresh(self):
+        self.labels = self.fetch()
+        self.fresh = True
+        self.save()
+
+    def find(self, name):
+        # Gmail label names are unique regardless of case
+        if name in self.labels:
+            return self.labels[name]
+        lower = name.lower()
+        return next((label_id for label_name, label_id in self.labels.items() if label_name.lower() == lower), None)
+
+    def resolve(self, name, create=True):
+        if name.upper() in SYSTEM_LABELS:
+            return name.upper()
+        self.load()
+        label_id = self.find(name)
+        if label_id is None and not self.fresh:
+            # The cached map may predate a label made in the Gmail UI, creating it again would conflict
+            self.refresh()
+            label_id = self.find(name)
+        if label_id is None and create:
+            label_id = self.labels[name] = self.create(name)
+            self.save()
+        return label_id
+
+    def resolve_actions(self, rules, create=True):
+        # Every move_to action of the rule set resolved once, returns {action: label id} for merge_actions
+        resolved = {}
+        for rule in rules:
+            for action in rule.actions:
+                if action.startswith(MOVE_PREFIX) and action not in resolved:
+                    resolved[action] = self.resolve(label_name(action), create)
+        return resolved
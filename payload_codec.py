@@ -0,0 +1,105 @@
+import json
+import sqlite3
+import sys
+import zlib
+
+# Marks a compressed payload, rows written before the compact format hold plain JSON text
+MAGIC = b'Z1'
+
+# Header names replaced by their position in this list, anything not listed is stored by name
+HEADER_NAMES = [
+    'From', 'To', 'Cc', 'Bcc', 'Subject', 'Date', 'Reply-To', 'Delivered-To', 'Received', 'Return-Path',
+    'Message-ID', 'MIME-Version', 'Content-Type', 'Content-Transfer-Encoding', 'Content-Disposition', 'List-Id',
+    'List-Unsubscribe', 'List-Unsubscribe-Post', 'Precedence', 'Sender', 'In-Reply-To', 'References',
+    'X-Received', 'X-Google-Smtp-Source', 'X-Gm-Message-State', 'ARC-Seal', 'ARC-Message-Signature',
+    'ARC-Authentication-Results', 'Authentication-Results', 'Received-SPF', 'DKIM-Signature', 'Feedback-ID',
+]
+HEADER_CODES = {name: code for code, name in enumerate(HEADER_NAMES)}
+LOWER_HEADER_NAMES = [name.lower() for name in HEADER_NAMES]
+
+# Preset dictionary, strings every Gmail payload repeats so even a single small payload compresses well
+ZDICT = ''.join([
+    '{"partId": "", "mimeType": "multipart/alternative", "filename": "", "headers": [',
+    '"text/plain; charset=\\"UTF-8\\"", "text/html; charset=\\"UTF-8\\"", "quoted-printable", "base64", "7bit",',
+    '"multipart/mixed", "multipart/related", "image/png", "application/pdf", "inline", "attachment",',
+    '], "body": {"size": 0, "data": "', '"attachmentId": "', '"parts": [{"partId": "0", "mimeType": "text/plain"',
+    ' +0000 (UTC)', ' -0700', 'Mon, Tue, Wed, Thu, Fri, Sat, Sun, Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec ',
+    'by 2002:a05:', 'with SMTP id ', 'for <', '@gmail.com', '.google.com', 'mx.google.com; spf=pass ',
+    'dkim=pass header.i=@', 'dmarc=pass (p=REJECT sp=REJECT dis=NONE) header.from=', 'v=1; a=rsa-sha256; c=relaxed/relaxed; d=',
+    'unsubscribe', 'noreply', 'no-reply', 'https://', 'mailto:',
+]).encode()
+
+
+def intern_headers(part):
+    # Header dicts become [code or name, value] pairs, nested MIME parts are handled the same way
+    compact = dict(part)
+    if 'headers' in part:
+        compact['headers'] = [[HEADER_CODES.get(header['name'], header['name']), header['value']]
+                              for header in part['headers']]
+    if 'parts' in part:
+        compact['parts'] = [intern_headers(child) for child in part['parts']]
+    return compact
+
+
+def expand_headers(part):
+    if 'headers' in part:
+        part['headers'] = [{'name': HEADER_NAMES[name] if isinstance(name, int) else name, 'value': value}
+                           for name, value in part['headers']]
+    for child in part.get('parts', []):
+        expand_headers(child)
+    return part
+
+
+def encode_payload(payload):
+    compressor = zlib.compressobj(level=6, zdict=ZDICT)
+    data = json.dumps(intern_headers(payload), separators=(',', ':')).encode()
+    return MAGIC + compressor.compress(data) + compressor.flush()
+
+
+def decompress(value):
+    decompressor = zlib.decompressobj(zdict=ZDICT)
+    return json.loads(decompressor.decompress(value[len(MAGIC):]) + decompressor.flush())
+
+
+def decode_payload(value):
+    # Transparent read of both formats, plain JSON text from older rows and the compressed BLOB
+    if value is None:
+        return {}
+    if isinstance(value, bytes) and value.startswith(MAGIC):
+        return expand_headers(decompress(value))
+    return json.loads(value)
+
+
+def decode_headers(value):
+    # Top level headers keyed by lower case name, what rule evaluation reads. Interned names are looked up directly
+    # instead of expanding the whole payload first
+    if isinstance(value, bytes) and value.startswith(MAGIC):
+        return {(LOWER_HEADER_NAMES[name] if isinstance(name, int) else name.lower()): header_value
+                for name, header_value in decompress(value).get('headers', [])}
+    return {header['name'].lower(): header['value'] for header in decode_payload(value).get('headers', [])}
+
+
+def compress_database(db_path, chunk_size=2000):
+    # Migration tool, rewrites every plain JSON payload as a compressed BLOB then gives the space back to the disk
+    conn = sqlite3.connect(db_path)
+    try:
+        converted = 0
+        while True:
+            rows = conn.execute("SELECT id, payload FROM emails WHERE typeof(payload) = 'text' LIMIT ?",
+                                (chunk_size,)).fetchall()
+            if not rows:
+                break
+            conn.executemany('UPDATE emails SET payload = ? WHERE id = ?',
+                             [(encode_payload(json.loads(payload)), email_id) for email_id, payload in rows])
+            conn.commit()
+            converted += len(rows)
+
+        conn.execute('VACUUM')
+        return converted
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'emails.db'
+    print(f"Compressed {compress_database(path)} payload(s) in {path}")
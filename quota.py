@@ -0,0 +1,124 @@
+import heapq
+import random
+import threading
+import time
+
+# NOTE: Gmail quota units per call, https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'list': 5,
+    'get': 5,
+    'modify': 5,
+    'batchModify': 50,
+    'history': 2,
+    'getProfile': 1,
+    'labels': 1,
+    'createLabel': 5,
+}
+# NOTE: Per user limit of 15000 units a minute, spent evenly as 250 units a second
+UNITS_PER_SECOND = 250
+# Statuses worth retrying, 429 and 403 rate limits are quota, 5xx are transient backend errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 32.0
+
+
+def error_status(error):
+    # HTTP status of a googleapiclient HttpError or a requests HTTPError, None for anything else
+    response = getattr(error, 'resp', None) or getattr(error, 'response', None)
+    status = getattr(response, 'status', None) or getattr(response, 'status_code', None)
+    return int(status) if status is not None else None
+
+
+def is_retryable(error):
+    status = error_status(error)
+    if status in RETRY_STATUSES:
+        return True
+    if status != 403:
+        return False
+    # A 403 is only quota when the error body names a rate limit reason
+    response = getattr(error, 'response', None)
+    text = f"{error} {getattr(error, 'content', b'')!r} {getattr(response, 'text', '')}"
+    return any(reason in text for reason in RATE_LIMIT_REASONS)
+
+
+class QuotaScheduler:
+    # Token bucket counted in Gmail quota units and shared by every call of the process, so list, get, modify and
+    # batchModify together stay under the per user limit instead of each running at full speed until rejected
+
+    def __init__(self, rate=UNITS_PER_SECOND, capacity=None, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_cap=BACKOFF_CAP):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.sleep = time.sleep
+        self.retries = 0
+
+    def reserve(self, units):
+        # Takes the units now and returns how long to wait before using them, the bucket goes into debt so callers
+        # are served in the order they asked. Async callers sleep on the result themselves
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, method, count=1):
+        wait = self.reserve(QUOTA_UNITS[method] * count)
+        if wait:
+            self.sleep(wait)
+
+    def backoff(self, attempt):
+        # Full jitter, a random wait up to the exponential bound so clients throttled together do not retry together
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def execute(self, method, request):
+        # Runs one request (anything with execute(), or a callable) within quota, retrying 429/5xx with backoff.
+        # The last error is raised once the retries are spent
+        for attempt in range(self.max_retries + 1):
+            self.acquire(method)
+            try:
+                return request.execute() if hasattr(request, 'execute') else request()
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                self.retries += 1
+                self.sleep(self.backoff(attempt))
+
+    def run(self, calls):
+        # Runs (method, request) pairs through a retry queue, a call that is backing off goes to the back of the queue
+        # with the time it may run again, so one throttled call does not hold up the others.
+        # Returns the (call, error) pairs that still failed after their retries
+        queue = [(0.0, position, 0, call) for position, call in enumerate(calls)]
+        heapq.heapify(queue)
+        failures = []
+        sequence = len(queue)
+        while queue:
+            ready_at, _, attempt, (method, request) = heapq.heappop(queue)
+            wait = ready_at - time.monotonic()
+            if wait > 0:
+                self.sleep(wait)
+
+            self.acquire(method)
+            try:
+                request.execute() if hasattr(request, 'execute') else request()
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    failures.append(((method, request), e))
+                    continue
+                self.retries += 1
+                heapq.heappush(queue, (time.monotonic() + self.backoff(attempt), sequence, attempt + 1,
+                                       (method, request)))
+                sequence += 1
+        return failures
+
+
+# One scheduler per process, every Gmail call draws from the same quota
+SCHEDULER = QuotaScheduler()
@@ -0,0 +1,368 @@
+import base64
+import hashlib
+import html
+import json
+import re
+import time
+from datetime import timedelta, timezone
+from email.utils import parsedate_to_datetime
+from dateutil import parser
+from payload_codec import decode_headers, decode_payload
+
+# NOTE: Fields and predicates accepted in rules.json, anything else is rejected when the rules are compiled
+STRING_FIELDS = {'from', 'to', 'cc', 'bcc', 'subject', 'reply-to', 'delivered-to', 'list-id'}
+DATE_FIELDS = {'received_at'}
+STRING_PREDICATES = {'contains', 'not_contains', 'equals', 'not_equals'}
+DATE_PREDICATES = {'is_less_than', 'is_greater_than'}
+MATCH_TYPES = {'all', 'any'}
+# Fields read from the message body instead of a header, they need the full message to be fetched
+BODY_FIELDS = {'message'}
+# NOTE: Bytes of a message body decoded for rules, longer bodies are cut, contains conditions only see the start
+BODY_MAX_BYTES = 64 * 1024
+# Script and style blocks and every tag, what is left of an HTML body is the text a reader sees
+HTML_TAGS = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]+>', re.S | re.I)
+# Fields stored in their own columns of the emails table, rules on any other header need the raw payload
+COLUMN_FIELDS = {'from': 'from_addr', 'to': 'to_addr', 'subject': 'subject'}
+# Trigram FTS5 index over those columns, a literal needs at least one trigram to be looked up in it
+FTS_TABLE = 'emails_fts'
+FTS_MIN_LENGTH = 3
+# Gmail search operators for the header fields, used to pre-filter the messages listed from the server
+GMAIL_OPERATORS = {'from': 'from', 'to': 'to', 'cc': 'cc', 'bcc': 'bcc', 'subject': 'subject', 'list-id': 'list',
+                   'delivered-to': 'deliveredto'}
+# A contains literal opening and closing on a non-word character, ' Interview ' or '<alerts@reddit.com>', can only
+# occur locally around whole words, the words in between are what Gmail search is given
+WHOLE_WORDS = re.compile(r'\W+(\w.*\w|\w)\W+', re.S)
+
+
+class RuleError(ValueError):
+    pass
+
+
+def parse_headers(payload):
+    # Extract the headers and store them in a dictionary for easy use
+    headers = {}
+    for header in payload.get('headers', []):
+        name = header['name'].lower()
+        headers[name] = header['value']
+    return headers
+
+
+def parse_time_value(value):
+    if 'day' in value:
+        days = int(value.replace('days', '').replace('day', '').strip())
+        return timedelta(days=days)
+    elif 'month' in value:
+        months = int(value.replace('months', '').replace('month', '').strip())
+        return timedelta(days=months * 30)  # Approximate month as 30 days
+    else:
+        raise ValueError(f"Unsupported time value: {value}")
+
+
+def parse_received_at(date):
+    # Date header as a UTC epoch, None when the header is missing or unreadable
+    if not date:
+        return None
+    try:
+        # Mail dates are RFC 2822, the stdlib parser handles them far faster than dateutil which covers the rest
+        parsed = parsedate_to_datetime(date)
+    except (TypeError, ValueError, IndexError):
+        try:
+            parsed = parser.parse(date)
+        except (ValueError, OverflowError):
+            return None
+    if parsed.tzinfo is None:
+        # -0000 and dates without a zone are UTC, a naive datetime would be read in the machine's local time
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def find_part(part, mime_type):
+    # Base64url data of the first inline part of that type, attachments are skipped
+    if part.get('mimeType') == mime_type and not part.get('filename') and part.get('body', {}).get('data'):
+        return part['body']['data']
+    for child in part.get('parts', []):
+        data = find_part(child, mime_type)
+        if data is not None:
+            return data
+    return None
+
+
+def decode_part(data, max_bytes):
+    # Only the base64 characters covering max_bytes are decoded, Gmail leaves the padding out
+    data = data[:-(-max_bytes // 3) * 4]
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))[:max_bytes].decode('utf-8', 'replace')
+
+
+def extract_body(payload, max_bytes=BODY_MAX_BYTES):
+    # Text of the message, the text/plain part when there is one, otherwise the text/html part without its tags
+    data = find_part(payload, 'text/plain')
+    if data is not None:
+        return decode_part(data, max_bytes)
+    data = find_part(payload, 'text/html')
+    if data is not None:
+        return html.unescape(HTML_TAGS.sub(' ', decode_part(data, max_bytes)))
+    return ''
+
+
+# Marks a date that has not been parsed yet, None is a valid parse result for a missing Date header
+UNPARSED = object()
+
+
+class ParsedEmail:
+    # An email parsed once per run, every rule reads the same header dict. The date is parsed and the body decoded
+    # on first use, an email no rule reaches the body of never decodes it
+
+    __slots__ = ('id', 'headers', '_received_at', 'payload', '_body')
+
+    def __init__(self, email_id, headers, received_at=UNPARSED, payload=None):
+        self.id = email_id
+        self.headers = headers
+        self._received_at = received_at
+        self.payload = payload
+        self._body = None
+
+    @classmethod
+    def from_payload(cls, email_id, payload):
+        # Accepts the decoded dict, plain JSON text from older rows or the compressed BLOB
+        headers = parse_headers(payload) if isinstance(payload, dict) else decode_headers(payload)
+        return cls(email_id, headers, payload=payload)
+
+    @property
+    def body(self):
+        if self._body is None:
+            if not isinstance(self.payload, dict):
+                self.payload = decode_payload(self.payload)
+            self._body = extract_body(self.payload, BODY_MAX_BYTES)
+        return self._body
+
+    def value(self, field):
+        # What a string condition on the field compares against, '' when the header is missing
+        if field in BODY_FIELDS:
+            return self.body
+        return self.headers.get(field, '')
+
+    @property
+    def received_at(self):
+        if self._received_at is UNPARSED:
+            self._received_at = parse_received_at(self.headers.get('date'))
+        return self._received_at
+
+
+class StringCondition:
+
+    __slots__ = ('field', 'predicate', 'value')
+
+    def __init__(self, field, predicate, value):
+        self.field, self.predicate, self.value = field, predicate, value
+
+    def matches(self, email, now):
+        field_value = email.value(self.field)
+        if self.predicate == 'contains':
+            return self.value in field_value
+        elif self.predicate == 'not_contains':
+            return self.value not in field_value
+        elif self.predicate == 'equals':
+            return self.value == field_value
+        return self.value != field_value
+
+    def to_sql(self, now, fts=False):
+        # Missing headers are NULL in the DB but '' in Python, IFNULL keeps both paths in agreement
+        column = COLUMN_FIELDS.get(self.field)
+        if column is None:
+            return None
+        if fts and self.predicate in ('contains', 'not_contains') and len(self.value) >= FTS_MIN_LENGTH:
+            # The trigram index returns the rows holding the literal without scanning the column. It is case
+            # sensitive like the Python check, a phrase of trigrams only matches where the literal occurs as is
+            query = f'{column} : "{self.value.replace(chr(34), chr(34) * 2)}"'
+            operator = 'IN' if self.predicate == 'contains' else 'NOT IN'
+            return f'rowid {operator} (SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ?)', [query]
+        if self.predicate == 'contains':
+            return f"instr(IFNULL({column}, ''), ?) > 0", [self.value]
+        elif self.predicate == 'not_contains':
+            return f"instr(IFNULL({column}, ''), ?) = 0", [self.value]
+        elif self.predicate == 'equals':
+            # A plain comparison keeps the column index usable
+            return (f"{column} = ?", [self.value]) if self.value else (f"IFNULL({column}, '') = ''", [])
+        return f"IFNULL({column}, '') != ?", [self.value]
+
+    def to_gmail_query(self):
+        # The term must list every message the condition can match locally, never fewer. Gmail ignores case, which
+        # only adds candidates, but matches whole words, so 'nterview' would miss 'Interview' and a negated term would
+        # drop 'Reddit' for -from:"reddit". None means the condition must not restrict the listing
+        operator = GMAIL_OPERATORS.get(self.field)
+        if operator is None or '"' in self.value:
+            return None
+        if self.predicate == 'equals':
+            value = self.value.strip()
+        elif self.predicate == 'contains':
+            whole_words = WHOLE_WORDS.fullmatch(self.value)
+            value = whole_words.group(1) if whole_words else None
+        else:
+            return None
+        return f'{operator}:"{value}"' if value else None
+
+
+class DateCondition:
+
+    __slots__ = ('field', 'predicate', 'value', 'time_difference')
+
+    def __init__(self, field, predicate, value):
+        self.field, self.predicate, self.value = field, predicate, value
+        # The "5days" style value is parsed once here instead of once per email
+        self.time_difference = parse_time_value(value)
+
+    def matches(self, email, now):
+        received_at = email.received_at
+        if received_at is None:
+            return False
+        if self.predicate == 'is_less_than':
+            return now - received_at < self.time_difference.total_seconds()
+        return now - received_at > self.time_difference.total_seconds()
+
+    def mask(self, received_at, now):
+        # Vectorized matches over a NumPy array of epochs
+        if self.predicate == 'is_less_than':
+            return now - received_at < self.time_difference.total_seconds()
+        return now - received_at > self.time_difference.total_seconds()
+
+    def to_sql(self, now, fts=False):
+        # Rewritten as a range on the epoch column so the received_at index is used
+        cutoff = now - self.time_difference.total_seconds()
+        if self.predicate == 'is_less_than':
+            return 'received_at > ?', [cutoff]
+        return 'received_at < ?', [cutoff]
+
+    def to_gmail_query(self):
+        # The listing seeds the history checkpoint, a message older_than left out would never be listed again once it
+        # ages into the rule. Terms relative to the time of the sync are never sent
+        return None
+
+
+class Rule:
+
+    __slots__ = ('conditions', 'match_all', 'actions', 'hash')
+
+    def __init__(self, conditions, match_all, actions, rule_hash=None):
+        self.conditions, self.match_all, self.actions = conditions, match_all, actions
+        # Identifies the rule across runs, any edit to its conditions or actions gives it a new hash
+        self.hash = rule_hash
+
+    @property
+    def time_dependent(self):
+        # Date conditions change their result as time passes, even for an email that has not changed
+        return any(condition.field in DATE_FIELDS for condition in self.conditions)
+
+    def matches(self, email, now):
+        # Generators short circuit, all stops at the first False and any at the first True
+        if self.match_all:
+            return all(condition.matches(email, now) for condition in self.conditions)
+        return any(condition.matches(email, now) for condition in self.conditions)
+
+    def to_sql(self, now, fts=False):
+        # One parameterized WHERE clause for the whole rule, None when a condition has no column to run against.
+        # fts answers contains conditions from the trigram index
+        clauses, params = [], []
+        for condition in self.conditions:
+            translated = condition.to_sql(now, fts)
+            if translated is None:
+                return None
+            clauses.append(f'({translated[0]})')
+            params.extend(translated[1])
+
+        if not clauses:
+            return ('1', []) if self.match_all else ('0', [])
+        return (' AND ' if self.match_all else ' OR ').join(clauses), params
+
+    def to_gmail_query(self):
+        # All drops the terms it can not express, that only widens the search. Any needs every term, a missing one
+        # could match anything so the rule can not restrict the listing at all
+        terms = [condition.to_gmail_query() for condition in self.conditions]
+        if self.match_all:
+            terms = [term for term in terms if term]
+            return f"({' '.join(terms)})" if terms else None
+        if not terms or None in terms:
+            return None
+        return f"{{{' '.join(terms)}}}"
+
+
+def compile_condition(condition):
+    try:
+        field, predicate, value = condition['field'], condition['predicate'], condition['value']
+    except (KeyError, TypeError):
+        raise RuleError(f"Condition needs field, predicate and value: {condition}")
+
+    if field in DATE_FIELDS:
+        if predicate not in DATE_PREDICATES:
+            raise RuleError(f"Unknown predicate '{predicate}' for field '{field}'")
+        try:
+            return DateCondition(field, predicate, value)
+        except ValueError as e:
+            raise RuleError(str(e))
+
+    if field in STRING_FIELDS or field in BODY_FIELDS:
+        if predicate not in STRING_PREDICATES:
+            raise RuleError(f"Unknown predicate '{predicate}' for field '{field}'")
+        return StringCondition(field, predicate, value)
+
+    raise RuleError(f"Unknown field '{field}'")
+
+
+def compile_conditions(conditions, match_all, actions=(), rule_hash=None):
+    # Body conditions go last, short circuiting on the header and date conditions spares most emails the decode
+    compiled = sorted((compile_condition(condition) for condition in conditions),
+                      key=lambda condition: condition.field in BODY_FIELDS)
+    return Rule(compiled, match_all, list(actions), rule_hash)
+
+
+def rule_hash(rule):
+    return hashlib.sha1(json.dumps(rule, sort_keys=True).encode()).hexdigest()
+
+
+def compile_rules(rules):
+    # Turns the rules.json structure into Rule objects once, validating it on the way
+    compiled = []
+    for rule in rules:
+        try:
+            match, conditions, actions = rule['conditions']['match'], rule['conditions']['rules'], rule['actions']
+        except (KeyError, TypeError):
+            raise RuleError(f"Rule needs conditions.match, conditions.rules and actions: {rule}")
+
+        if match not in MATCH_TYPES:
+            raise RuleError(f"Unknown match type '{match}', expected 'all' or 'any'")
+        for action in actions:
+            if action not in ('mark_as_read', 'mark_as_unread') and not action.startswith('move_to_'):
+                raise RuleError(f"Unknown action '{action}'")
+
+        compiled.append(compile_conditions(conditions, match == 'all', actions, rule_hash(rule)))
+    return compiled
+
+
+def gmail_query(rules):
+    # Gmail search query selecting every message some rule could match, None when the whole mailbox is needed
+    parts = []
+    for rule in rules:
+        if not rule.match_all and not rule.conditions:
+            # An empty any rule never matches, it adds no candidates
+            continue
+        query = rule.to_gmail_query()
+        if query is None:
+            return None
+        parts.append(query)
+
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else f"{{{' '.join(parts)}}}"
+
+
+def rule_fields(rules):
+    return {condition.field for rule in rules for condition in rule.conditions}
+
+
+def evaluate(rules, email, now=None):
+    # Actions of every matching rule in rules.json order, now (UTC epoch) is snapshotted once by the caller for a run
+    now = now or time.time()
+    actions = []
+    for rule in rules:
+        if rule.matches(email, now):
+            actions.extend(rule.actions)
+    return actions
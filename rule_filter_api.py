@@ -1,11 +1,23 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import os
 import json
 import sqlite3
 import requests
+import time
+from requests.adapters import HTTPAdapter
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from rule_filter_client import match_rule
+from gmail_client import chunked, init_db
+from label_registry import LabelRegistry
+from quota import QUOTA_UNITS, SCHEDULER, is_retryable
+from rule_engine import compile_rules
+from rule_filter_client import find_new_matches, merge_actions, plan_actions, record_ledger, BATCH_MODIFY_SIZE
+
+MESSAGES_URL = 'https://www.googleapis.com/gmail/v1/users/me/messages'
+LABELS_URL = 'https://www.googleapis.com/gmail/v1/users/me/labels'
+# NOTE: Requests in flight at once, also the size of the keep-alive connection pool
+CONCURRENCY = 10
 
 
 def authenticate_gmail_api(token_file, scopes):
@@ -17,6 +29,8 @@ def authenticate_gmail_api(token_file, scopes):
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
             else:
+                # Only imported when interactive consent is needed, it is slow to import
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file('credentials.json', scopes)
                 creds = flow.run_local_server(port=0)
             with open(token_file, 'w') as token:
@@ -28,52 +42,149 @@ def authenticate_gmail_api(token_file, scopes):
         return None
 
 
-def apply_actions(access_token, email_id, actions):
-    # NOTE: Implementing API based updates instead of using the client library directly
-    try:
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-
-        for action in actions:
-            data = {}
-            if action.startswith('mark_as'):
-                if action.split('_')[-1].upper() == 'READ':
-                    data = {'removeLabelIds': ['UNREAD']}
-                else:
-                    data = {'addLabelIds': ['UNREAD']}
-            elif action.startswith('move_to'):
-                data = {'addLabelIds': [action.split('_')[-1].upper()]}
-
-            response = requests.post(f'https://www.googleapis.com/gmail/v1/users/me/messages/{email_id}/modify',
-                                     headers=headers, json=data)
-            response.raise_for_status()
+def refresh_access_token(token_file, scopes):
+    # Forces a refresh of the stored credentials, called when the API answers 401 to a token that looked valid
+    creds = Credentials.from_authorized_user_file(token_file, scopes)
+    creds.refresh(Request())
+    with open(token_file, 'w') as token:
+        token.write(creds.to_json())
+    return creds.token
 
-    except Exception as e:
-        print(f"Failed to execute action: {e}")
 
+class ActionExecutor:
+    # Sends modify / batchModify calls concurrently over one pooled session, so connections are kept alive between
+    # calls instead of one TLS handshake per action. requests is blocking, each call runs on a thread pool sized to the
+    # concurrency limit and the semaphore caps how many are in flight
+
+    def __init__(self, access_token, refresh=None, concurrency=CONCURRENCY, messages_url=MESSAGES_URL):
+        self.access_token = access_token
+        self.refresh = refresh
+        self.concurrency = concurrency
+        self.messages_url = messages_url
+        self.session = requests.Session()
+        self.session.mount(messages_url, HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+        self.refreshes = 0
+
+    def send(self, path, body):
+        return self.session.post(f'{self.messages_url}/{path}', json=body,
+                                 headers={'Authorization': f'Bearer {self.access_token}'})
+
+    async def in_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.threads, function, *args)
+
+    async def attempt(self, path, body):
+        # Waits for quota from the shared scheduler without holding up the event loop
+        await asyncio.sleep(SCHEDULER.reserve(QUOTA_UNITS[path.rsplit('/', 1)[-1]]))
+        token = self.access_token
+        response = await self.in_thread(self.send, path, body)
+        if response.status_code == 401 and self.refresh:
+            # Concurrent 401s share one refresh, only the first caller to see the stale token refreshes it
+            async with self.refresh_lock:
+                if self.access_token == token:
+                    self.access_token = await self.in_thread(self.refresh)
+                    self.refreshes += 1
+            response = await self.in_thread(self.send, path, body)
+        response.raise_for_status()
+
+    async def post(self, path, body):
+        async with self.semaphore:
+            for attempt in range(SCHEDULER.max_retries + 1):
+                try:
+                    return await self.attempt(path, body)
+                except requests.HTTPError as e:
+                    if attempt == SCHEDULER.max_retries or not is_retryable(e):
+                        raise
+                    await asyncio.sleep(SCHEDULER.backoff(attempt))
+
+    async def run(self, calls):
+        # calls is a list of (path, body), returns the calls that failed after printing each error
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.refresh_lock = asyncio.Lock()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as self.threads:
+            results = await asyncio.gather(*(self.post(path, body) for path, body in calls), return_exceptions=True)
+        failed = []
+        for call, result in zip(calls, results):
+            if isinstance(result, Exception):
+                print(f"Failed to execute action: {result}")
+                failed.append(call)
+        return failed
+
+    def execute(self, calls):
+        try:
+            return asyncio.run(self.run(calls))
+        finally:
+            self.session.close()
+
+
+class RestLabelRegistry(LabelRegistry):
+    # Same cached name to id map, labels are listed and created over REST with the access token
+
+    def send(self, method, body):
+        response = requests.request(method, LABELS_URL, json=body,
+                                    headers={'Authorization': f'Bearer {self.service}'})
+        response.raise_for_status()
+        return response.json()
 
-def apply_rules():
+    def request(self, method, body=None):
+        # Within quota like every other Gmail call, rate limits and 5xx are retried with backoff
+        return SCHEDULER.execute('labels' if method == 'GET' else 'createLabel', lambda: self.send(method, body))
+
+    def fetch(self):
+        return {label['name']: label['id'] for label in self.request('GET').get('labels', [])}
+
+    def create(self, name):
+        return self.request('POST', {'name': name, 'labelListVisibility': 'labelShow',
+                                     'messageListVisibility': 'show'})['id']
+
+
+def modify_calls(email_actions, email_labels=None, labels=None):
+    # One modify call per email with its merged label diff, emails with nothing to change are left out
+    email_labels = email_labels or {}
+    calls = []
+    for email_id, actions in email_actions:
+        add, remove = merge_actions(actions, email_labels.get(email_id), labels)
+        if add or remove:
+            calls.append((f'{email_id}/modify', {'addLabelIds': list(add), 'removeLabelIds': list(remove)}))
+    return calls
+
+
+def batch_modify_calls(plan):
+    return [('batchModify', {'ids': chunk, 'addLabelIds': list(add), 'removeLabelIds': list(remove)})
+            for (add, remove), email_ids in plan.items() for chunk in chunked(email_ids, BATCH_MODIFY_SIZE)]
+
+
+def batch_modify(access_token, plan, refresh=None, concurrency=CONCURRENCY):
+    # Every batchModify chunk of the plan is sent through the executor, they run concurrently.
+    # Returns the ids of the emails whose call failed
+    failed = ActionExecutor(access_token, refresh, concurrency).execute(batch_modify_calls(plan))
+    return {email_id for _, body in failed for email_id in body['ids']}
+
+
+def apply_rules(pushdown=True):
     with open('rules.json', 'r') as f:
-        rules = json.load(f)
+        rules = compile_rules(json.load(f))
 
-    service = authenticate_gmail_api('write_token.json', ['https://www.googleapis.com/auth/gmail.modify'])
+    scopes = ['https://www.googleapis.com/auth/gmail.modify']
+    service = authenticate_gmail_api('write_token.json', scopes)
+    labels = RestLabelRegistry(service).resolve_actions(rules)
     conn = sqlite3.connect('emails.db')
     c = conn.cursor()
-    for row in c.execute('SELECT * FROM emails'):
-        for rule in rules:
-            match_all = rule['conditions']['match'] == 'all'
-            email_id, payload = row
-            email = {
-                'id': email_id,
-                'payload': payload
-            }
-            match = match_rule(email, rule['conditions']['rules'], match_all)
-            if match:
-                apply_actions(service, email_id, rule['actions'])
-
-    conn.close()
+    init_db(c)
+    now = time.time()
+    email_actions, email_labels = {}, {}
+    matches, matched, checkpoint = find_new_matches(c, rules, now, pushdown)
+    for email_id, (actions, label_ids) in matches.items():
+        email_actions[email_id] = actions
+        if label_ids is not None:
+            email_labels[email_id] = set(json.loads(label_ids))
+
+    # Same match results and ledger as rule_filter_client, only the transport differs
+    try:
+        failed_ids = batch_modify(service, plan_actions(email_actions.items(), email_labels, labels),
+                                  refresh=lambda: refresh_access_token('write_token.json', scopes))
+        record_ledger(conn, matched, failed_ids, checkpoint, now)
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
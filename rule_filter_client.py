@@ -1,108 +1,493 @@
 import json
+import os
 import sqlite3
-from datetime import datetime, timedelta
-from dateutil import parser
-from gmail_client import authenticate_gmail_api
-
-
-def parse_headers(payload):
-    # Extract the headers and store them in a dictionary for easy use
-    headers = {}
-    for header in payload.get('headers', []):
-        name = header['name'].lower()
-        headers[name] = header['value']
-    return headers
-
-
-def parse_time_value(value):
-    if 'day' in value:
-        days = int(value.replace('days', '').replace('day', '').strip())
-        return timedelta(days=days)
-    elif 'month' in value:
-        months = int(value.replace('months', '').replace('month', '').strip())
-        return timedelta(days=months * 30)  # Approximate month as 30 days
-    else:
-        raise ValueError(f"Unsupported time value: {value}")
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from gmail_client import authenticate_gmail_api, chunked, init_db
+from label_registry import MOVE_PREFIX, LabelRegistry, label_name
+from payload_codec import decode_payload
+from rule_engine import (BODY_FIELDS, COLUMN_FIELDS, DATE_FIELDS, FTS_TABLE, ParsedEmail, compile_conditions,
+                         compile_rules, parse_headers, parse_time_value, rule_fields)
+from quota import SCHEDULER
+from rule_index import RuleIndex
+
+# NOTE: Gmail accepts at most 1000 ids in one batchModify call
+BATCH_MODIFY_SIZE = 1000
+# NOTE: Every pushed down rule is its own query, past this many rules a single pass through the rule index is cheaper
+PUSHDOWN_MAX_RULES = 20
+# Emails evaluated together, date conditions are decided with one NumPy comparison per batch
+EVAL_BATCH_SIZE = 10000
+# Rowid ranges handed out per worker, more ranges than workers keeps them busy when matches are unevenly spread
+RANGES_PER_WORKER = 4
+# NOTE: Pipeline stages hand work over through queues of this size, a full queue blocks the stage feeding it so
+# memory stays bounded whatever the mailbox size
+PIPELINE_QUEUE_SIZE = 1000
+# Matched emails looked up in the ledger per query, also keeps the IN list under SQLite's variable limit
+LEDGER_LOOKUP_SIZE = 500
+DISPATCHERS = 4
+# Marks the end of a pipeline queue
+DONE = object()
 
 
 def match_rule(email, conditions, match_all):
-    headers = parse_headers(json.loads(email['payload']))
-    matches = []
+    # Single rule check kept for callers outside apply_rules, compiles the conditions on every call
+    rule = compile_conditions(conditions, match_all)
+    return rule.matches(ParsedEmail.from_payload(email.get('id'), email['payload']), time.time())
+
+
+def load_emails(cur, rules, where='', params=()):
+    # Streams (email, label_ids) pairs built from the header columns. The payload is only read when a rule references
+    # a header that has no column of its own or the body, and decoded at most once per email: up front for such
+    # headers, otherwise only when a body condition is reached
+    fields = rule_fields(rules)
+    payload_headers = not fields <= set(COLUMN_FIELDS) | DATE_FIELDS | BODY_FIELDS
+    needs_payload = payload_headers or bool(fields & BODY_FIELDS)
+    query = 'SELECT id, label_ids, from_addr, to_addr, subject, received_at' + (', payload' if needs_payload else '')
+
+    for row in cur.execute(query + ' FROM emails' + (f' WHERE {where}' if where else ''), params):
+        email_id, label_ids, from_addr, to_addr, subject, received_at = row[:6]
+        if payload_headers:
+            # The body reuses the decoded dict, headers alone are read without expanding the payload
+            email = ParsedEmail.from_payload(email_id, decode_payload(row[6]) if fields & BODY_FIELDS else row[6])
+            email._received_at = received_at
+        else:
+            headers = {field: value for field, value in zip(COLUMN_FIELDS, (from_addr, to_addr, subject))
+                       if value is not None}
+            email = ParsedEmail(email_id, headers, received_at, row[6] if needs_payload else None)
+        yield email, label_ids
+
+
+# Per worker process state, set once by init_worker so the rules are not pickled again for every range
+worker_state = {}
+
+
+def init_worker(db_path, rules, now):
+    # Each worker reads through its own read-only connection and holds its own copy of the compiled rules
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    worker_state.update(cur=conn.cursor(), rule_index=RuleIndex(rules), now=now)
+
+
+def match_range(first_rowid, last_rowid):
+    # Evaluates one rowid range, only matched emails go back to the parent as (id, rule positions, label_ids)
+    rule_index, now = worker_state['rule_index'], worker_state['now']
+    emails = load_emails(worker_state['cur'], rule_index.rules, 'rowid BETWEEN ? AND ?', (first_rowid, last_rowid))
+    return list(match_emails(rule_index, emails, now))
+
+
+def rowid_ranges(cur, count):
+    first, last = cur.execute('SELECT MIN(rowid), MAX(rowid) FROM emails').fetchone()
+    if first is None:
+        return []
+    step = -(-(last - first + 1) // count)
+    return [(start, min(start + step - 1, last)) for start in range(first, last + 1, step)]
+
+
+def match_parallel(cur, rules, now, workers):
+    # Splits the table into rowid ranges evaluated across a process pool, yields (id, rule positions, label_ids)
+    db_path = cur.execute('PRAGMA database_list').fetchone()[2]
+    ranges = rowid_ranges(cur, workers * RANGES_PER_WORKER)
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(db_path, rules, now)) as pool:
+        for matched in pool.map(match_range, [first for first, _ in ranges], [last for _, last in ranges]):
+            yield from matched
+
+
+def match_emails(rule_index, emails, now):
+    # Yields (id, rule positions, label_ids) for the matched ones among (email, label_ids) pairs
+    for chunk in chunked(emails, EVAL_BATCH_SIZE):
+        for (email, label_ids), positions in zip(chunk, rule_index.match_batch([email for email, _ in chunk], now)):
+            if positions:
+                yield email.id, positions, label_ids
+
 
-    for condition in conditions:
-        field, predicate, value = condition['field'], condition['predicate'], condition['value']
-        field_value = headers.get(field, '')
+def match_serial(cur, rules, now, where='', params=()):
+    return match_emails(RuleIndex(rules), load_emails(cur, rules, where, params), now)
 
-        if field == 'received_at':
-            email_date = parser.parse(headers.get('date', '1')).replace(tzinfo=None)
-            time_difference = parse_time_value(value)
 
-            if predicate == 'is_less_than':
-                matches.append(datetime.utcnow() - email_date < time_difference)
-            elif predicate == 'is_greater_than':
-                matches.append(datetime.utcnow() - email_date > time_difference)
+def has_fts(cur):
+    return cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone() is not None
 
+
+def match_rules(cur, rules, now, pushdown=True, workers=1, where='', params=()):
+    # Returns ({email_id: matched rule indexes}, {email_id: label_ids}). where restricts the emails looked at, the
+    # process pool can not see the caller's temp tables so a restricted run stays serial
+    matched_rules, email_labels = {}, {}
+    python_rules = []
+    pushdown = pushdown and len(rules) <= PUSHDOWN_MAX_RULES
+    # contains conditions on the header columns are answered from the trigram index when the DB has one
+    fts = pushdown and has_fts(cur)
+
+    for index, rule in enumerate(rules):
+        translated = rule.to_sql(now, fts) if pushdown else None
+        if translated is None:
+            python_rules.append((index, rule))
+            continue
+
+        rule_where, rule_params = translated
+        if where:
+            rule_where, rule_params = f'({where}) AND ({rule_where})', [*params, *rule_params]
+        for email_id, label_ids in cur.execute(f'SELECT id, label_ids FROM emails WHERE {rule_where}', rule_params):
+            matched_rules.setdefault(email_id, []).append(index)
+            email_labels[email_id] = label_ids
+
+    if python_rules:
+        rules_left = [rule for _, rule in python_rules]
+        parallel = workers > 1 and not where and cur.execute('PRAGMA database_list').fetchone()[2]
+        if parallel:
+            matched = match_parallel(cur, rules_left, now, workers)
         else:
-            if predicate == 'contains':
-                matches.append(value in field_value)
-            elif predicate == 'not_contains':
-                matches.append(value not in field_value)
-            elif predicate == 'equals':
-                matches.append(value == field_value)
-            elif predicate == 'not_equals':
-                matches.append(value != field_value)
+            matched = match_serial(cur, rules_left, now, where, params)
+        for email_id, positions, label_ids in matched:
+            for position in positions:
+                matched_rules.setdefault(email_id, []).append(python_rules[position][0])
+            email_labels[email_id] = label_ids
+
+    return {email_id: sorted(indexes) for email_id, indexes in matched_rules.items()}, email_labels
+
+
+def matched_actions(rules, matched_rules, email_labels):
+    # Actions are put back in rules.json order so conflicts resolve the same way on both paths
+    matches = {}
+    for email_id, indexes in matched_rules.items():
+        actions = [action for index in indexes for action in rules[index].actions]
+        if actions:
+            matches[email_id] = (actions, email_labels[email_id])
+    return matches
+
+
+def find_matches(cur, rules, now, pushdown=True, workers=1):
+    # Returns {email_id: (actions, label_ids)}, rules translated to SQL let SQLite do the filtering through the
+    # column indexes, the rest are evaluated in Python over the loaded emails through the rule index.
+    # With workers > 1 the Python evaluation is spread over a process pool, an in-memory DB always runs serially
+    return matched_actions(rules, *match_rules(cur, rules, now, pushdown, workers))
+
+
+def load_value(cur, key):
+    row = cur.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def ledger_checkpoint(cur, rules):
+    # The checkpoint stops at the last finished store, a store still running writes more rows under its sequence
+    # after this run
+    return {'sequence': int(load_value(cur, 'store_sequence_done') or 0),
+            'rules': sorted({rule.hash for rule in rules})}
+
+
+def applied_pairs(cur, email_ids):
+    # (email_id, rule_hash) pairs already in the ledger, one query per LEDGER_LOOKUP_SIZE emails
+    applied = set()
+    for chunk in chunked(email_ids, LEDGER_LOOKUP_SIZE):
+        applied.update(cur.execute(f"SELECT email_id, rule_hash FROM ledger WHERE email_id IN "
+                                   f"({', '.join('?' * len(chunk))})", chunk))
+    return applied
+
+
+def find_new_matches(cur, rules, now, pushdown=True, workers=1):
+    # Like find_matches, but only for work the ledger has not seen. Returns (matches, {email_id: matched rule
+    # hashes}, checkpoint). Rules are evaluated over every email when they are new or edited, or when they have
+    # date conditions, whose result moves with time. Every rule is evaluated over the emails stored since the last
+    # checkpoint and over the emails a fresh rule matched, so each email's actions are still merged across all
+    # rules. An email whose every matched rule is already in the ledger is dropped
+    checkpoint = ledger_checkpoint(cur, rules)
+    last = json.loads(load_value(cur, 'ledger_checkpoint') or '{"sequence": 0, "rules": []}')
+    evaluated = set(last['rules'])
+    fresh = [rule for rule in rules if rule.hash not in evaluated or rule.time_dependent]
+
+    if len(fresh) == len(rules):
+        matched_rules, email_labels = match_rules(cur, rules, now, pushdown, workers)
+    else:
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS candidates (id TEXT PRIMARY KEY)')
+        cur.execute('DELETE FROM temp.candidates')
+        if fresh:
+            fresh_matches, _ = match_rules(cur, fresh, now, pushdown, workers)
+            cur.executemany('INSERT INTO temp.candidates (id) VALUES (?)', [(email_id,) for email_id in fresh_matches])
+        matched_rules, email_labels = match_rules(cur, rules, now, pushdown, workers,
+                                                  'sequence > ? OR id IN (SELECT id FROM temp.candidates)',
+                                                  (last['sequence'],))
 
-    # NOTE: Can implement early termination for better performance (all -> exit on first False | any -> return on
-    # first True), current code is kept as it is for simplicity and can be optimized when application scales
-    return all(matches) if match_all else any(matches)
+    # Matches already in the ledger, looked up for the matched emails only
+    applied = applied_pairs(cur, list(matched_rules))
 
+    new_rules = {}
+    for email_id, indexes in matched_rules.items():
+        hashes = {rules[index].hash for index in indexes}
+        if any((email_id, rule_hash) not in applied for rule_hash in hashes):
+            new_rules[email_id] = indexes
+    matches = matched_actions(rules, new_rules, email_labels)
+    return matches, {email_id: [rules[index] for index in indexes] for email_id, indexes in new_rules.items()}, \
+        checkpoint
 
-def apply_actions(service, email_id, actions):
+
+def record_ledger(conn, matched, failed_ids, checkpoint, now):
+    # Records the matches whose actions went through. The checkpoint only moves when nothing failed, otherwise the
+    # next run looks at the same emails again and the ledger keeps it from repeating the calls that succeeded
+    # Serialized once per rule, not once per matched email
+    actions = {rule.hash: rule.actions for matched_rules in matched.values() for rule in matched_rules}
+    actions = {rule_hash: json.dumps(rule_actions) for rule_hash, rule_actions in actions.items()}
+    conn.executemany('INSERT OR REPLACE INTO ledger (email_id, rule_hash, actions, applied_at) VALUES (?, ?, ?, ?)',
+                     [(email_id, rule.hash, actions[rule.hash], now)
+                      for email_id, matched_rules in matched.items() if email_id not in failed_ids
+                      for rule in matched_rules])
+    if not failed_ids:
+        conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('ledger_checkpoint', ?)",
+                     (json.dumps(checkpoint),))
+    conn.commit()
+
+
+def action_labels(action, labels=None):
+    # Label changes for a single action, True adds the label and False removes it
+    # labels maps move_to actions to label ids, resolved once per run by the label registry. Without it the name is
+    # taken as a system label id
+    if action.startswith('mark_as'):
+        if action == 'mark_as_read':
+            return {'UNREAD': False}
+        return {'UNREAD': True}
+    elif action.startswith(MOVE_PREFIX):
+        return {(labels or {}).get(action) or label_name(action).upper(): True}
+    return {}
+
+
+def merge_actions(actions, label_ids=None, labels=None):
+    # Collapses a list of actions into one (add, remove) label diff
+    # NOTE: Conflicts (mark_as_read vs mark_as_unread) are resolved by order, actions are collected in rules.json order
+    # so the action of the rule listed last wins, which keeps the outcome independent of evaluation order
+    changes = {}
+    for action in actions:
+        changes.update(action_labels(action, labels))
+
+    # With the stored labels known, adding a present label or removing an absent one is a no-op and dropped
+    if label_ids is not None:
+        changes = {label: added for label, added in changes.items() if added != (label in label_ids)}
+
+    add = tuple(sorted(label for label, added in changes.items() if added))
+    remove = tuple(sorted(label for label, added in changes.items() if not added))
+    return add, remove
+
+
+def apply_actions(service, email_id, actions, label_ids=None, labels=None):
     try:
         # Supports mark as read / move to inbox, can be extended for more requirements
-        for action in actions:
-            body = {}
-            if action.startswith('mark_as'):
-                if action.split('_')[-1].upper() == 'READ':
-                    body = {'removeLabelIds': ['UNREAD']}
-                else:
-                    body = {'addLabelIds': ['UNREAD']}
-            elif action.startswith('move_to'):
-                body = {'addLabelIds': [action.split('_')[-1].upper()]}
-
-            service.users().messages().modify(
-                userId='me',
-                id=email_id,
-                body=body
-            ).execute()
+        # All actions are merged so an email costs at most one modify call, none if nothing would change
+        add, remove = merge_actions(actions, label_ids, labels)
+        if not add and not remove:
+            return
+
+        body = {}
+        if add:
+            body['addLabelIds'] = list(add)
+        if remove:
+            body['removeLabelIds'] = list(remove)
+
+        SCHEDULER.execute('modify', service.users().messages().modify(
+            userId='me',
+            id=email_id,
+            body=body
+        ))
 
     except Exception as e:
         print(f"Failed to execute action: {e}")
 
 
-def apply_rules():
-    with open('rules.json', 'r') as f:
-        rules = json.load(f)
+def plan_actions(email_actions, email_labels=None, labels=None):
+    # Groups email ids by their final label diff, cost then scales with distinct diffs instead of emails
+    email_labels = email_labels or {}
+    plan = {}
+    for email_id, actions in email_actions:
+        add, remove = merge_actions(actions, email_labels.get(email_id), labels)
+        if add or remove:
+            plan.setdefault((add, remove), []).append(email_id)
+    return plan
+
+
+def batch_modify(service, plan):
+    # Rate limited and failed calls go back on the scheduler's retry queue, only errors left after the retries are
+    # reported. Returns the ids of the emails whose call failed
+    chunks = {}
+
+    def call(body):
+        request = lambda: service.users().messages().batchModify(userId='me', body=body).execute()
+        chunks[request] = body['ids']
+        return request
+
+    calls = [('batchModify', call({'ids': chunk, 'addLabelIds': list(add), 'removeLabelIds': list(remove)}))
+             for (add, remove), email_ids in plan.items() for chunk in chunked(email_ids, BATCH_MODIFY_SIZE)]
+
+    failed_ids = set()
+    for (_, request), e in SCHEDULER.run(calls):
+        print(f"Failed to execute action: {e}")
+        failed_ids.update(chunks[request])
+    return failed_ids
+
+
+def read_stage(db_path, rules, rows, errors):
+    # Streams rows from its own connection, SQLite connections can not be shared across threads
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            for item in load_emails(conn.cursor(), rules):
+                rows.put(item)
+        finally:
+            conn.close()
+    except Exception as e:
+        errors.append(e)
+    finally:
+        rows.put(DONE)
+
+
+def evaluate_stage(rules, now, rows, calls, dispatchers, labels=None, ledger=None, matched=None):
+    # Every rule runs through one index, so an email's actions are complete as soon as it is evaluated and a
+    # batchModify call can go out as soon as a label diff has collected BATCH_MODIFY_SIZE ids.
+    # With a ledger cursor an email whose every matched rule is in the ledger is skipped, the others are collected
+    # in matched for record_ledger
+    rule_index = RuleIndex(rules)
+    plan = {}
+
+    def hits():
+        while (item := rows.get()) is not DONE:
+            email, label_ids = item
+            positions = rule_index.match(email, now)
+            if positions:
+                yield email.id, positions, label_ids
+
+    try:
+        for chunk in chunked(hits(), LEDGER_LOOKUP_SIZE):
+            # The ledger is read once per chunk of matched emails instead of once per email
+            applied = applied_pairs(ledger, [email_id for email_id, _, _ in chunk]) if ledger is not None else set()
+            for email_id, positions, label_ids in chunk:
+                if ledger is not None:
+                    if all((email_id, rules[position].hash) in applied for position in positions):
+                        continue
+                    matched[email_id] = [rules[position] for position in positions]
+                actions = [action for position in positions for action in rules[position].actions]
+                add, remove = merge_actions(actions, set(json.loads(label_ids)) if label_ids is not None else None,
+                                            labels)
+                if not add and not remove:
+                    continue
+                email_ids = plan.setdefault((add, remove), [])
+                email_ids.append(email_id)
+                if len(email_ids) == BATCH_MODIFY_SIZE:
+                    calls.put(((add, remove), plan.pop((add, remove))))
+
+        for diff, email_ids in plan.items():
+            calls.put((diff, email_ids))
+    finally:
+        for _ in range(dispatchers):
+            calls.put(DONE)
+
+
+def dispatch_stage(service, calls, errors, sent_ids, failed_ids):
+    # A dispatcher that fails stops sending but keeps taking calls until DONE, otherwise the evaluator would block on
+    # a full queue. Its error is raised by run_pipeline once every stage has finished. The ids of each call end up in
+    # sent_ids or failed_ids
+    http, failed = None, False
+    while (call := calls.get()) is not DONE:
+        (add, remove), email_ids = call
+        if failed:
+            failed_ids.extend(email_ids)
+            continue
+        try:
+            request = service.users().messages().batchModify(
+                userId='me', body={'ids': email_ids, 'addLabelIds': list(add), 'removeLabelIds': list(remove)})
+            if http is None:
+                # googleapiclient requests are not thread safe over a shared connection, each dispatcher opens its
+                # own with the credentials of the request's transport
+                http = AuthorizedHttp(request.http.credentials, http=httplib2.Http())
+            failures = SCHEDULER.run([('batchModify', lambda: request.execute(http=http))])
+            for _, e in failures:
+                print(f"Failed to execute action: {e}")
+            (failed_ids if failures else sent_ids).extend(email_ids)
+        except Exception as e:
+            errors.append(e)
+            failed_ids.extend(email_ids)
+            failed = True
+
+
+def run_pipeline(db_path, rules, now, service, queue_size=PIPELINE_QUEUE_SIZE, dispatchers=DISPATCHERS, labels=None):
+    # Reader, evaluator and dispatchers run at the same time, so a run takes about as long as its slowest stage
+    # instead of the sum of all of them. The evaluator stays on the calling thread and checks the ledger, so actions
+    # applied by earlier runs are not sent again. Returns the ids of the emails whose actions went through
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        checkpoint = ledger_checkpoint(cur, rules)
+        rows, calls, errors, sent_ids, failed_ids, matched = Queue(queue_size), Queue(queue_size), [], [], [], {}
+        threads = [threading.Thread(target=read_stage, args=(db_path, rules, rows, errors), daemon=True)]
+        threads += [threading.Thread(target=dispatch_stage, args=(service, calls, errors, sent_ids, failed_ids),
+                                    daemon=True)
+                    for _ in range(dispatchers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            evaluate_stage(rules, now, rows, calls, dispatchers, labels, cur, matched)
+        finally:
+            # Drain the reader if evaluation failed, it may be blocked on a full queue
+            while threads[0].is_alive():
+                while not rows.empty():
+                    rows.get()
+                threads[0].join(0.01)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            # Nothing is recorded, the next run evaluates every email again
+            raise errors[0]
+        record_ledger(conn, matched, set(failed_ids), checkpoint, now)
+    finally:
+        conn.close()
+    return set(sent_ids)
+
+
+def apply_rules(pushdown=True, workers=1, pipeline=False, service=None, rules=None):
+    # A long running caller passes its own service and compiled rules. Returns the ids of the emails whose actions
+    # were applied
+    # Rules are validated and compiled once, a broken rules.json fails here before any email is touched
+    if rules is None:
+        with open('rules.json', 'r') as f:
+            rules = compile_rules(json.load(f))
 
     # Reuse authentication from other script with a different scope to allow updates
-    service = authenticate_gmail_api('write_token.json', ['https://www.googleapis.com/auth/gmail.modify'])
+    if service is None:
+        service = authenticate_gmail_api('write_token.json', ['https://www.googleapis.com/auth/gmail.modify'])
+    # move_to actions are resolved to label ids once for the whole run, missing labels are created here
+    labels = LabelRegistry(service).resolve_actions(rules)
     conn = sqlite3.connect('emails.db')
     c = conn.cursor()
+    init_db(c)
+
+    if pipeline:
+        # Streams straight from the DB to the API, pushdown and workers do not apply
+        conn.close()
+        return run_pipeline('emails.db', rules, time.time(), service, labels=labels)
 
-    for row in c.execute('SELECT * FROM emails'):
-        for rule in rules:
-            match_all = rule['conditions']['match'] == 'all'
-            email_id, payload = row
-            email = {
-                'id': email_id,
-                'payload': payload
-            }
+    # Actions of every matching rule are collected per email and dispatched once evaluation is done
+    # All rules are checked against a single snapshot of the current time
+    # The ledger limits both to what earlier runs have not done, an unchanged mailbox costs no API call
+    now = time.time()
+    email_actions, email_labels = {}, {}
+    matches, matched, checkpoint = find_new_matches(c, rules, now, pushdown, workers=workers)
+    for email_id, (actions, label_ids) in matches.items():
+        email_actions[email_id] = actions
+        if label_ids is not None:
+            email_labels[email_id] = set(json.loads(label_ids))
+
+    try:
+        plan = plan_actions(email_actions.items(), email_labels, labels)
+        failed_ids = batch_modify(service, plan)
+        record_ledger(conn, matched, failed_ids, checkpoint, now)
+    finally:
+        conn.close()
 
-            match = match_rule(email, rule['conditions']['rules'], match_all)
-            if match:
-                apply_actions(service, email_id, rule['actions'])
+    return {email_id for email_ids in plan.values() for email_id in email_ids if email_id not in failed_ids}
 
-    conn.close()
 
 if __name__ == "__main__":
-    apply_rules()
+    # --parallel evaluates across every CPU core, worth it once the store holds millions of messages
+    # --pipeline overlaps DB reads, evaluation and API calls
+    apply_rules(workers=os.cpu_count() if '--parallel' in sys.argv else 1, pipeline='--pipeline' in sys.argv)
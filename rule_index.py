@@ -0,0 +1,173 @@
+from collections import deque
+import numpy as np
+from rule_engine import BODY_FIELDS, StringCondition
+
+# Positive predicates and the negated predicate answered from the same lookup
+NEGATED = {'not_contains': 'contains', 'not_equals': 'equals'}
+
+
+class Automaton:
+    # Aho-Corasick automaton, finds every pattern occurring in a text with one pass over the text
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(pattern_id)
+
+        # Breadth first so the fail state of a node is always built before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+        # The empty pattern is contained in every text
+        self.always = list(self.output[0])
+
+    def search(self, text):
+        found = set(self.always)
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class RuleIndex:
+    # Evaluates many compiled rules per email with a cost that follows header length instead of rule count.
+    # Every string condition becomes a key, equals keys live in a hash map per field and all contains literals of a
+    # field share one automaton, so each header is scanned once and reports every condition it satisfies.
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.equals = {}
+        literals = {}
+
+        # Date conditions are keys too, decided for a whole batch of emails with one comparison each
+        self.dates = {}
+
+        # Per rule: the keys that must hit, and the keys of negated conditions which must not
+        self.positive = []
+        self.residual = []
+        self.rules_by_key = {}
+        # Rules reading the body are checked one by one after the index, so they short circuit before the decode
+        self.lazy = {index for index, rule in enumerate(rules)
+                     if any(condition.field in BODY_FIELDS for condition in rule.conditions)}
+        for index, rule in enumerate(rules):
+            positive, residual = [], []
+            for condition in rule.conditions if index not in self.lazy else ():
+                if isinstance(condition, StringCondition):
+                    predicate = NEGATED.get(condition.predicate, condition.predicate)
+                    key = (condition.field, predicate, condition.value)
+                    if predicate == 'equals':
+                        self.equals.setdefault(condition.field, {})[condition.value] = key
+                    else:
+                        literals.setdefault(condition.field, {})[condition.value] = key
+                    if condition.predicate in NEGATED:
+                        residual.append(key)
+                    else:
+                        positive.append(key)
+                else:
+                    key = (condition.field, condition.predicate, condition.value)
+                    self.dates[key] = condition
+                    positive.append(key)
+
+            self.positive.append(set(positive))
+            self.residual.append(residual)
+            for key in set(positive):
+                self.rules_by_key.setdefault(key, []).append(index)
+
+        self.automata = {}
+        for field, keys_by_literal in literals.items():
+            patterns = list(keys_by_literal)
+            self.automata[field] = (Automaton(patterns), [keys_by_literal[pattern] for pattern in patterns])
+
+        # Rules that can match without any positive hit have to be checked for every email
+        self.unanchored = [index for index, rule in enumerate(rules) if index not in self.lazy
+                           and not self.positive[index] and (rule.match_all or self.residual[index])]
+        self.any_with_residual = [index for index, rule in enumerate(rules)
+                                  if not rule.match_all and self.residual[index] and self.positive[index]]
+
+    def hits(self, email, now, date_hits=None):
+        # Every condition key satisfied by the email, found with one lookup or one scan per field. date_hits comes
+        # from date_hits_batch, without it the date conditions are checked for this email alone
+        if date_hits is None:
+            date_hits = [key for key, condition in self.dates.items() if condition.matches(email, now)]
+        found = set(date_hits)
+        for field, values in self.equals.items():
+            key = values.get(email.headers.get(field, ''))
+            if key is not None:
+                found.add(key)
+        for field, (automaton, keys) in self.automata.items():
+            found.update(keys[pattern_id] for pattern_id in automaton.search(email.headers.get(field, '')))
+        return found
+
+    def check_residual(self, index, hits):
+        # Residual keys are the negated conditions, they hold when the positive key did not hit
+        checks = (key not in hits for key in self.residual[index])
+        return all(checks) if self.rules[index].match_all else any(checks)
+
+    def date_hits_batch(self, emails, now):
+        # Date keys satisfied by each email, one NumPy comparison per date condition over the whole batch against the
+        # same now. Missing dates become NaN, which fails every comparison like None does in DateCondition.matches
+        per_email = [[] for _ in emails]
+        if not self.dates or not emails:
+            return per_email
+        received_at = np.array([email.received_at for email in emails], dtype=float)
+        for key, condition in self.dates.items():
+            for position in np.flatnonzero(condition.mask(received_at, now)):
+                per_email[position].append(key)
+        return per_email
+
+    def match_batch(self, emails, now):
+        # Matching rule indexes for each email of the batch
+        return [self.match(email, now, date_hits)
+                for email, date_hits in zip(emails, self.date_hits_batch(emails, now))]
+
+    def match(self, email, now, date_hits=None):
+        # Indexes of the matching rules in rules.json order
+        hits = self.hits(email, now, date_hits)
+        counts = {}
+        for key in hits:
+            for index in self.rules_by_key.get(key, ()):
+                counts[index] = counts.get(index, 0) + 1
+
+        matched = set()
+        for index, count in counts.items():
+            if self.rules[index].match_all:
+                if count == len(self.positive[index]) and self.check_residual(index, hits):
+                    matched.add(index)
+            else:
+                matched.add(index)
+
+        for index in self.unanchored:
+            if self.check_residual(index, hits):
+                matched.add(index)
+        for index in self.any_with_residual:
+            if index not in matched and self.check_residual(index, hits):
+                matched.add(index)
+        for index in self.lazy:
+            if self.rules[index].matches(email, now):
+                matched.add(index)
+
+        return sorted(matched)
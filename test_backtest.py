@@ -0,0 +1,113 @@
+import unittest
+from unittest.mock import patch
+
+import base64
+import json
+import os
+import random
+import sqlite3
+import tempfile
+
+from backtest import backtest, load_labels, load_snapshot
+from gmail_client import save_metadata, store_emails_in_sqlite
+from rule_engine import compile_rules, rule_fields
+from rule_filter_client import find_matches, match_rules, plan_actions
+
+NOW = 1725200000.0
+
+
+def make_rule(conditions, match='all', actions=('mark_as_read',)):
+    return {'conditions': {'match': match, 'rules': conditions}, 'actions': list(actions)}
+
+
+class TestBacktest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, self.db_path)
+
+        random.seed(7)
+        messages = []
+        for i in range(300):
+            headers = [{'name': 'From', 'value': random.choice(['alerts@reddit.com', 'news@vendor.com', 'a@x.com'])},
+                       {'name': 'Subject', 'value': random.choice(['Interview', 'Weekly digest', 'Hello'])}]
+            if i % 3:
+                headers.append({'name': 'Cc', 'value': random.choice(['team', 'boss'])})
+            body = base64.urlsafe_b64encode(random.choice([b'your order', b'refund issued'])).decode()
+            messages.append({'id': f'msg{i}', 'threadId': 't',
+                             'labelIds': random.choice([['INBOX'], ['INBOX', 'UNREAD'], ['STARRED']]),
+                             'internalDate': str(int((NOW - random.randint(0, 60) * 86400) * 1000)),
+                             'payload': {'mimeType': 'text/plain', 'headers': headers,
+                                         'body': {'data': body}}})
+        with patch('gmail_client.DB_PATH', self.db_path):
+            store_emails_in_sqlite(messages)
+
+        self.rules = compile_rules([
+            make_rule([{'field': 'from', 'predicate': 'contains', 'value': 'reddit'},
+                       {'field': 'subject', 'predicate': 'equals', 'value': 'Interview'}], match='any',
+                      actions=['mark_as_unread', 'move_to_starred']),
+            make_rule([{'field': 'received_at', 'predicate': 'is_greater_than', 'value': '1month'},
+                       {'field': 'subject', 'predicate': 'not_contains', 'value': 'digest'}],
+                      actions=['mark_as_read']),
+            make_rule([{'field': 'cc', 'predicate': 'not_equals', 'value': 'team'},
+                       {'field': 'message', 'predicate': 'contains', 'value': 'order'}], actions=['move_to_inbox']),
+            make_rule([], match='any', actions=['mark_as_read']),
+        ])
+
+    def run_backtest(self):
+        return backtest(load_snapshot(self.db_path, rule_fields(self.rules)), self.rules, NOW)
+
+    def test_agrees_with_rule_evaluation(self):
+        report = self.run_backtest()
+
+        conn = sqlite3.connect(self.db_path)
+        matched, _ = match_rules(conn.cursor(), self.rules, NOW, pushdown=False)
+        matches = find_matches(conn.cursor(), self.rules, NOW, pushdown=False)
+        conn.close()
+
+        self.assertEqual(report['emails'], 300)
+        self.assertEqual(report['matched'], len(matched))
+        self.assertEqual(report['hits'], [sum(index in indexes for indexes in matched.values())
+                                          for index in range(len(self.rules))])
+        self.assertEqual(report['hits'][3], 0)
+        self.assertEqual(report['overlaps'][0, 1], sum({0, 1} <= set(indexes) for indexes in matched.values()))
+
+        plan = plan_actions([(email_id, actions) for email_id, (actions, _) in matches.items()],
+                            {email_id: set(json.loads(labels)) for email_id, (_, labels) in matches.items()})
+        self.assertEqual(report['plan'], {diff: len(email_ids) for diff, email_ids in plan.items()})
+
+    def test_custom_labels_resolved_from_cache(self):
+        with patch('gmail_client.DB_PATH', self.db_path):
+            store_emails_in_sqlite([{'id': 'filed', 'labelIds': ['INBOX', 'Label_12'], 'payload': {'headers': [
+                {'name': 'From', 'value': 'billing@shop.com'}]}}])
+            save_metadata('labels', json.dumps({'fetched_at': 0, 'labels': {'Receipts': 'Label_12'}}))
+        rules = compile_rules([make_rule([{'field': 'from', 'predicate': 'contains', 'value': 'billing@'}],
+                                         actions=['move_to_receipts', 'move_to_travel'])])
+        labels = load_labels(self.db_path, rules)
+
+        report = backtest(load_snapshot(self.db_path, rule_fields(rules)), rules, NOW, labels)
+
+        # The stored label id is recognised, only the label the map does not know is still added
+        self.assertEqual(labels, {'move_to_receipts': 'Label_12'})
+        self.assertEqual(report['plan'], {(('TRAVEL',), ()): 1})
+
+    def test_only_needed_columns_loaded(self):
+        snapshot = load_snapshot(self.db_path, {'from', 'received_at'})
+
+        self.assertEqual(set(snapshot.columns), {'from'})
+        self.assertEqual(len(snapshot), 300)
+
+    def test_empty_store(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DELETE FROM emails')
+        conn.commit()
+        conn.close()
+
+        report = self.run_backtest()
+
+        self.assertEqual(report, {'emails': 0, 'matched': 0, 'hits': [0, 0, 0, 0], 'overlaps': {}, 'plan': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,36 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch, MagicMock
-from gmail_client import authenticate_gmail_api, fetch_emails, store_emails_in_sqlite
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch, MagicMock, ANY
+
+import googleapiclient
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+
+from payload_codec import encode_payload
+from quota import QuotaScheduler
+from rule_engine import compile_rules
+
+from gmail_client import (authenticate_gmail_api, fetch_emails, store_emails_in_sqlite, get_messages_batched,
+                          sync_emails, load_history_id, save_history_id, load_metadata, save_metadata, fetch_params,
+                          load_rules, covers, UPSERT_EMAIL)
 
 
 class TestAuthenticateGmailAPI(unittest.TestCase):
 
+    def setUp(self):
+        patcher = patch.dict('gmail_client.SERVICES', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch('gmail_client.os.path.exists')
     @patch('gmail_client.Credentials.from_authorized_user_file')
     @patch('gmail_client.build')
@@ -20,7 +46,7 @@ class TestAuthenticateGmailAPI(unittest.TestCase):
 
     @patch('gmail_client.os.path.exists')
     @patch('gmail_client.Credentials.from_authorized_user_file')
-    @patch('gmail_client.Request')
+    @patch('google.auth.transport.requests.Request')
     @patch('gmail_client.build')
     def test_refresh_token(self, mock_build, mock_request, mock_from_authorized_user_file, mock_exists):
         mock_exists.return_value = True
@@ -38,7 +64,7 @@ class TestAuthenticateGmailAPI(unittest.TestCase):
 
     @patch('gmail_client.os.path.exists')
     @patch('gmail_client.Credentials.from_authorized_user_file')
-    @patch('gmail_client.InstalledAppFlow.from_client_secrets_file')
+    @patch('google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file')
     @patch('gmail_client.build')
     def test_authentication_success(self, mock_build, mock_from_client_secrets_file,
                                                             mock_from_authorized_user_file, mock_exists):
@@ -57,7 +83,7 @@ class TestAuthenticateGmailAPI(unittest.TestCase):
 
     @patch('gmail_client.os.path.exists')
     @patch('gmail_client.Credentials.from_authorized_user_file')
-    @patch('gmail_client.InstalledAppFlow.from_client_secrets_file')
+    @patch('google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file')
     @patch('gmail_client.build')
     def test_authentication_failure(self, mock_build, mock_from_client_secrets_file, mock_from_authorized_user_file,
                                     mock_exists):
@@ -71,7 +97,7 @@ class TestAuthenticateGmailAPI(unittest.TestCase):
 
     @patch('gmail_client.os.path.exists')
     @patch('gmail_client.Credentials.from_authorized_user_file')
-    @patch('gmail_client.InstalledAppFlow.from_client_secrets_file')
+    @patch('google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file')
     @patch('gmail_client.build')
     def test_build_success(self, mock_build, mock_from_client_secrets_file, mock_from_authorized_user_file, mock_exists):
         mock_exists.return_value = True
@@ -81,11 +107,11 @@ class TestAuthenticateGmailAPI(unittest.TestCase):
 
         authenticate_gmail_api('read_token.json',['https://www.googleapis.com/auth/gmail.readonly'])
 
-        mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_creds)
+        mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_creds, static_discovery=True)
 
     @patch('gmail_client.os.path.exists')
     @patch('gmail_client.Credentials.from_authorized_user_file')
-    @patch('gmail_client.InstalledAppFlow.from_client_secrets_file')
+    @patch('google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file')
     @patch('gmail_client.build')
     def test_build_failure(self, mock_build, mock_from_client_secrets_file, mock_from_authorized_user_file,
                            mock_exists):
@@ -99,6 +125,43 @@ class TestAuthenticateGmailAPI(unittest.TestCase):
 
         self.assertIsNone(service)
 
+    @patch('gmail_client.os.path.exists')
+    @patch('gmail_client.Credentials.from_authorized_user_file')
+    @patch('gmail_client.build')
+    def test_service_reused_per_scope(self, mock_build, mock_from_authorized_user_file, mock_exists):
+        mock_exists.return_value = True
+        mock_from_authorized_user_file.return_value = MagicMock(valid=True)
+        mock_build.side_effect = lambda *args, **kwargs: MagicMock()
+
+        read = authenticate_gmail_api('read_token.json', ['https://www.googleapis.com/auth/gmail.readonly'])
+        again = authenticate_gmail_api('read_token.json', ['https://www.googleapis.com/auth/gmail.readonly'])
+        write = authenticate_gmail_api('write_token.json', ['https://www.googleapis.com/auth/gmail.modify'])
+
+        self.assertIs(read, again)
+        self.assertIsNot(read, write)
+        self.assertEqual(mock_build.call_count, 2)
+        self.assertEqual(mock_from_authorized_user_file.call_count, 2)
+
+    @patch('gmail_client.os.path.exists')
+    @patch('gmail_client.Credentials.from_authorized_user_file')
+    @patch('gmail_client.build')
+    def test_failed_build_not_cached(self, mock_build, mock_from_authorized_user_file, mock_exists):
+        mock_exists.return_value = True
+        mock_from_authorized_user_file.return_value = MagicMock(valid=True)
+        mock_build.side_effect = [Exception("Error building service"), MagicMock()]
+
+        self.assertIsNone(authenticate_gmail_api('read_token.json', ['https://www.googleapis.com/auth/gmail.readonly']))
+        self.assertIsNotNone(authenticate_gmail_api('read_token.json',
+                                                    ['https://www.googleapis.com/auth/gmail.readonly']))
+
+    def test_oauth_flow_not_imported_at_startup(self):
+        # A fresh interpreter importing the entry points must not pay for the interactive consent modules
+        code = ("import sys, rule_filter_client, watch_daemon; "
+                "print('google_auth_oauthlib' in sys.modules, 'google.auth.transport.requests' in sys.modules)")
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stdout.split(), ['False', 'False'])
+
 
 class TestFetchEmails(unittest.TestCase):
 
@@ -106,8 +169,9 @@ class TestFetchEmails(unittest.TestCase):
     def test_authenticate_gmail_api_called(self, mock_authenticate_gmail_api):
         mock_service = MagicMock()
         mock_authenticate_gmail_api.return_value = mock_service
+        mock_service.users().messages().list.return_value.execute.return_value = {'messages': []}
 
-        fetch_emails()
+        list(fetch_emails())
 
         mock_authenticate_gmail_api.assert_called_once_with('read_token.json', ['https://www.googleapis.com/auth/gmail.readonly'])
 
@@ -125,9 +189,10 @@ class TestFetchEmails(unittest.TestCase):
 
         mock_get.execute.side_effect = lambda: {'id': 'msg1', 'payload': {}}
 
-        fetch_emails()
+        list(fetch_emails())
 
-        mock_service.users().messages().list.assert_called_once_with(userId='me', maxResults=10, q='')
+        mock_service.users().messages().list.assert_called_once_with(userId='me', maxResults=500, q='',
+                                                                     pageToken=None)
         mock_service.users().messages().get.assert_any_call(userId='me', id='msg1')
         mock_service.users().messages().get.assert_any_call(userId='me', id='msg2')
 
@@ -139,7 +204,8 @@ class TestFetchEmails(unittest.TestCase):
         mock_list = mock_service.users().messages().list.return_value
         mock_list.execute.side_effect = Exception("Error fetching messages")
 
-        fetch_emails()
+        with self.assertRaises(Exception):
+            list(fetch_emails())
 
         mock_print.assert_called_with("Failed to fetch email: Error fetching messages")
 
@@ -155,9 +221,222 @@ class TestFetchEmails(unittest.TestCase):
 
         mock_get.execute.side_effect = Exception("Error fetching message data")
 
-        fetch_emails()
+        list(fetch_emails())
+
+        mock_print.assert_any_call("Failed to fetch email msg1: Error fetching message data")
+        mock_print.assert_called_with("Skipped 1 email(s) that failed to fetch: msg1")
+
+    @patch('gmail_client.authenticate_gmail_api')
+    @patch('builtins.print')
+    def test_mid_stream_get_failure_keeps_paginating(self, mock_print, mock_authenticate_gmail_api):
+        mock_service = MagicMock()
+        mock_authenticate_gmail_api.return_value = mock_service
+        mock_list = mock_service.users().messages().list
+        mock_get = mock_service.users().messages().get
+
+        mock_list.return_value.execute.side_effect = [
+            {'messages': [{'id': 'msg1'}, {'id': 'msg2'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': 'msg3'}]}
+        ]
+
+        def get(userId, id):
+            if id == 'msg2':
+                return MagicMock(execute=MagicMock(side_effect=Exception("Backend Error")))
+            return MagicMock(execute=MagicMock(return_value={'id': id}))
+        mock_get.side_effect = get
+
+        emails = [email['id'] for email in fetch_emails()]
+
+        self.assertEqual(emails, ['msg1', 'msg3'])
+        mock_print.assert_called_with("Skipped 1 email(s) that failed to fetch: msg2")
+
+    @patch('gmail_client.authenticate_gmail_api')
+    @patch('builtins.print')
+    def test_mid_stream_list_failure_raises(self, mock_print, mock_authenticate_gmail_api):
+        mock_service = MagicMock()
+        mock_authenticate_gmail_api.return_value = mock_service
+        mock_service.users().messages().list.return_value.execute.side_effect = [
+            {'messages': [{'id': 'msg1'}], 'nextPageToken': 'page2'},
+            Exception("Quota exceeded")
+        ]
+        mock_service.users().messages().get.return_value.execute.return_value = {'id': 'msg1'}
+
+        emails = fetch_emails()
+        self.assertEqual(next(emails)['id'], 'msg1')
+        with self.assertRaises(Exception):
+            next(emails)
+
+        mock_print.assert_called_with("Failed to fetch email: Quota exceeded")
 
-        mock_print.assert_called_with("Failed to fetch email: Error fetching message data")
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_follows_next_page_token(self, mock_authenticate_gmail_api):
+        mock_service = MagicMock()
+        mock_authenticate_gmail_api.return_value = mock_service
+        mock_list = mock_service.users().messages().list
+        mock_get = mock_service.users().messages().get
+
+        mock_list.return_value.execute.side_effect = [
+            {'messages': [{'id': 'msg1'}, {'id': 'msg2'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': 'msg3'}]}
+        ]
+        mock_get.side_effect = lambda userId, id: MagicMock(execute=MagicMock(return_value={'id': id}))
+
+        emails = [email['id'] for email in fetch_emails()]
+
+        self.assertEqual(emails, ['msg1', 'msg2', 'msg3'])
+        mock_list.assert_any_call(userId='me', maxResults=500, q='', pageToken=None)
+        mock_list.assert_any_call(userId='me', maxResults=500, q='', pageToken='page2')
+
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_fetch_is_lazy(self, mock_authenticate_gmail_api):
+        mock_service = MagicMock()
+        mock_authenticate_gmail_api.return_value = mock_service
+        mock_service.users().messages().list.return_value.execute.return_value = {
+            'messages': [{'id': 'msg1'}, {'id': 'msg2'}]
+        }
+        mock_get = mock_service.users().messages().get
+        mock_get.reset_mock()
+
+        emails = fetch_emails()
+        next(emails)
+
+        self.assertEqual(mock_get.call_count, 1)
+
+
+def unthrottled():
+    # Quota and backoff waits are real in production, the tests do not need to wait for them
+    scheduler = QuotaScheduler(rate=1e9)
+    scheduler.sleep = lambda seconds: None
+    return scheduler
+
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    # Answers Gmail style multipart batch requests, failing the ids in server.flaky once
+
+    def do_POST(self):
+        self.server.round_trips += 1
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = BytesParser().parsebytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+
+        boundary = 'batch_boundary'
+        parts = []
+        for part in message.get_payload():
+            request_line = part.get_payload().splitlines()[0]
+            message_id = request_line.split()[1].split('?')[0].rsplit('/', 1)[-1]
+            if message_id in self.server.flaky:
+                self.server.flaky.discard(message_id)
+                status, content = '503 Service Unavailable', {'error': {'code': 503, 'message': 'Backend Error'}}
+            else:
+                status, content = '200 OK', {'id': message_id, 'payload': {}}
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\n"
+                         f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                         f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{json.dumps(content)}\r\n")
+
+        response = (''.join(parts) + f"--{boundary}--").encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBatchedFetch(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('gmail_client.SCHEDULER', unthrottled())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = HTTPServer(('127.0.0.1', 0), FakeBatchHandler)
+        self.server.round_trips = 0
+        self.server.flaky = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        # Static discovery document shipped with the client, pointed at the local fake endpoint
+        documents = os.path.join(os.path.dirname(googleapiclient.__file__), 'discovery_cache', 'documents')
+        with open(os.path.join(documents, 'gmail.v1.json')) as f:
+            document = json.load(f)
+        document['rootUrl'] = f'http://127.0.0.1:{self.server.server_port}/'
+        self.service = build_from_document(document, http=httplib2.Http())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_round_trips_scale_with_batches(self):
+        for mailbox_size in (10, 250, 1000):
+            self.server.round_trips = 0
+            message_ids = [f'msg{i}' for i in range(mailbox_size)]
+
+            emails = list(get_messages_batched(self.service, message_ids, []))
+
+            self.assertEqual([email['id'] for email in emails], message_ids)
+            # One multipart request per 100 messages instead of one per message
+            self.assertEqual(self.server.round_trips, -(-mailbox_size // 100))
+
+    def test_only_failed_sub_requests_retried(self):
+        self.server.flaky = {'msg3', 'msg7'}
+        failed_ids = []
+
+        emails = list(get_messages_batched(self.service, [f'msg{i}' for i in range(10)], failed_ids))
+
+        self.assertEqual(len(emails), 10)
+        self.assertEqual(failed_ids, [])
+        self.assertEqual(self.server.round_trips, 2)
+        self.assertEqual([email['id'] for email in emails[-2:]], ['msg3', 'msg7'])
+
+    @staticmethod
+    def failing_service(error, errors=None):
+        # Every sub request fails with error, or with its entry in errors when given
+        service = MagicMock()
+
+        def new_batch_http_request(callback):
+            batch, request_ids = MagicMock(), []
+            batch.add.side_effect = lambda request, request_id: request_ids.append(request_id)
+            batch.execute.side_effect = lambda: [callback(request_id, None, (errors or {}).get(request_id, error))
+                                                 for request_id in request_ids]
+            return batch
+        service.new_batch_http_request.side_effect = new_batch_http_request
+        return service
+
+    @patch('builtins.print')
+    def test_exhausted_retries_reported(self, mock_print):
+        error = HttpError(MagicMock(status=503), b'Backend Error')
+        service = self.failing_service(error)
+        failed_ids = []
+
+        emails = list(get_messages_batched(service, ['msg1'], failed_ids, retries=2))
+
+        self.assertEqual(emails, [])
+        self.assertEqual(failed_ids, ['msg1'])
+        self.assertEqual(service.new_batch_http_request.call_count, 2)
+        mock_print.assert_called_with(f"Failed to fetch email msg1: {error}")
+
+    @patch('builtins.print')
+    def test_permanent_error_not_retried(self, mock_print):
+        service = self.failing_service(HttpError(MagicMock(status=404), b'Not Found'))
+        failed_ids = []
+
+        list(get_messages_batched(service, ['msg1'], failed_ids, retries=3))
+
+        self.assertEqual(failed_ids, ['msg1'])
+        self.assertEqual(service.new_batch_http_request.call_count, 1)
+
+    @patch('builtins.print')
+    def test_permanent_errors_not_retried_with_retryable_ones(self, mock_print):
+        service = self.failing_service(HttpError(MagicMock(status=503), b'Backend Error'),
+                                       {'msg1': HttpError(MagicMock(status=404), b'Not Found')})
+        failed_ids = []
+
+        list(get_messages_batched(service, ['msg1', 'msg2'], failed_ids, retries=3))
+
+        self.assertEqual(failed_ids, ['msg1', 'msg2'])
+        self.assertEqual(service.new_batch_http_request.call_count, 3)
+        retried = [call.kwargs['id'] for call in service.users().messages().get.call_args_list]
+        self.assertEqual(retried.count('msg1'), 1)
+        self.assertEqual(retried.count('msg2'), 3)
 
 
 class TestStoreEmailsInSQLite(unittest.TestCase):
@@ -176,16 +455,26 @@ class TestStoreEmailsInSQLite(unittest.TestCase):
 
         store_emails_in_sqlite(emails)
 
-        mock_connect.assert_called_once_with('emails.db')
+        mock_connect.assert_called_once_with('emails.db', timeout=30)
+        mock_conn.execute.assert_any_call('PRAGMA journal_mode=WAL')
 
         mock_cursor.execute.assert_any_call('CREATE TABLE IF NOT EXISTS emails (id TEXT PRIMARY KEY, payload TEXT)')
 
-        mock_cursor.execute.assert_any_call("INSERT OR REPLACE INTO emails (id, payload) VALUES (?, ?)",
-                                            ('msg1', '{"headers": [{"name": "Subject", "value": "Test Subject"}]}'))
-        mock_cursor.execute.assert_any_call("INSERT OR REPLACE INTO emails (id, payload) VALUES (?, ?)",
-                                            ('msg2', '{"headers": [{"name": "Subject", "value": "Another Test"}]}'))
-
-        mock_conn.commit.assert_called_once()
+        # One executemany per chunk instead of one execute per row
+        mock_cursor.executemany.assert_called_once()
+        insert, rows = mock_cursor.executemany.call_args[0]
+        self.assertEqual(insert, UPSERT_EMAIL)
+        self.assertEqual(list(rows), [
+            ('msg1', encode_payload(emails[0]['payload']), None, None, None, None,
+             'Test Subject', None, ANY),
+            ('msg2', encode_payload(emails[1]['payload']), None, None, None, None,
+             'Another Test', None, ANY),
+        ])
+
+        # The chunk, then the store marked done
+        self.assertEqual(mock_conn.commit.call_count, 2)
+        mock_cursor.execute.assert_called_with(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES ('store_sequence_done', ?)", ANY)
 
         mock_conn.close.assert_called_once()
 
@@ -206,6 +495,324 @@ class TestStoreEmailsInSQLite(unittest.TestCase):
 
             mock_print.assert_called_with("An error occurred while updating the DB: SQL Error")
 
+    @patch('sqlite3.connect')
+    def test_commits_in_chunks(self, mock_connect):
+        mock_conn = MagicMock()
+        mock_connect.return_value = mock_conn
+
+        emails = ({'id': f'msg{i}', 'payload': {}} for i in range(5))
+
+        store_emails_in_sqlite(emails, chunk_size=2)
+
+        # One per chunk and one marking the store done
+        self.assertEqual(mock_conn.commit.call_count, 4)
+
+    def test_long_lived_connection_reused(self):
+        conn = sqlite3.connect(':memory:')
+
+        store_emails_in_sqlite([{'id': 'msg1'}], conn=conn)
+        store_emails_in_sqlite([{'id': 'msg2'}], conn=conn)
+
+        # The caller keeps ownership, the connection is still open after both batches
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0], 2)
+        conn.close()
+
+    def test_database_switched_to_wal(self):
+        handle, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, db_path)
+
+        with patch('gmail_client.DB_PATH', db_path):
+            store_emails_in_sqlite([{'id': 'msg1'}])
+
+        # WAL is stored in the file, readers such as apply_rules get it without setting any pragma
+        reader = sqlite3.connect(db_path)
+        self.assertEqual(reader.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        reader.close()
+
+    def test_columns_stored_and_old_schema_migrated(self):
+        handle, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, db_path)
+        conn = sqlite3.connect(db_path)
+        conn.execute('CREATE TABLE emails (id TEXT PRIMARY KEY, payload TEXT)')
+        old_payload = {'headers': [{'name': 'From', 'value': 'alerts@reddit.com'},
+                                   {'name': 'Date', 'value': 'Sat, 31 Aug 2024 15:44:49 +0000'}]}
+        conn.execute("INSERT INTO emails (id, payload) VALUES ('old', ?)", (json.dumps(old_payload),))
+        conn.commit()
+        conn.close()
+
+        with patch('gmail_client.DB_PATH', db_path):
+            store_emails_in_sqlite([{'id': 'msg1', 'threadId': 'thread1', 'labelIds': ['INBOX', 'UNREAD'],
+                                     'payload': {'headers': [{'name': 'Subject', 'value': 'Hello'}]}}])
+
+        conn = sqlite3.connect(db_path)
+        rows = {row[0]: row[1:] for row in conn.execute(
+            'SELECT id, label_ids, thread_id, from_addr, subject, received_at FROM emails')}
+        indexes = {row[1] for row in conn.execute('PRAGMA index_list(emails)')}
+        conn.close()
+
+        # The old row is backfilled from its payload, the new one is split at ingest
+        self.assertEqual(rows, {
+            'old': (None, None, 'alerts@reddit.com', None, 1725119089.0),
+            'msg1': ('["INBOX", "UNREAD"]', 'thread1', None, 'Hello', None),
+        })
+        self.assertTrue({'idx_emails_from_addr', 'idx_emails_received_at'} <= indexes)
+
+    def test_every_call_gets_a_new_sequence(self):
+        conn = sqlite3.connect(':memory:')
+
+        store_emails_in_sqlite([{'id': 'msg1'}, {'id': 'msg2'}], conn=conn)
+        store_emails_in_sqlite([{'id': 'msg2'}], conn=conn)
+
+        # A re-fetched message moves to the latest sequence, so rule runs see it as changed
+        self.assertEqual(dict(conn.execute('SELECT id, sequence FROM emails')), {'msg1': 1, 'msg2': 2})
+        conn.close()
+
+    def test_internal_date_preferred_over_date_header(self):
+        conn = sqlite3.connect(':memory:')
+        payload = {'headers': [{'name': 'Date', 'value': 'Sat, 31 Aug 2024 08:44:49 -0700'}]}
+
+        store_emails_in_sqlite([{'id': 'msg1', 'internalDate': '1725119089123', 'payload': payload},
+                                {'id': 'msg2', 'payload': payload}], conn=conn)
+
+        # Both are the same UTC instant, the header offset is applied instead of dropped
+        rows = dict(conn.execute('SELECT id, received_at FROM emails'))
+        conn.close()
+        self.assertEqual(rows, {'msg1': 1725119089.123, 'msg2': 1725119089.0})
+
+    @patch('builtins.print')
+    @patch('sqlite3.connect')
+    def test_connection_closed_on_mid_stream_error(self, mock_connect, mock_print):
+        mock_conn = MagicMock()
+        mock_connect.return_value = mock_conn
+
+        def emails():
+            yield {'id': 'msg1', 'payload': {}}
+            raise Exception("Stream broke")
+
+        store_emails_in_sqlite(emails(), chunk_size=1)
+
+        mock_conn.close.assert_called_once()
+        mock_print.assert_called_with("An error occurred while updating the DB: Stream broke")
+
+
+def fake_batch_service(messages, failing=()):
+    # MagicMock service whose batch requests answer from the messages dict
+    service = MagicMock()
+    service.users().messages().get.side_effect = lambda userId, id, **params: id
+
+    def new_batch_http_request(callback):
+        batch, request_ids = MagicMock(), []
+        batch.add.side_effect = lambda request, request_id: request_ids.append(request_id)
+        batch.execute.side_effect = lambda: [
+            callback(request_id, None, Exception("Not Found")) if request_id in failing
+            else callback(request_id, messages[request_id], None) for request_id in request_ids]
+        return batch
+    service.new_batch_http_request.side_effect = new_batch_http_request
+    return service
+
+
+class TestSyncEmails(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        patcher = patch('gmail_client.SCHEDULER', unthrottled())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('gmail_client.DB_PATH', self.db_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(os.remove, self.db_path)
+
+    def save_checkpoint(self, history_id, query=''):
+        save_history_id(history_id)
+        save_metadata('fetch_params', json.dumps(fetch_params(load_rules())))
+        save_metadata('sync_query', query)
+
+    def stored_ids(self):
+        conn = sqlite3.connect(self.db_path)
+        ids = sorted(row[0] for row in conn.execute('SELECT id FROM emails'))
+        conn.close()
+        return ids
+
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_first_run_full_sync_saves_checkpoint(self, mock_authenticate_gmail_api):
+        service = fake_batch_service({'msg1': {'id': 'msg1'}, 'msg2': {'id': 'msg2'}})
+        service.users().getProfile.return_value.execute.return_value = {'historyId': '100'}
+        service.users().messages().list.return_value.execute.return_value = {
+            'messages': [{'id': 'msg1'}, {'id': 'msg2'}]
+        }
+        mock_authenticate_gmail_api.return_value = service
+
+        sync_emails()
+
+        self.assertEqual(self.stored_ids(), ['msg1', 'msg2'])
+        self.assertEqual(load_history_id(), '100')
+        service.users().history().list.assert_not_called()
+
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_incremental_sync_only_fetches_changes(self, mock_authenticate_gmail_api):
+        store_emails_in_sqlite([{'id': 'msg1'}, {'id': 'msg3'}])
+        self.save_checkpoint('100')
+        service = fake_batch_service({'msg1': {'id': 'msg1'}, 'msg2': {'id': 'msg2'}})
+        service.users().history().list.return_value.execute.side_effect = [
+            {'history': [{'messagesAdded': [{'message': {'id': 'msg2'}}]},
+                         {'labelsAdded': [{'message': {'id': 'msg1'}}]}],
+             'nextPageToken': 'page2', 'historyId': '110'},
+            {'history': [{'messagesDeleted': [{'message': {'id': 'msg3'}}]}], 'historyId': '120'}
+        ]
+        mock_authenticate_gmail_api.return_value = service
+
+        sync_emails()
+
+        self.assertEqual(self.stored_ids(), ['msg1', 'msg2'])
+        self.assertEqual(load_history_id(), '120')
+        service.users().messages().list.assert_not_called()
+        self.assertEqual(service.new_batch_http_request.call_count, 1)
+
+    @patch('gmail_client.gmail_query')
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_prefilter_lists_only_candidates(self, mock_authenticate_gmail_api, mock_gmail_query):
+        service = fake_batch_service({'msg1': {'id': 'msg1'}})
+        service.users().getProfile.return_value.execute.return_value = {'historyId': '100'}
+        service.users().messages().list.return_value.execute.return_value = {'messages': [{'id': 'msg1'}]}
+        mock_authenticate_gmail_api.return_value = service
+        mock_gmail_query.return_value = '{from:"Reddit" newer_than:5d}'
+
+        sync_emails(prefilter=True)
+
+        service.users().messages().list.assert_called_with(userId='me', maxResults=500,
+                                                           q='{from:"Reddit" newer_than:5d}', pageToken=None)
+        self.assertEqual(self.stored_ids(), ['msg1'])
+        self.assertEqual(load_metadata('sync_query'), '{from:"Reddit" newer_than:5d}')
+
+    @patch('builtins.print')
+    @patch('gmail_client.gmail_query')
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_changed_query_forces_full_sync(self, mock_authenticate_gmail_api, mock_gmail_query, mock_print):
+        self.save_checkpoint('100', query='(from:"Reddit")')
+        service = fake_batch_service({'msg1': {'id': 'msg1'}})
+        service.users().getProfile.return_value.execute.return_value = {'historyId': '200'}
+        service.users().messages().list.return_value.execute.return_value = {'messages': [{'id': 'msg1'}]}
+        mock_authenticate_gmail_api.return_value = service
+        mock_gmail_query.return_value = '{(from:"Reddit") (subject:"Interview")}'
+
+        sync_emails(prefilter=True)
+
+        mock_print.assert_any_call("Rules changed the sync query, running a full sync")
+        service.users().history().list.assert_not_called()
+        self.assertEqual(load_metadata('sync_query'), '{(from:"Reddit") (subject:"Interview")}')
+
+    @patch('gmail_client.gmail_query')
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_whole_mailbox_covers_any_query(self, mock_authenticate_gmail_api, mock_gmail_query):
+        self.save_checkpoint('100')
+        service = fake_batch_service({})
+        service.users().history().list.return_value.execute.return_value = {'historyId': '110'}
+        mock_authenticate_gmail_api.return_value = service
+        mock_gmail_query.return_value = '(from:"Reddit")'
+
+        sync_emails(prefilter=True)
+
+        service.users().messages().list.assert_not_called()
+        self.assertEqual(load_history_id(), '110')
+        self.assertEqual(load_metadata('sync_query'), '')
+
+    @patch('builtins.print')
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_expired_checkpoint_falls_back_to_full_sync(self, mock_authenticate_gmail_api, mock_print):
+        self.save_checkpoint('1')
+        service = fake_batch_service({'msg1': {'id': 'msg1'}})
+        service.users().history().list.return_value.execute.side_effect = HttpError(
+            MagicMock(status=404), b'Requested entity was not found.')
+        service.users().getProfile.return_value.execute.return_value = {'historyId': '200'}
+        service.users().messages().list.return_value.execute.return_value = {'messages': [{'id': 'msg1'}]}
+        mock_authenticate_gmail_api.return_value = service
+
+        sync_emails()
+
+        mock_print.assert_any_call("History checkpoint expired, falling back to a full sync")
+        self.assertEqual(self.stored_ids(), ['msg1'])
+        self.assertEqual(load_history_id(), '200')
+
+    @patch('builtins.print')
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_skipped_messages_keep_checkpoint(self, mock_authenticate_gmail_api, mock_print):
+        self.save_checkpoint('100')
+        service = fake_batch_service({}, failing={'msg1'})
+        service.users().history().list.return_value.execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': 'msg1'}}]}], 'historyId': '110'
+        }
+        mock_authenticate_gmail_api.return_value = service
+
+        sync_emails()
+
+        self.assertEqual(load_history_id(), '100')
+
+
+    @patch('builtins.print')
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_sync_requests_metadata_and_reports_bytes(self, mock_authenticate_gmail_api, mock_print):
+        message = {'id': 'msg1', 'payload': {'headers': [{'name': 'Subject', 'value': 'Hi'}]}}
+        service = fake_batch_service({'msg1': message})
+        service.users().getProfile.return_value.execute.return_value = {'historyId': '100'}
+        service.users().messages().list.return_value.execute.return_value = {'messages': [{'id': 'msg1'}]}
+        mock_authenticate_gmail_api.return_value = service
+
+        sync_emails()
+
+        service.users().messages().get.assert_called_with(userId='me', id='msg1', format='metadata',
+                                                          metadataHeaders=['From', 'To', 'Subject', 'Date'])
+        mock_print.assert_any_call(f"Fetched 1 email(s) with format=metadata, {len(json.dumps(message))} bytes "
+                                   f"transferred, {len(encode_payload(message['payload']))} bytes stored")
+        self.assertEqual(json.loads(load_metadata('fetch_params'))['format'], 'metadata')
+
+    @patch('builtins.print')
+    @patch('gmail_client.authenticate_gmail_api')
+    def test_new_headers_force_full_sync(self, mock_authenticate_gmail_api, mock_print):
+        save_history_id('100')
+        save_metadata('fetch_params', json.dumps({'format': 'metadata', 'metadataHeaders': ['From']}))
+        service = fake_batch_service({'msg1': {'id': 'msg1'}})
+        service.users().getProfile.return_value.execute.return_value = {'historyId': '200'}
+        service.users().messages().list.return_value.execute.return_value = {'messages': [{'id': 'msg1'}]}
+        mock_authenticate_gmail_api.return_value = service
+
+        sync_emails()
+
+        mock_print.assert_any_call("Rules need headers that were not fetched before, running a full sync")
+        service.users().history().list.assert_not_called()
+        self.assertEqual(load_history_id(), '200')
+
+class TestFetchParams(unittest.TestCase):
+
+    def test_metadata_for_header_rules(self):
+        self.assertEqual(fetch_params(load_rules()),
+                         {'format': 'metadata', 'metadataHeaders': ['From', 'To', 'Subject', 'Date']})
+
+    def test_extra_headers_requested(self):
+        rules = compile_rules([{'conditions': {'match': 'all', 'rules': [
+            {'field': 'cc', 'predicate': 'contains', 'value': 'team'},
+            {'field': 'list-id', 'predicate': 'contains', 'value': 'news'}]}, 'actions': []}])
+
+        self.assertEqual(fetch_params(rules)['metadataHeaders'], ['From', 'To', 'Subject', 'Date', 'Cc', 'List-Id'])
+
+    @patch('gmail_client.rule_fields')
+    def test_body_rules_need_full(self, mock_rule_fields):
+        mock_rule_fields.return_value = {'subject', 'message'}
+
+        self.assertEqual(fetch_params([]), {'format': 'full'})
+
+    def test_covers(self):
+        narrow = {'format': 'metadata', 'metadataHeaders': ['From', 'Date']}
+        wide = {'format': 'metadata', 'metadataHeaders': ['From', 'Date', 'Cc']}
+
+        self.assertTrue(covers(wide, narrow))
+        self.assertFalse(covers(narrow, wide))
+        self.assertTrue(covers({'format': 'full'}, wide))
+        self.assertFalse(covers(wide, {'format': 'full'}))
+        self.assertFalse(covers(None, narrow))
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,7 @@ from unittest.mock import patch, MagicMock
 import sqlite3
 import json
 from gmail_client import fetch_emails, store_emails_in_sqlite
+from payload_codec import decode_payload
 from rule_filter_client import apply_rules
 
 
@@ -36,7 +37,7 @@ class TestEmailFetchingAndStoring(unittest.TestCase):
         self.assertIsNotNone(result)
         self.assertEqual(result[0], 'test_email_id')
 
-        payload = json.loads(result[1])
+        payload = decode_payload(result[1])
         self.assertEqual(payload['headers'][0]['value'], 'Test Email')
 
         conn.close()
@@ -44,7 +45,7 @@ class TestEmailFetchingAndStoring(unittest.TestCase):
 class TestApplyingRulesAndCallingGmailAPI(unittest.TestCase):
 
     @patch('rule_filter_client.authenticate_gmail_api')
-    @patch('rule_filter_client.apply_actions')
+    @patch('rule_filter_client.batch_modify')
     @patch('rule_filter_client.open', new_callable=unittest.mock.mock_open, read_data=json.dumps([
         {
             "conditions": {
@@ -56,7 +57,7 @@ class TestApplyingRulesAndCallingGmailAPI(unittest.TestCase):
             "actions": ["mark_as_read"]
         }
     ]))
-    def test_apply_rules(self, mock_open, mock_apply_actions, mock_authenticate_gmail_api):
+    def test_apply_rules(self, mock_open, mock_batch_modify, mock_authenticate_gmail_api):
         mock_service = MagicMock()
         mock_authenticate_gmail_api.return_value = mock_service
 
@@ -73,7 +74,7 @@ class TestApplyingRulesAndCallingGmailAPI(unittest.TestCase):
         with patch('rule_filter_client.sqlite3.connect', return_value=conn):
             apply_rules()
 
-        mock_apply_actions.assert_called_once_with(mock_service, 'test_email_id', ['mark_as_read'])
+        mock_batch_modify.assert_called_once_with(mock_service, {((), ('UNREAD',)): ['test_email_id']})
 
         conn.close()
 
@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+import os
+import tempfile
+
+from label_registry import LabelRegistry
+from rule_engine import compile_rules
+from test_gmail_client import unthrottled
+
+
+def make_service(labels, created_id='Label_new'):
+    service = MagicMock()
+    service.users().labels().list.return_value.execute.return_value = {
+        'labels': [{'name': name, 'id': label_id} for name, label_id in labels.items()]}
+    service.users().labels().create.return_value.execute.return_value = {'id': created_id}
+    return service
+
+
+class TestLabelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, self.db_path)
+        for patcher in (patch('gmail_client.DB_PATH', self.db_path),
+                        patch('label_registry.SCHEDULER', unthrottled())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_system_labels_need_no_lookup(self):
+        service = make_service({})
+        registry = LabelRegistry(service)
+
+        self.assertEqual(registry.resolve('starred'), 'STARRED')
+        self.assertEqual(registry.resolve('category_promotions'), 'CATEGORY_PROMOTIONS')
+        service.users().labels().list.assert_not_called()
+
+    def test_names_with_underscores(self):
+        registry = LabelRegistry(make_service({'Receipts_2024': 'Label_1', 'Work/Team_A': 'Label_2'}))
+        rules = compile_rules([{'conditions': {'match': 'any', 'rules': []},
+                                'actions': ['move_to_Receipts_2024', 'move_to_work/team_a', 'move_to_inbox',
+                                            'mark_as_read']}])
+
+        self.assertEqual(registry.resolve_actions(rules), {'move_to_Receipts_2024': 'Label_1',
+                                                           'move_to_work/team_a': 'Label_2',
+                                                           'move_to_inbox': 'INBOX'})
+
+    def test_cached_across_runs(self):
+        service = make_service({'Receipts': 'Label_1'})
+
+        self.assertEqual(LabelRegistry(service).resolve('Receipts'), 'Label_1')
+        self.assertEqual(LabelRegistry(service).resolve('Receipts'), 'Label_1')
+        self.assertEqual(service.users().labels().list.return_value.execute.call_count, 1)
+
+    def test_expired_cache_listed_again(self):
+        service = make_service({'Receipts': 'Label_1'})
+        LabelRegistry(service).resolve('Receipts')
+
+        with patch('label_registry.time.time', return_value=4e9):
+            LabelRegistry(service).resolve('Receipts')
+        self.assertEqual(service.users().labels().list.return_value.execute.call_count, 2)
+
+    def test_missing_label_created_once(self):
+        service = make_service({}, created_id='Label_9')
+
+        self.assertEqual(LabelRegistry(service).resolve('Newsletters'), 'Label_9')
+        self.assertEqual(LabelRegistry(service).resolve('Newsletters'), 'Label_9')
+        service.users().labels().create.assert_called_once_with(
+            userId='me', body={'name': 'Newsletters', 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'})
+
+    def test_stale_cache_checked_before_create(self):
+        service = make_service({})
+        LabelRegistry(service).resolve('Receipts')
+        # Made in the Gmail UI after the map was cached
+        service.users().labels().list.return_value.execute.return_value = {
+            'labels': [{'name': 'Receipts', 'id': 'Label_new'}, {'name': 'Travel', 'id': 'Label_7'}]}
+
+        self.assertEqual(LabelRegistry(service).resolve('Travel'), 'Label_7')
+        self.assertEqual(service.users().labels().create.return_value.execute.call_count, 1)
+
+    def test_no_create(self):
+        registry = LabelRegistry(make_service({}))
+
+        self.assertIsNone(registry.resolve('Travel', create=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+from unittest.mock import MagicMock
+
+import requests
+from googleapiclient.errors import HttpError
+
+from quota import QuotaScheduler, is_retryable
+
+
+def http_error(status, content=b''):
+    return HttpError(MagicMock(status=status), content)
+
+
+def make_scheduler(**kwargs):
+    scheduler = QuotaScheduler(**kwargs)
+    scheduler.waits = []
+    scheduler.sleep = scheduler.waits.append
+    return scheduler
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_waits_once_units_run_out(self):
+        scheduler = make_scheduler(rate=10)
+
+        scheduler.acquire('get')
+        scheduler.acquire('get')
+        self.assertEqual(scheduler.waits, [])
+
+        # The bucket is in debt by 5 units, half a second at 10 units a second
+        scheduler.acquire('get')
+        self.assertAlmostEqual(scheduler.waits[0], 0.5, delta=0.05)
+
+    def test_units_follow_the_method(self):
+        scheduler = make_scheduler(rate=100)
+
+        self.assertEqual(scheduler.reserve(50), 0)
+        # batchModify costs 50 units, the bucket can not cover it any more
+        scheduler.acquire('batchModify')
+        scheduler.acquire('batchModify')
+        self.assertAlmostEqual(scheduler.waits[0], 0.5, delta=0.05)
+
+
+class TestRetries(unittest.TestCase):
+
+    def test_rate_limits_and_server_errors_retryable(self):
+        self.assertTrue(is_retryable(http_error(429)))
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertTrue(is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}')))
+        self.assertFalse(is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "forbidden"}]}}')))
+        self.assertFalse(is_retryable(http_error(404)))
+        self.assertFalse(is_retryable(ValueError('not an HTTP error')))
+
+        response = requests.Response()
+        response.status_code = 429
+        self.assertTrue(is_retryable(requests.HTTPError(response=response)))
+
+    def test_backoff_is_jittered_and_capped(self):
+        scheduler = make_scheduler(backoff_base=1.0, backoff_cap=8.0)
+
+        for attempt in range(10):
+            self.assertLessEqual(scheduler.backoff(attempt), min(8.0, 2 ** attempt))
+        self.assertGreater(len({scheduler.backoff(3) for _ in range(10)}), 1)
+
+    def test_execute_retries_until_success(self):
+        scheduler = make_scheduler(rate=1e9)
+        request = MagicMock()
+        request.execute.side_effect = [http_error(429), http_error(500), {'id': 'msg1'}]
+
+        self.assertEqual(scheduler.execute('get', request), {'id': 'msg1'})
+        self.assertEqual(request.execute.call_count, 3)
+        self.assertEqual(len(scheduler.waits), 2)
+
+    def test_execute_raises_permanent_error_at_once(self):
+        scheduler = make_scheduler(rate=1e9)
+        request = MagicMock()
+        request.execute.side_effect = http_error(404)
+
+        with self.assertRaises(HttpError):
+            scheduler.execute('get', request)
+        self.assertEqual(request.execute.call_count, 1)
+
+    def test_execute_gives_up_after_max_retries(self):
+        scheduler = make_scheduler(rate=1e9, max_retries=2)
+        request = MagicMock()
+        request.execute.side_effect = http_error(503)
+
+        with self.assertRaises(HttpError):
+            scheduler.execute('modify', request)
+        self.assertEqual(request.execute.call_count, 3)
+
+
+class TestRetryQueue(unittest.TestCase):
+
+    def test_throttled_call_does_not_hold_up_the_rest(self):
+        scheduler = make_scheduler(rate=1e9, backoff_base=0.0)
+        order = []
+        outcomes = {'a': [http_error(429), None], 'b': [None], 'c': [None]}
+
+        def call(name):
+            def run():
+                order.append(name)
+                error = outcomes[name].pop(0)
+                if error:
+                    raise error
+            return 'batchModify', run
+
+        failures = scheduler.run([call('a'), call('b'), call('c')])
+
+        self.assertEqual(failures, [])
+        self.assertEqual(order, ['a', 'b', 'c', 'a'])
+
+    def test_failures_returned_after_retries(self):
+        scheduler = make_scheduler(rate=1e9, max_retries=1, backoff_base=0.0)
+        permanent, throttled = http_error(400), http_error(429)
+
+        def raise_error(error):
+            def run():
+                raise error
+            return run
+
+        failures = scheduler.run([('modify', raise_error(permanent)), ('modify', raise_error(throttled))])
+
+        self.assertEqual([error for _, error in failures], [permanent, throttled])
+
+
+if __name__ == '__main__':
+    unittest.main()
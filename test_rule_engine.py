@@ -0,0 +1,226 @@
+import base64
+import json
+import os
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from rule_engine import (RuleError, ParsedEmail, compile_rules, evaluate, extract_body, gmail_query,
+                         parse_received_at)
+
+
+def make_rule(conditions, match='all', actions=('mark_as_read',)):
+    return {'conditions': {'match': match, 'rules': conditions}, 'actions': list(actions)}
+
+
+def make_email(email_id='email_id_1', **headers):
+    payload = {'headers': [{'name': name.capitalize(), 'value': value} for name, value in headers.items()]}
+    return ParsedEmail.from_payload(email_id, json.dumps(payload))
+
+
+class TestCompileRules(unittest.TestCase):
+
+    def test_compiles_rules_json_shape(self):
+        with open('rules.json') as f:
+            rules = compile_rules(json.load(f))
+
+        self.assertEqual(len(rules), 1)
+        self.assertFalse(rules[0].match_all)
+        self.assertEqual(rules[0].conditions[2].time_difference, timedelta(days=5))
+
+    def test_unknown_field(self):
+        with self.assertRaisesRegex(RuleError, "Unknown field 'sender'"):
+            compile_rules([make_rule([{'field': 'sender', 'predicate': 'contains', 'value': 'x'}])])
+
+    def test_unknown_predicate(self):
+        with self.assertRaisesRegex(RuleError, "Unknown predicate 'starts_with'"):
+            compile_rules([make_rule([{'field': 'subject', 'predicate': 'starts_with', 'value': 'x'}])])
+
+    def test_date_predicate_on_string_field(self):
+        with self.assertRaises(RuleError):
+            compile_rules([make_rule([{'field': 'subject', 'predicate': 'is_less_than', 'value': '5days'}])])
+
+    def test_bad_time_value(self):
+        with self.assertRaisesRegex(RuleError, "Unsupported time value"):
+            compile_rules([make_rule([{'field': 'received_at', 'predicate': 'is_less_than', 'value': '5weeks'}])])
+
+    def test_unknown_match_and_action(self):
+        with self.assertRaises(RuleError):
+            compile_rules([make_rule([], match='some')])
+        with self.assertRaisesRegex(RuleError, "Unknown action 'delete'"):
+            compile_rules([make_rule([], actions=['delete'])])
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def test_actions_in_rule_order(self):
+        rules = compile_rules([
+            make_rule([{'field': 'subject', 'predicate': 'contains', 'value': 'Test'}], actions=['mark_as_unread']),
+            make_rule([{'field': 'from', 'predicate': 'equals', 'value': 'other'}], actions=['move_to_inbox']),
+            make_rule([{'field': 'subject', 'predicate': 'not_equals', 'value': 'Spam'}], actions=['mark_as_read']),
+        ])
+
+        self.assertEqual(evaluate(rules, make_email(subject='Test Email')), ['mark_as_unread', 'mark_as_read'])
+
+    @patch('rule_engine.parsedate_to_datetime')
+    def test_any_short_circuits_before_date(self, mock_parse):
+        rules = compile_rules([make_rule([
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Test'},
+            {'field': 'received_at', 'predicate': 'is_less_than', 'value': '5days'}
+        ], match='any')])
+
+        self.assertEqual(evaluate(rules, make_email(subject='Test Email')), ['mark_as_read'])
+        mock_parse.assert_not_called()
+
+    @patch('rule_engine.parsedate_to_datetime')
+    def test_all_short_circuits_before_date(self, mock_parse):
+        rules = compile_rules([make_rule([
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Spam'},
+            {'field': 'received_at', 'predicate': 'is_less_than', 'value': '5days'}
+        ])])
+
+        self.assertEqual(evaluate(rules, make_email(subject='Test Email')), [])
+        mock_parse.assert_not_called()
+
+    @patch('rule_engine.parsedate_to_datetime')
+    def test_date_parsed_once_per_email(self, mock_parse):
+        now = datetime(2024, 9, 1, tzinfo=timezone.utc)
+        mock_parse.return_value = now - timedelta(days=2)
+        rules = compile_rules([
+            make_rule([{'field': 'received_at', 'predicate': 'is_less_than', 'value': '5days'}]),
+            make_rule([{'field': 'received_at', 'predicate': 'is_greater_than', 'value': '1day'}],
+                      actions=['move_to_starred']),
+        ])
+
+        actions = evaluate(rules, make_email(date='Fri, 30 Aug 2024 00:00:00 +0000'), now.timestamp())
+
+        self.assertEqual(actions, ['mark_as_read', 'move_to_starred'])
+        mock_parse.assert_called_once()
+
+
+class TestParseReceivedAt(unittest.TestCase):
+
+    def setUp(self):
+        # A naive datetime would be read in this zone, 4 hours off UTC in September
+        patcher = patch.dict(os.environ, {'TZ': 'America/New_York'})
+        patcher.start()
+        self.addCleanup(time.tzset)
+        self.addCleanup(patcher.stop)
+        time.tzset()
+
+    def test_dates_without_zone_are_utc(self):
+        expected = datetime(2024, 9, 1, 10, tzinfo=timezone.utc).timestamp()
+
+        for date in ('Sun, 1 Sep 2024 10:00:00 +0000', 'Sun, 1 Sep 2024 10:00:00 -0000', 'Sun, 1 Sep 2024 10:00:00',
+                     '2024-09-01 10:00:00', '2024-09-01T12:00:00+02:00'):
+            self.assertEqual(parse_received_at(date), expected, date)
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def make_body_email(plain=None, html=None, subject='Weekly digest'):
+    parts = [{'mimeType': 'application/pdf', 'filename': 'invoice.pdf', 'body': {'attachmentId': 'a1'}}]
+    if plain is not None:
+        parts.append({'mimeType': 'text/plain', 'filename': '', 'body': {'data': encode(plain)}})
+    if html is not None:
+        parts.append({'mimeType': 'text/html', 'filename': '', 'body': {'data': encode(html)}})
+    payload = {'mimeType': 'multipart/mixed', 'headers': [{'name': 'Subject', 'value': subject}],
+               'parts': [{'mimeType': 'multipart/alternative', 'parts': parts}]}
+    return ParsedEmail.from_payload('email_id_1', json.dumps(payload))
+
+
+class TestMessageBody(unittest.TestCase):
+
+    def test_prefers_plain_text(self):
+        email = make_body_email(plain='Your order shipped', html='<p>Your <b>order</b> shipped</p>')
+        self.assertEqual(email.body, 'Your order shipped')
+
+    def test_strips_html(self):
+        email = make_body_email(html='<style>p {color: red}</style><p>Your&nbsp;<b>order</b> shipped</p>')
+        self.assertEqual(email.body.split(), ['Your', 'order', 'shipped'])
+
+    def test_byte_cap(self):
+        payload = {'mimeType': 'text/plain', 'body': {'data': encode('x' * 100 + 'tail')}}
+        self.assertEqual(extract_body(payload, max_bytes=10), 'x' * 10)
+        self.assertEqual(extract_body({'mimeType': 'text/plain', 'body': {'size': 0}}), '')
+
+    def test_message_rules_match_body(self):
+        rules = compile_rules([
+            make_rule([{'field': 'message', 'predicate': 'contains', 'value': 'order'}], actions=['mark_as_read']),
+            make_rule([{'field': 'message', 'predicate': 'not_contains', 'value': 'refund'}],
+                      actions=['move_to_starred']),
+        ])
+
+        with patch('rule_engine.extract_body', wraps=extract_body) as mock_extract:
+            actions = evaluate(rules, make_body_email(plain='Your order shipped'))
+
+        self.assertEqual(actions, ['mark_as_read', 'move_to_starred'])
+        # Decoded once and reused by the second rule
+        mock_extract.assert_called_once()
+
+    @patch('rule_engine.extract_body')
+    def test_short_circuit_skips_decode(self, mock_extract):
+        # The body condition is listed first but evaluated after the subject one
+        rules = compile_rules([make_rule([
+            {'field': 'message', 'predicate': 'contains', 'value': 'order'},
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+        ])])
+
+        self.assertEqual(evaluate(rules, make_body_email(plain='Your order shipped')), [])
+        mock_extract.assert_not_called()
+
+
+class TestGmailQuery(unittest.TestCase):
+
+    def test_any_rule(self):
+        rules = compile_rules([make_rule([
+            {'field': 'from', 'predicate': 'contains', 'value': '<alerts@reddit.com>'},
+            {'field': 'subject', 'predicate': 'equals', 'value': 'Interview'}
+        ], match='any')])
+
+        self.assertEqual(gmail_query(rules), '{from:"alerts@reddit.com" subject:"Interview"}')
+
+    def test_all_rule_drops_unexpressible_terms(self):
+        rules = compile_rules([make_rule([
+            {'field': 'from', 'predicate': 'equals', 'value': 'alerts@reddit.com'},
+            {'field': 'subject', 'predicate': 'not_equals', 'value': 'Hi'},
+            {'field': 'subject', 'predicate': 'not_contains', 'value': 'digest'},
+            {'field': 'received_at', 'predicate': 'is_greater_than', 'value': '1month'}
+        ])])
+
+        self.assertEqual(gmail_query(rules), '(from:"alerts@reddit.com")')
+
+    def test_rules_combined_with_or(self):
+        rules = compile_rules([
+            make_rule([{'field': 'from', 'predicate': 'contains', 'value': ' Reddit '}]),
+            make_rule([{'field': 'to', 'predicate': 'equals', 'value': 'team'}], match='any'),
+            make_rule([], match='any'),
+        ])
+
+        self.assertEqual(gmail_query(rules), '{(from:"Reddit") {to:"team"}}')
+
+    def test_never_narrower_than_local_match(self):
+        # Gmail matches whole words regardless of case, these terms would drop messages the rule matches locally
+        for condition in ({'field': 'subject', 'predicate': 'contains', 'value': 'nterview'},
+                          {'field': 'subject', 'predicate': 'contains', 'value': 'Interview'},
+                          {'field': 'from', 'predicate': 'not_contains', 'value': 'reddit'},
+                          {'field': 'received_at', 'predicate': 'is_greater_than', 'value': '1month'},
+                          {'field': 'received_at', 'predicate': 'is_less_than', 'value': '5days'}):
+            self.assertIsNone(gmail_query(compile_rules([make_rule([condition])])), condition)
+
+    def test_unrestricted_rules_need_full_mailbox(self):
+        # An any rule with a not_equals term or an empty all rule can match any message
+        self.assertIsNone(gmail_query(compile_rules([make_rule([
+            {'field': 'from', 'predicate': 'equals', 'value': 'Reddit'},
+            {'field': 'subject', 'predicate': 'not_equals', 'value': 'Hi'}
+        ], match='any')])))
+        self.assertIsNone(gmail_query(compile_rules([make_rule([])])))
+        with open('rules.json') as f:
+            self.assertIsNone(gmail_query(compile_rules(json.load(f))))
+
+
+if __name__ == '__main__':
+    unittest.main()
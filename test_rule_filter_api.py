@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch, MagicMock
+
+import requests
+
+from rule_filter_api import ActionExecutor, RestLabelRegistry, batch_modify_calls, modify_calls
+from test_gmail_client import unthrottled
+
+
+class StubGmailHandler(BaseHTTPRequestHandler):
+    # Accepts modify / batchModify calls, answers 401 to any token other than server.valid_token
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes, without this Nagle holds the body for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.delay)
+
+        with server.lock:
+            throttled = server.throttle > 0
+            server.throttle -= throttled
+        if throttled:
+            status = 429
+        elif self.headers['Authorization'] == f'Bearer {server.valid_token}':
+            status = 200
+            with server.lock:
+                server.calls.append((self.path.rsplit('/', 2)[-2:], body))
+        else:
+            status = 401
+        with server.lock:
+            server.in_flight -= 1
+
+        response = b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(delay=0.0, valid_token='token'):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGmailHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls, server.connections = [], set()
+    server.in_flight = server.max_in_flight = 0
+    server.delay, server.valid_token = delay, valid_token
+    server.throttle = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/gmail/v1/users/me/messages'
+
+
+class TestActionExecutor(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('rule_filter_api.SCHEDULER', unthrottled())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server, self.url = start_stub_server(delay=0.01)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_every_call_sent_within_concurrency_limit(self):
+        calls = modify_calls([(f'msg{i}', ['mark_as_read']) for i in range(40)])
+
+        failed = ActionExecutor('token', concurrency=4, messages_url=self.url).execute(calls)
+
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(call[0][0] for call in self.server.calls), sorted(f'msg{i}' for i in range(40)))
+        self.assertLessEqual(self.server.max_in_flight, 4)
+        # Connections are kept alive and reused, not one per action
+        self.assertLessEqual(len(self.server.connections), 4)
+
+    def test_token_refreshed_once_on_401(self):
+        self.server.valid_token = 'fresh'
+        refreshes = []
+
+        def refresh():
+            refreshes.append(1)
+            return 'fresh'
+
+        executor = ActionExecutor('expired', refresh=refresh, concurrency=5, messages_url=self.url)
+        failed = executor.execute(modify_calls([(f'msg{i}', ['mark_as_unread']) for i in range(10)]))
+
+        self.assertEqual(failed, [])
+        self.assertEqual(len(refreshes), 1)
+        self.assertEqual(len(self.server.calls), 10)
+
+    def test_rate_limited_calls_retried(self):
+        self.server.throttle = 3
+
+        failed = ActionExecutor('token', messages_url=self.url).execute(
+            modify_calls([(f'msg{i}', ['mark_as_read']) for i in range(5)]))
+
+        # Every 429 was retried, no action was lost
+        self.assertEqual(failed, [])
+        self.assertEqual(len(self.server.calls), 5)
+
+    @patch('builtins.print')
+    def test_401_without_refresh_reported(self, mock_print):
+        failed = ActionExecutor('expired', messages_url=self.url).execute(modify_calls([('msg1', ['mark_as_read'])]))
+
+        self.assertEqual(failed, [('msg1/modify', {'addLabelIds': [], 'removeLabelIds': ['UNREAD']})])
+        self.assertIn('401', mock_print.call_args[0][0])
+
+    def test_batch_modify_calls_from_plan(self):
+        plan = {(('INBOX',), ('UNREAD',)): [f'msg{i}' for i in range(1500)]}
+
+        failed = ActionExecutor('token', messages_url=self.url).execute(batch_modify_calls(plan))
+
+        self.assertEqual(failed, [])
+        bodies = [body for path, body in self.server.calls]
+        self.assertEqual([path[-1] for path, _ in self.server.calls], ['batchModify', 'batchModify'])
+        self.assertEqual(sorted(len(body['ids']) for body in bodies), [500, 1000])
+        self.assertEqual(bodies[0]['addLabelIds'], ['INBOX'])
+
+
+class TestRestLabelRegistry(unittest.TestCase):
+
+    @patch('rule_filter_api.requests.request')
+    def test_label_calls_retried_within_quota(self, mock_request):
+        throttled = requests.Response()
+        throttled.status_code = 429
+        listed = MagicMock()
+        listed.json.return_value = {'labels': [{'name': 'Receipts', 'id': 'Label_1'}]}
+        mock_request.side_effect = [throttled, listed]
+        scheduler = unthrottled()
+
+        with patch('rule_filter_api.SCHEDULER', scheduler):
+            self.assertEqual(RestLabelRegistry('token').fetch(), {'Receipts': 'Label_1'})
+        self.assertEqual(scheduler.retries, 1)
+
+
+class TestModifyCalls(unittest.TestCase):
+
+    def test_no_op_emails_skipped(self):
+        calls = modify_calls([('msg1', ['mark_as_read']), ('msg2', ['mark_as_read'])], {'msg1': {'INBOX'}})
+
+        self.assertEqual(calls, [('msg2/modify', {'addLabelIds': [], 'removeLabelIds': ['UNREAD']})])
+
+
+if __name__ == '__main__':
+    unittest.main()
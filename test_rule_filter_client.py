@@ -1,8 +1,21 @@
+import threading
 import unittest
 from datetime import datetime, timedelta
-from unittest.mock import patch, MagicMock, mock_open, call
+from unittest.mock import patch, MagicMock, mock_open, call, ANY
 
-from rule_filter_client import parse_headers, match_rule, apply_actions, apply_rules
+import json
+import os
+import sqlite3
+import tempfile
+from queue import Queue
+
+from gmail_client import delete_emails_from_sqlite, init_db, set_fts, store_emails_in_sqlite
+from payload_codec import decompress, encode_payload
+from rule_engine import compile_rules
+from test_gmail_client import unthrottled
+from rule_filter_client import (parse_headers, match_rule, apply_actions, apply_rules, merge_actions, plan_actions,
+                                batch_modify, load_emails, find_matches, rowid_ranges, read_stage, run_pipeline,
+                                find_new_matches, record_ledger)
 
 
 class TestParseHeaders(unittest.TestCase):
@@ -24,7 +37,7 @@ class TestParseHeaders(unittest.TestCase):
 
 class TestMatchRule(unittest.TestCase):
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_received_at_greater_than_days(self, mock_parse):
         mock_parse.return_value = datetime.now() - timedelta(days=10)
 
@@ -37,7 +50,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_received_at_less_than_days(self, mock_parse):
         mock_parse.return_value = datetime.now() - timedelta(days=1)
 
@@ -50,7 +63,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_received_at_greater_than_months(self, mock_parse):
         mock_parse.return_value = datetime.now() - timedelta(days=60)
 
@@ -63,7 +76,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_received_at_less_than_months(self, mock_parse):
         mock_parse.return_value = datetime.now() - timedelta(days=15)
 
@@ -76,7 +89,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_contains_field(self, mock_parse):
         email = {
             'payload': '{"headers": [{"name": "Subject", "value": "Test Email"}]}'
@@ -87,7 +100,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_not_contains_field(self, mock_parse):
         email = {
             'payload': '{"headers": [{"name": "Subject", "value": "Test Email"}]}'
@@ -98,7 +111,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_equals_field(self, mock_parse):
         email = {
             'payload': '{"headers": [{"name": "Subject", "value": "Test Email"}]}'
@@ -109,7 +122,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_not_equals_field(self, mock_parse):
         email = {
             'payload': '{"headers": [{"name": "Subject", "value": "Test Email"}]}'
@@ -120,7 +133,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_all_rules_matches(self, mock_parse):
         email = {
             'payload': '{"headers": [{"name": "Subject", "value": "Test Email"}]}'
@@ -134,7 +147,7 @@ class TestMatchRule(unittest.TestCase):
         result = match_rule(email, conditions, match_all)
         self.assertTrue(result)
 
-    @patch('rule_filter_client.parser.parse')
+    @patch('rule_engine.parsedate_to_datetime')
     def test_any_rule_match(self, mock_parse):
         email = {
             'payload': '{"headers": [{"name": "Subject", "value": "Test Email"}]}'
@@ -184,6 +197,35 @@ class TestApplyActions(unittest.TestCase):
             body={'addLabelIds': ['INBOX']}
         )
 
+    def test_actions_merged_into_one_modify(self):
+        mock_service = MagicMock()
+
+        apply_actions(mock_service, 'test_email_id', ['mark_as_unread', 'move_to_starred'])
+
+        mock_service.users().messages().modify.assert_called_once_with(
+            userId='me',
+            id='test_email_id',
+            body={'addLabelIds': ['STARRED', 'UNREAD']}
+        )
+
+    def test_conflicting_actions_last_wins(self):
+        mock_service = MagicMock()
+
+        apply_actions(mock_service, 'test_email_id', ['mark_as_unread', 'mark_as_read'])
+
+        mock_service.users().messages().modify.assert_called_once_with(
+            userId='me',
+            id='test_email_id',
+            body={'removeLabelIds': ['UNREAD']}
+        )
+
+    def test_no_op_skipped(self):
+        mock_service = MagicMock()
+
+        apply_actions(mock_service, 'test_email_id', ['mark_as_read', 'move_to_starred'], label_ids={'STARRED'})
+
+        mock_service.users().messages().modify.assert_not_called()
+
     @patch('builtins.print')
     def test_exception_message(self, mock_print):
         mock_service = MagicMock()
@@ -209,10 +251,13 @@ class TestApplyRules(unittest.TestCase):
         apply_rules()
         mock_authenticate_gmail_api.assert_called_once_with('write_token.json', ['https://www.googleapis.com/auth/gmail.modify'])
 
+    @patch('rule_filter_client.record_ledger')
+    @patch('rule_filter_client.find_new_matches', return_value=({}, {}, {}))
     @patch('rule_filter_client.authenticate_gmail_api')
     @patch('rule_filter_client.sqlite3.connect')
     @patch('rule_filter_client.open', new_callable=mock_open, read_data='[{"conditions": {"match": "all", "rules": []}, "actions": []}]')
-    def test_sqlite_called(self, mock_open_file, mock_sqlite_connect, mock_authenticate_gmail_api):
+    def test_sqlite_called(self, mock_open_file, mock_sqlite_connect, mock_authenticate_gmail_api, mock_find_new_matches,
+                           mock_record_ledger):
         mock_conn = MagicMock()
         mock_sqlite_connect.return_value = mock_conn
         apply_rules()
@@ -220,47 +265,580 @@ class TestApplyRules(unittest.TestCase):
         mock_conn.cursor.assert_called_once()
         mock_conn.close.assert_called_once()
 
+    @patch('rule_filter_client.record_ledger')
+    @patch('rule_filter_client.init_db')
     @patch('rule_filter_client.authenticate_gmail_api')
-    @patch('rule_filter_client.match_rule')
+    @patch('rule_filter_client.find_new_matches')
     @patch('rule_filter_client.sqlite3.connect')
     @patch('rule_filter_client.open', new_callable=mock_open, read_data='[{"conditions": {"match": "all", "rules": []}, "actions": []}]')
-    def test_match_rule_called_correct_times(self, mock_open_file, mock_sqlite_connect, mock_match_rule, mock_authenticate_gmail_api):
+    def test_find_matches_called(self, mock_open_file, mock_sqlite_connect, mock_find_new_matches, mock_authenticate_gmail_api, mock_init_db,
+                                 mock_record_ledger):
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_sqlite_connect.return_value = mock_conn
         mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.execute.return_value = [('email_id_1', '{"payload": {}}'), ('email_id_2', '{"payload": {}}')]
+        mock_find_new_matches.return_value = ({}, {}, {})
 
-        apply_rules()
+        apply_rules(pushdown=False)
 
-        self.assertEqual(mock_match_rule.call_count, 2 * 1)
+        mock_find_new_matches.assert_called_once_with(mock_cursor, ANY, ANY, False, workers=1)
 
-    @patch('rule_filter_client.apply_actions')
-    @patch('rule_filter_client.match_rule')
+    @patch('rule_filter_client.record_ledger')
+    @patch('rule_filter_client.init_db')
+    @patch('rule_filter_client.batch_modify')
+    @patch('rule_filter_client.find_new_matches')
     @patch('rule_filter_client.sqlite3.connect')
-    @patch('rule_filter_client.open', new_callable=mock_open, read_data='[{"conditions": {"match": "all", "rules": []}, "actions": []}]')
+    @patch('rule_filter_client.open', new_callable=mock_open, read_data='[{"conditions": {"match": "all", "rules": []}, "actions": ["mark_as_read"]}]')
     @patch('rule_filter_client.authenticate_gmail_api')
-    def test_apply_actions_called(self, mock_authenticate_gmail_api, mock_open_file, mock_sqlite_connect, mock_match_rule, mock_apply_actions):
+    def test_batch_modify_called(self, mock_authenticate_gmail_api, mock_open_file, mock_sqlite_connect, mock_find_new_matches, mock_batch_modify, mock_init_db,
+                                 mock_record_ledger):
         mock_conn = MagicMock()
-        mock_cursor = MagicMock()
         mock_sqlite_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.execute.return_value = [('email_id_1', '{"payload": {}}'), ('email_id_2', '{"payload": {}}')]
 
-        mock_match_rule.return_value = True
+        mock_find_new_matches.return_value = (
+            {'email_id_1': (['mark_as_read'], None), 'email_id_2': (['mark_as_read'], None)}, {}, {})
 
         mock_service = MagicMock()
         mock_authenticate_gmail_api.return_value = mock_service
 
         apply_rules()
 
-        expected_calls = [
-            call(mock_service, 'email_id_1', []),
-            call(mock_service, 'email_id_2', [])
+        # 2 emails with the same label diff end up in a single group
+        mock_batch_modify.assert_called_once_with(mock_service, {((), ('UNREAD',)): ['email_id_1', 'email_id_2']})
+
+
+class TestPlanActions(unittest.TestCase):
+
+    def test_merge_actions(self):
+        self.assertEqual(merge_actions(['mark_as_unread', 'move_to_starred']), (('STARRED', 'UNREAD'), ()))
+        self.assertEqual(merge_actions(['mark_as_read']), ((), ('UNREAD',)))
+
+    def test_merge_actions_resolved_labels(self):
+        labels = {'move_to_Receipts_2024': 'Label_1'}
+        self.assertEqual(merge_actions(['move_to_Receipts_2024', 'move_to_inbox'], labels=labels),
+                         (('INBOX', 'Label_1'), ()))
+        # Unresolved names keep everything after the prefix, not only the last underscore part
+        self.assertEqual(merge_actions(['move_to_category_social']), (('CATEGORY_SOCIAL',), ()))
+
+    def test_groups_by_label_diff(self):
+        plan = plan_actions([
+            ('email_id_1', ['mark_as_read']),
+            ('email_id_2', ['move_to_starred']),
+            ('email_id_3', ['mark_as_read']),
+            ('email_id_4', []),
+        ])
+
+        self.assertEqual(plan, {
+            ((), ('UNREAD',)): ['email_id_1', 'email_id_3'],
+            (('STARRED',), ()): ['email_id_2'],
+        })
+
+    def test_no_op_label_changes_dropped(self):
+        plan = plan_actions(
+            [('email_id_1', ['mark_as_read', 'move_to_starred']), ('email_id_2', ['mark_as_read']),
+             ('email_id_3', ['mark_as_read'])],
+            {'email_id_1': {'UNREAD'}, 'email_id_2': {'INBOX'}}
+        )
+
+        # email_id_2 is already read, email_id_3 has no stored labels so it is always sent
+        self.assertEqual(plan, {(('STARRED',), ('UNREAD',)): ['email_id_1'], ((), ('UNREAD',)): ['email_id_3']})
+
+    def test_batch_modify_chunks_ids(self):
+        mock_service = MagicMock()
+        email_ids = [f'email_id_{i}' for i in range(2500)]
+
+        batch_modify(mock_service, {((), ('UNREAD',)): email_ids, (('STARRED',), ()): ['email_id_0']})
+
+        mock_batch_modify = mock_service.users().messages().batchModify
+        self.assertEqual(mock_batch_modify.call_count, 3 + 1)
+        mock_batch_modify.assert_any_call(
+            userId='me', body={'ids': email_ids[2000:], 'addLabelIds': [], 'removeLabelIds': ['UNREAD']})
+        mock_batch_modify.assert_any_call(
+            userId='me', body={'ids': ['email_id_0'], 'addLabelIds': ['STARRED'], 'removeLabelIds': []})
+
+    @patch('builtins.print')
+    def test_batch_modify_exception_message(self, mock_print):
+        mock_service = MagicMock()
+        mock_service.users().messages().batchModify.side_effect = Exception("API Error")
+
+        batch_modify(mock_service, {((), ('UNREAD',)): ['email_id_1']})
+
+        mock_print.assert_called_once_with("Failed to execute action: API Error")
+
+
+class TestLoadEmails(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.cur = self.conn.cursor()
+        init_db(self.cur)
+        # A payload that is not JSON proves whether evaluation touched it
+        self.cur.execute("INSERT INTO emails (id, payload, from_addr, subject, received_at) "
+                         "VALUES ('email_id_1', 'not json', 'alerts@reddit.com', 'Hi', 1725119089.0)")
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_column_fields_skip_payload(self):
+        rules = compile_rules([{'conditions': {'match': 'all', 'rules': [
+            {'field': 'from', 'predicate': 'contains', 'value': 'reddit'},
+            {'field': 'received_at', 'predicate': 'is_greater_than', 'value': '1day'}
+        ]}, 'actions': []}])
+
+        (email, label_ids), = load_emails(self.cur, rules)
+
+        self.assertEqual(email.headers, {'from': 'alerts@reddit.com', 'subject': 'Hi'})
+        self.assertEqual(email.received_at, 1725119089.0)
+
+    def test_other_headers_read_payload(self):
+        self.cur.execute("""UPDATE emails SET payload = '{"headers": [{"name": "Cc", "value": "team"}]}'""")
+        rules = compile_rules([{'conditions': {'match': 'all', 'rules': [
+            {'field': 'cc', 'predicate': 'equals', 'value': 'team'}
+        ]}, 'actions': []}])
+
+        (email, label_ids), = load_emails(self.cur, rules)
+
+        self.assertEqual(email.headers, {'cc': 'team'})
+        self.assertEqual(email.received_at, 1725119089.0)
+
+
+    def body_rules(self, *conditions):
+        return compile_rules([{'conditions': {'match': 'all', 'rules': [
+            *conditions, {'field': 'message', 'predicate': 'contains', 'value': 'order'}]}, 'actions': []}])
+
+    def store_payload(self, payload):
+        self.cur.execute('UPDATE emails SET payload = ?', (encode_payload(payload),))
+
+    def test_body_rules_take_headers_from_columns(self):
+        self.store_payload({'mimeType': 'text/plain', 'body': {'data': 'eW91ciBvcmRlcg'}})
+
+        with patch('payload_codec.decompress', wraps=decompress) as mock_decompress:
+            (email, label_ids), = load_emails(self.cur, self.body_rules(
+                {'field': 'from', 'predicate': 'contains', 'value': 'reddit'}))
+            self.assertEqual(email.headers, {'from': 'alerts@reddit.com', 'subject': 'Hi'})
+            # Nothing is decoded until a body condition is reached, then only once
+            mock_decompress.assert_not_called()
+            self.assertEqual(email.value('message'), 'your order')
+            self.assertEqual(email.value('message'), 'your order')
+        self.assertEqual(mock_decompress.call_count, 1)
+
+    def test_payload_decoded_once_for_headers_and_body(self):
+        self.store_payload({'mimeType': 'text/plain', 'headers': [{'name': 'Cc', 'value': 'team'}],
+                            'body': {'data': 'eW91ciBvcmRlcg'}})
+
+        with patch('payload_codec.decompress', wraps=decompress) as mock_decompress:
+            (email, label_ids), = load_emails(self.cur, self.body_rules(
+                {'field': 'cc', 'predicate': 'equals', 'value': 'team'}))
+            self.assertEqual(email.headers, {'cc': 'team'})
+            self.assertEqual(email.value('message'), 'your order')
+        self.assertEqual(mock_decompress.call_count, 1)
+
+
+class TestFindMatches(unittest.TestCase):
+
+    NOW = 1725200000.0
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.cur = self.conn.cursor()
+        init_db(self.cur)
+        rows = [
+            ('email_id_1', 'alerts@reddit.com', 'me@example.com', 'Interview tomorrow', self.NOW - 2 * 86400),
+            ('email_id_2', 'news@vendor.com', 'me@example.com', 'Weekly digest', self.NOW - 40 * 86400),
+            ('email_id_3', None, None, None, None),
+            ('email_id_4', 'Reddit <noreply@reddit.com>', 'team@example.com', 'Reddit digest', self.NOW - 10 * 86400),
         ]
-        mock_apply_actions.assert_has_calls(expected_calls, any_order=True)
-        self.assertEqual(mock_apply_actions.call_count, 2)  # 2 emails, both matching
+        for email_id, from_addr, to_addr, subject, received_at in rows:
+            headers = [{'name': name, 'value': value} for name, value in
+                       (('From', from_addr), ('To', to_addr), ('Subject', subject), ('Cc', 'team')) if value]
+            self.cur.execute('INSERT INTO emails (id, payload, from_addr, to_addr, subject, received_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (email_id, json.dumps({'headers': headers}), from_addr, to_addr, subject, received_at))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def rules(self):
+        return compile_rules([
+            {'conditions': {'match': 'any', 'rules': [
+                {'field': 'from', 'predicate': 'contains', 'value': 'reddit'},
+                {'field': 'subject', 'predicate': 'contains', 'value': 'Interview'}]},
+             'actions': ['mark_as_read']},
+            {'conditions': {'match': 'all', 'rules': [
+                {'field': 'to', 'predicate': 'equals', 'value': 'me@example.com'},
+                {'field': 'received_at', 'predicate': 'is_greater_than', 'value': '1month'}]},
+             'actions': ['move_to_starred']},
+            {'conditions': {'match': 'all', 'rules': [
+                {'field': 'subject', 'predicate': 'not_contains', 'value': 'digest'},
+                {'field': 'from', 'predicate': 'not_equals', 'value': 'x'}]},
+             'actions': ['mark_as_unread']},
+            {'conditions': {'match': 'all', 'rules': [
+                {'field': 'cc', 'predicate': 'equals', 'value': 'team'},
+                {'field': 'received_at', 'predicate': 'is_less_than', 'value': '5days'}]},
+             'actions': ['move_to_inbox']},
+        ])
+
+    def test_pushdown_matches_python_evaluation(self):
+        pushed = find_matches(self.cur, self.rules(), self.NOW)
+        in_python = find_matches(self.cur, self.rules(), self.NOW, pushdown=False)
+
+        self.assertEqual(pushed, in_python)
+        self.assertEqual(pushed, {
+            'email_id_1': (['mark_as_read', 'mark_as_unread', 'move_to_inbox'], None),
+            'email_id_2': (['move_to_starred'], None),
+            'email_id_3': (['mark_as_unread'], None),
+            'email_id_4': (['mark_as_read'], None),
+        })
+
+    def test_translatable_rules_use_where_clause(self):
+        rule = self.rules()[1]
+
+        where, params = rule.to_sql(self.NOW)
+
+        self.assertEqual(where, '(to_addr = ?) AND (received_at < ?)')
+        self.assertEqual(params, ['me@example.com', self.NOW - 30 * 86400])
+        plan = ' '.join(row[3] for row in self.cur.execute(
+            f'EXPLAIN QUERY PLAN SELECT id FROM emails WHERE {where}', params))
+        self.assertIn('USING INDEX', plan)
+
+    def test_untranslatable_rule_falls_back(self):
+        self.assertIsNone(self.rules()[3].to_sql(self.NOW))
+
+    def test_parallel_matches_serial(self):
+        handle, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, db_path)
+        self.conn.commit()
+        disk = sqlite3.connect(db_path)
+        self.conn.backup(disk)
+
+        parallel = find_matches(disk.cursor(), self.rules(), self.NOW, pushdown=False, workers=2)
+        disk.close()
+
+        self.assertEqual(parallel, find_matches(self.cur, self.rules(), self.NOW, pushdown=False))
+
+    def test_rowid_ranges_cover_the_table(self):
+        self.assertEqual(rowid_ranges(self.cur, 3), [(1, 2), (3, 4)])
+        self.assertEqual(rowid_ranges(self.cur, 8), [(1, 1), (2, 2), (3, 3), (4, 4)])
+        self.cur.execute('DELETE FROM emails')
+        self.assertEqual(rowid_ranges(self.cur, 3), [])
+
+
+class TestFtsIndex(unittest.TestCase):
+
+    NOW = 1725200000.0
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, self.db_path)
+        patcher = patch('gmail_client.DB_PATH', self.db_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        set_fts(True)
+
+    def store(self, *messages):
+        store_emails_in_sqlite([{'id': email_id, 'threadId': 't', 'payload': {'headers': [
+            {'name': 'From', 'value': from_addr}, {'name': 'Subject', 'value': subject}]}}
+            for email_id, from_addr, subject in messages])
+
+    def matches(self, condition, pushdown=True):
+        rules = compile_rules([{'conditions': {'match': 'all', 'rules': [condition]}, 'actions': ['mark_as_read']}])
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return set(find_matches(conn.cursor(), rules, self.NOW, pushdown))
+        finally:
+            conn.close()
+
+    def test_contains_answered_from_index(self):
+        rule = compile_rules([{'conditions': {'match': 'all', 'rules': [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Interview'}]}, 'actions': []}])[0]
+
+        where, params = rule.to_sql(self.NOW, fts=True)
+
+        self.assertEqual(where, '(rowid IN (SELECT rowid FROM emails_fts WHERE emails_fts MATCH ?))')
+        self.assertEqual(params, ['subject : "Interview"'])
+
+    def test_agrees_with_python_evaluation(self):
+        self.store(('1', 'alerts@reddit.com', 'Interview "tomorrow"'), ('2', 'Reddit <no@reddit.com>', 'digest'),
+                   ('3', 'news@vendor.com', 'interview notes'))
+        conditions = [
+            {'field': 'from', 'predicate': 'contains', 'value': 'reddit'},
+            {'field': 'from', 'predicate': 'contains', 'value': 'Reddit'},
+            {'field': 'subject', 'predicate': 'contains', 'value': '"tomorrow"'},
+            {'field': 'subject', 'predicate': 'not_contains', 'value': 'Interview'},
+            {'field': 'subject', 'predicate': 'contains', 'value': 'di'},
+            {'field': 'to', 'predicate': 'not_contains', 'value': 'me@'},
+        ]
+        for condition in conditions:
+            self.assertEqual(self.matches(condition), self.matches(condition, pushdown=False), condition)
+        self.assertEqual(self.matches(conditions[1]), {'2'})
+
+    def test_index_follows_updates_and_deletes(self):
+        self.store(('1', 'alerts@reddit.com', 'Interview'), ('2', 'news@vendor.com', 'digest'))
+        self.store(('1', 'alerts@reddit.com', 'Offer'))
+        delete_emails_from_sqlite(['2'])
+
+        self.assertEqual(self.matches({'field': 'subject', 'predicate': 'contains', 'value': 'Interview'}), set())
+        self.assertEqual(self.matches({'field': 'subject', 'predicate': 'contains', 'value': 'Offer'}), {'1'})
+        self.assertEqual(self.matches({'field': 'from', 'predicate': 'contains', 'value': 'vendor'}), set())
+
+    def test_existing_rows_indexed(self):
+        os.remove(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE emails (id TEXT PRIMARY KEY, payload TEXT, subject TEXT)")
+        conn.execute("INSERT INTO emails (id, payload, subject) VALUES ('1', '{}', 'Interview')")
+        conn.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("INSERT INTO metadata VALUES ('schema_version', '2')")
+        conn.commit()
+        conn.close()
+        set_fts(True)
+        self.store(('2', 'news@vendor.com', 'Interview digest'))
+
+        self.assertEqual(self.matches({'field': 'subject', 'predicate': 'contains', 'value': 'Interview'}), {'1', '2'})
+
+    def test_index_is_opt_in(self):
+        def index_objects():
+            conn = sqlite3.connect(self.db_path)
+            try:
+                return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'emails_fts%'").fetchone()[0]
+            finally:
+                conn.close()
+        self.assertGreater(index_objects(), 0)
+
+        set_fts(False)
+        self.store(('1', 'alerts@reddit.com', 'Interview'))
+
+        # Ingest pays for no triggers, contains conditions scan the column
+        self.assertEqual(index_objects(), 0)
+        self.assertEqual(self.matches({'field': 'subject', 'predicate': 'contains', 'value': 'Interview'}), {'1'})
+
+
+class TestPipeline(unittest.TestCase):
+
+    NOW = 1725200000.0
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        init_db(conn.cursor())
+        conn.executemany('INSERT INTO emails (id, label_ids, from_addr, subject, received_at) VALUES (?, ?, ?, ?, ?)',
+                         [(f'msg{i}', '["INBOX", "UNREAD"]' if i % 3 else '["INBOX"]', f'news{i % 7}@vendor.com',
+                           f'Digest {i}', self.NOW - i * 3600) for i in range(1000)])
+        conn.commit()
+        conn.close()
+        patcher = patch('rule_filter_client.SCHEDULER', unthrottled())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def rules(self):
+        return compile_rules([
+            {'conditions': {'match': 'all', 'rules': [{'field': 'from', 'predicate': 'contains', 'value': 'news1'}]},
+             'actions': ['mark_as_read']},
+            {'conditions': {'match': 'all', 'rules': [
+                {'field': 'received_at', 'predicate': 'is_greater_than', 'value': '10days'}]},
+             'actions': ['move_to_starred']},
+        ])
+
+    @staticmethod
+    def recording_service():
+        service, bodies, lock = MagicMock(), [], threading.Lock()
+
+        def batch_modify_request(userId, body):
+            request = MagicMock()
+
+            def execute(http):
+                with lock:
+                    bodies.append(body)
+            request.execute.side_effect = execute
+            return request
+        service.users().messages().batchModify.side_effect = batch_modify_request
+        return service, bodies
+
+    @patch('rule_filter_client.BATCH_MODIFY_SIZE', 50)
+    def test_same_plan_as_batch_path(self):
+        service, bodies = self.recording_service()
+
+        run_pipeline(self.db_path, self.rules(), self.NOW, service, queue_size=10, dispatchers=3)
+
+        conn = sqlite3.connect(self.db_path)
+        matches = find_matches(conn.cursor(), self.rules(), self.NOW)
+        conn.close()
+        expected = plan_actions([(email_id, actions) for email_id, (actions, _) in matches.items()],
+                                {email_id: set(json.loads(labels)) for email_id, (_, labels) in matches.items()})
+
+        dispatched = {}
+        for body in bodies:
+            self.assertLessEqual(len(body['ids']), 50)
+            key = (tuple(body['addLabelIds']), tuple(body['removeLabelIds']))
+            dispatched.setdefault(key, set()).update(body['ids'])
+        self.assertEqual(dispatched, {key: set(email_ids) for key, email_ids in expected.items()})
+
+    def test_ledger_skips_applied_actions(self):
+        service, bodies = self.recording_service()
+
+        applied = run_pipeline(self.db_path, self.rules(), self.NOW, service)
+        sent = {email_id for body in bodies for email_id in body['ids']}
+        self.assertEqual(applied, sent)
+
+        bodies.clear()
+        self.assertEqual(run_pipeline(self.db_path, self.rules(), self.NOW, service), set())
+        # An unchanged mailbox costs no call
+        self.assertEqual(bodies, [])
+
+    @patch('builtins.print')
+    def test_failed_calls_sent_again(self, mock_print):
+        service, bodies = self.recording_service()
+        failing = MagicMock()
+        failing.execute.side_effect = Exception('Not Found')
+        service.users().messages().batchModify.side_effect = lambda userId, body: failing
+
+        self.assertEqual(run_pipeline(self.db_path, self.rules(), self.NOW, service), set())
+
+        service, bodies = self.recording_service()
+        applied = run_pipeline(self.db_path, self.rules(), self.NOW, service)
+        self.assertEqual(applied, {email_id for body in bodies for email_id in body['ids']})
+        self.assertTrue(applied)
+
+    def test_reader_blocks_on_full_queue(self):
+        rows = Queue(5)
+        reader = threading.Thread(target=read_stage, args=(self.db_path, self.rules(), rows, []), daemon=True)
+        reader.start()
+        reader.join(0.2)
+
+        # Backpressure, the reader waits for the evaluator instead of loading the whole table
+        self.assertTrue(reader.is_alive())
+        self.assertEqual(rows.qsize(), 5)
+        while reader.is_alive():
+            rows.get()
+
+    def test_reader_error_raised(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        service, bodies = self.recording_service()
+
+        with self.assertRaises(sqlite3.OperationalError):
+            run_pipeline(os.path.join(directory, 'missing', 'emails.db'), self.rules(), self.NOW, service)
+        self.assertEqual(bodies, [])
+
+
+    @patch('rule_filter_client.BATCH_MODIFY_SIZE', 5)
+    def test_dispatcher_error_raised(self):
+        service, bodies = self.recording_service()
+        service.users().messages().batchModify.side_effect = RuntimeError('transport gone')
+        raised = []
+
+        def run():
+            try:
+                run_pipeline(self.db_path, self.rules(), self.NOW, service, queue_size=1, dispatchers=1)
+            except RuntimeError as e:
+                raised.append(e)
+        pipeline = threading.Thread(target=run, daemon=True)
+        pipeline.start()
+        pipeline.join(10)
+
+        # The evaluator is not left blocked on the full calls queue
+        self.assertFalse(pipeline.is_alive())
+        self.assertEqual([str(e) for e in raised], ['transport gone'])
+
+
+class TestLedger(unittest.TestCase):
+
+    NOW = 1725200000.0
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        store_emails_in_sqlite([self.email('msg1', 'alerts@reddit.com'), self.email('msg2', 'news@vendor.com')],
+                               conn=self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def email(self, email_id, sender, labels=('INBOX', 'UNREAD')):
+        return {'id': email_id, 'labelIds': list(labels), 'internalDate': str(int((self.NOW - 86400) * 1000)),
+                'payload': {'headers': [{'name': 'From', 'value': sender}]}}
+
+    @staticmethod
+    def rules(sender='reddit', extra=()):
+        return compile_rules([{'conditions': {'match': 'all', 'rules': [
+            {'field': 'from', 'predicate': 'contains', 'value': sender}]}, 'actions': ['mark_as_read']}, *extra])
+
+    def run_rules(self, rules, failed_ids=(), pushdown=True):
+        # One apply_rules run without the API, returns the emails that would have been dispatched
+        matches, matched, checkpoint = find_new_matches(self.conn.cursor(), rules, self.NOW, pushdown)
+        record_ledger(self.conn, matched, set(failed_ids), checkpoint, self.NOW)
+        return sorted(matches)
+
+    def test_unchanged_mailbox_dispatches_nothing(self):
+        self.assertEqual(self.run_rules(self.rules()), ['msg1'])
+
+        self.assertEqual(self.run_rules(self.rules()), [])
+        self.assertEqual(self.conn.execute('SELECT email_id, rule_hash, actions FROM ledger').fetchall(),
+                         [('msg1', self.rules()[0].hash, '["mark_as_read"]')])
+
+    def test_only_new_emails_evaluated(self):
+        self.run_rules(self.rules())
+        store_emails_in_sqlite([self.email('msg3', 'digest@reddit.com'), self.email('msg1', 'alerts@reddit.com', ['INBOX'])],
+                               conn=self.conn)
+
+        with patch('rule_filter_client.load_emails', wraps=load_emails) as mock_load_emails:
+            dispatched = self.run_rules(self.rules(), pushdown=False)
+
+        # msg1 changed but its action is in the ledger, msg3 is new
+        self.assertEqual(dispatched, ['msg3'])
+        # Only the rows stored since the last run were read
+        where, params = mock_load_emails.call_args[0][2:]
+        self.assertTrue(where.startswith('sequence > ?'))
+        self.assertEqual(params, (1,))
+
+    def test_rows_of_running_store_evaluated_again(self):
+        self.run_rules(self.rules())
+        dispatched = []
+
+        def emails():
+            yield self.email('msg3', 'digest@reddit.com')
+            # A rule run between two chunk commits of the same store
+            dispatched.append(self.run_rules(self.rules()))
+            yield self.email('msg4', 'weekly@reddit.com')
+        store_emails_in_sqlite(emails(), chunk_size=1, conn=self.conn)
+
+        self.assertEqual(dispatched, [['msg3']])
+        self.assertEqual(self.run_rules(self.rules()), ['msg4'])
+        self.assertEqual(self.run_rules(self.rules()), [])
+
+    def test_edited_rule_evaluated_again(self):
+        self.run_rules(self.rules())
+
+        self.assertEqual(self.run_rules(self.rules('vendor')), ['msg2'])
+
+    def test_new_rule_merged_with_applied_ones(self):
+        self.run_rules(self.rules())
+        star = {'conditions': {'match': 'all', 'rules': [{'field': 'from', 'predicate': 'contains', 'value': 'alerts'}]},
+                'actions': ['move_to_starred']}
+
+        matches, _, _ = find_new_matches(self.conn.cursor(), self.rules(extra=[star]), self.NOW)
+
+        # The email is dispatched with every matching rule's actions, so conflicts still resolve in rules.json order
+        self.assertEqual(matches, {'msg1': (['mark_as_read', 'move_to_starred'], '["INBOX", "UNREAD"]')})
+
+    def test_failed_emails_retried(self):
+        self.assertEqual(self.run_rules(self.rules(), failed_ids={'msg1'}), ['msg1'])
+
+        self.assertEqual(self.run_rules(self.rules()), ['msg1'])
+        self.assertEqual(self.run_rules(self.rules()), [])
+
+    def test_date_rules_rechecked_without_repeating_actions(self):
+        old = {'conditions': {'match': 'all', 'rules': [
+            {'field': 'received_at', 'predicate': 'is_greater_than', 'value': '2days'}]}, 'actions': ['move_to_archive']}
+        rules = compile_rules([old])
 
+        self.assertEqual(self.run_rules(rules), [])
+        # Time passes, the unchanged emails are now old enough
+        self.NOW += 3 * 86400
+        self.assertEqual(self.run_rules(rules), ['msg1', 'msg2'])
+        self.assertEqual(self.run_rules(rules), [])
 
 
 if __name__ == '__main__':
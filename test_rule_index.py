@@ -0,0 +1,125 @@
+import random
+import unittest
+from unittest.mock import patch
+
+from rule_engine import ParsedEmail, compile_rules
+from rule_index import Automaton, RuleIndex
+
+NOW = 1725200000.0
+
+
+def make_rule(conditions, match='all', actions=('mark_as_read',)):
+    return {'conditions': {'match': match, 'rules': conditions}, 'actions': list(actions)}
+
+
+class TestAutomaton(unittest.TestCase):
+
+    def test_overlapping_patterns(self):
+        automaton = Automaton(['he', 'she', 'his', 'hers'])
+
+        self.assertEqual(automaton.search('ushers'), {0, 1, 3})
+        self.assertEqual(automaton.search('history'), {2})
+        self.assertEqual(automaton.search('nothing'), set())
+
+    def test_empty_pattern_always_found(self):
+        self.assertEqual(Automaton(['', 'x']).search('abc'), {0})
+
+    def test_matches_substring_search(self):
+        random.seed(1)
+        patterns = list({''.join(random.choices('abc', k=random.randint(1, 4))) for _ in range(40)})
+        automaton = Automaton(patterns)
+
+        for _ in range(200):
+            text = ''.join(random.choices('abcd', k=random.randint(0, 20)))
+            expected = {pattern_id for pattern_id, pattern in enumerate(patterns) if pattern in text}
+            self.assertEqual(automaton.search(text), expected)
+
+
+class TestRuleIndex(unittest.TestCase):
+
+    def test_matches_rule_by_rule_evaluation(self):
+        random.seed(2)
+        words = ['reddit', 'vendor', 'news', 'interview', 'digest', 'a', '']
+        fields = ['from', 'to', 'subject']
+        predicates = ['contains', 'not_contains', 'equals', 'not_equals']
+
+        rules = []
+        for _ in range(300):
+            conditions = [{'field': random.choice(fields), 'predicate': random.choice(predicates),
+                           'value': random.choice(words)} for _ in range(random.randint(0, 3))]
+            if random.random() < 0.2:
+                conditions.append({'field': 'received_at', 'predicate': 'is_less_than', 'value': '5days'})
+            rules.append(make_rule(conditions, match=random.choice(['all', 'any'])))
+        compiled = compile_rules(rules)
+        index = RuleIndex(compiled)
+
+        for i in range(300):
+            headers = {field: ' '.join(random.choices(words, k=random.randint(0, 3))) for field in fields
+                       if random.random() < 0.9}
+            email = ParsedEmail(f'email_id_{i}', headers, NOW - random.randint(0, 10) * 86400)
+
+            expected = [position for position, rule in enumerate(compiled) if rule.matches(email, NOW)]
+            self.assertEqual(index.match(email, NOW), expected)
+
+    def test_batch_dates_match_per_email_evaluation(self):
+        rules = compile_rules([
+            make_rule([{'field': 'received_at', 'predicate': 'is_less_than', 'value': '5days'}]),
+            make_rule([{'field': 'received_at', 'predicate': 'is_greater_than', 'value': '1month'},
+                       {'field': 'from', 'predicate': 'contains', 'value': 'news'}]),
+            make_rule([{'field': 'received_at', 'predicate': 'is_greater_than', 'value': '10days'},
+                       {'field': 'subject', 'predicate': 'not_contains', 'value': 'digest'}], match='any'),
+        ])
+        index = RuleIndex(rules)
+        emails = [ParsedEmail(f'email_id_{i}', {'from': 'news@vendor.com' if i % 2 else 'a@x.com',
+                                                'subject': 'digest' if i % 3 else 'hello'},
+                              None if i % 5 == 0 else NOW - i * 86400) for i in range(60)]
+
+        batched = index.match_batch(emails, NOW)
+
+        self.assertEqual(batched, [index.match(email, NOW) for email in emails])
+        self.assertEqual(batched, [[position for position, rule in enumerate(rules) if rule.matches(email, NOW)]
+                                   for email in emails])
+        # A missing date fails every date condition
+        self.assertEqual(batched[0], [2])
+
+    def test_each_header_scanned_once(self):
+        rules = compile_rules([make_rule([{'field': 'subject', 'predicate': 'contains', 'value': f'word{i}'}])
+                               for i in range(1000)])
+        index = RuleIndex(rules)
+        email = ParsedEmail('email_id_1', {'subject': 'hello word7 and word42'})
+
+        with patch.object(Automaton, 'search', autospec=True, side_effect=Automaton.search) as mock_search:
+            matched = index.match(email, NOW)
+
+        # word4 is a substring of word42
+        self.assertEqual(matched, [4, 7, 42])
+        self.assertEqual(mock_search.call_count, 1)
+
+    def test_equals_uses_hash_map(self):
+        rules = compile_rules([
+            make_rule([{'field': 'from', 'predicate': 'equals', 'value': 'a@x.com'}], actions=['mark_as_read']),
+            make_rule([{'field': 'from', 'predicate': 'not_equals', 'value': 'a@x.com'}], actions=['mark_as_unread']),
+        ])
+        index = RuleIndex(rules)
+
+        self.assertEqual(index.match(ParsedEmail('1', {'from': 'a@x.com'}), NOW), [0])
+        self.assertEqual(index.match(ParsedEmail('2', {'from': 'b@x.com'}), NOW), [1])
+        self.assertEqual(index.equals, {'from': {'a@x.com': ('from', 'equals', 'a@x.com')}})
+
+    @patch('rule_engine.extract_body', return_value='Your order shipped')
+    def test_body_rules_checked_after_index(self, mock_extract):
+        rules = compile_rules([
+            make_rule([{'field': 'from', 'predicate': 'contains', 'value': 'shop'},
+                       {'field': 'message', 'predicate': 'contains', 'value': 'order'}]),
+            make_rule([{'field': 'from', 'predicate': 'contains', 'value': 'x.com'}], actions=['mark_as_unread']),
+        ])
+        index = RuleIndex(rules)
+
+        self.assertEqual(index.match(ParsedEmail('1', {'from': 'a@x.com'}, payload={}), NOW), [1])
+        mock_extract.assert_not_called()
+        self.assertEqual(index.match(ParsedEmail('2', {'from': 'shop@y.com'}, payload={}), NOW), [0])
+        mock_extract.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from gmail_client import store_emails_in_sqlite
+from watch_daemon import FileSource, SocketSource, LatencyMetrics, WatchDaemon, arrival_delays
+
+
+def make_daemon(**kwargs):
+    with patch('watch_daemon.authenticate_gmail_api'):
+        return WatchDaemon(source=MagicMock(), **kwargs)
+
+
+class TestNotificationSources(unittest.TestCase):
+
+    def test_file_source_wakes_on_touch(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        source = FileSource(path, check_every=0.01)
+
+        self.assertFalse(source.wait(0.05))
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertTrue(source.wait(1))
+        self.assertFalse(source.wait(0.05))
+
+    def test_socket_source_drains_burst(self):
+        source = SocketSource(0)
+        self.addCleanup(source.close)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+
+        self.assertFalse(source.wait(0.05))
+        for _ in range(3):
+            sender.sendto(b'ping', ('127.0.0.1', source.port))
+        started = time.monotonic()
+        self.assertTrue(source.wait(5))
+        self.assertLess(time.monotonic() - started, 1)
+        # The whole burst was one wake up
+        self.assertFalse(source.wait(0.05))
+
+    def test_socket_source_wakes_while_waiting(self):
+        source = SocketSource(0)
+        self.addCleanup(source.close)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+
+        timer = threading.Timer(0.05, sender.sendto, (b'ping', ('127.0.0.1', source.port)))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertTrue(source.wait(5))
+
+
+class TestLatencyMetrics(unittest.TestCase):
+
+    def test_summary(self):
+        metrics = LatencyMetrics()
+        self.assertIsNone(metrics.summary())
+        metrics.record([float(delay) for delay in range(1, 101)])
+        self.assertEqual(metrics.summary(), {'count': 100, 'p50': 51.0, 'p95': 96.0, 'max': 100.0})
+
+    def test_arrival_delays(self):
+        handle, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, db_path)
+        emails = [{'id': f'id{i}', 'threadId': 't', 'labelIds': [], 'internalDate': str((1000 + i) * 1000),
+                   'payload': {'headers': []}} for i in range(3)]
+        with patch('gmail_client.DB_PATH', db_path), patch('watch_daemon.DB_PATH', db_path):
+            store_emails_in_sqlite(emails)
+            delays = arrival_delays(['id0', 'id2', 'missing'], 1010.0)
+        self.assertEqual(sorted(delays), [8.0, 10.0])
+
+
+class TestWatchDaemon(unittest.TestCase):
+
+    @patch('watch_daemon.arrival_delays', return_value=[])
+    @patch('watch_daemon.apply_rules')
+    @patch('watch_daemon.sync_emails')
+    @patch('watch_daemon.load_rules', return_value=[])
+    def test_interval_backs_off_when_idle(self, mock_load_rules, mock_sync, mock_apply, mock_delays):
+        mock_sync.side_effect = [{'messages': 1, 'deleted': 0}] + [{'messages': 0, 'deleted': 0}] * 4
+        mock_apply.side_effect = [{'id1'}] + [set()] * 4
+        daemon = make_daemon(min_interval=2, max_interval=10)
+
+        daemon.run(cycles=5)
+
+        waits = [args[0] for args, _ in daemon.source.wait.call_args_list]
+        self.assertEqual(waits, [2, 4, 8, 10, 10])
+        # Services and rules are reused across cycles
+        self.assertEqual(mock_load_rules.call_count, 1)
+        mock_sync.assert_called_with(gmail_service=daemon.read_service, rules=daemon.rules)
+        mock_apply.assert_called_with(service=daemon.write_service, rules=daemon.rules)
+
+    @patch('watch_daemon.arrival_delays', return_value=[])
+    @patch('watch_daemon.apply_rules', return_value=set())
+    @patch('watch_daemon.sync_emails')
+    @patch('watch_daemon.load_rules', return_value=[])
+    def test_interval_resets_when_busy(self, mock_load_rules, mock_sync, mock_apply, mock_delays):
+        mock_sync.side_effect = [{'messages': 0, 'deleted': 0}] * 2 + [{'messages': 0, 'deleted': 1}]
+        daemon = make_daemon(min_interval=1, max_interval=60)
+
+        daemon.run(cycles=3)
+
+        waits = [args[0] for args, _ in daemon.source.wait.call_args_list]
+        self.assertEqual(waits, [2, 4, 1])
+
+    @patch('builtins.print')
+    @patch('watch_daemon.arrival_delays', return_value=[])
+    @patch('watch_daemon.apply_rules')
+    @patch('watch_daemon.sync_emails')
+    @patch('watch_daemon.load_rules', return_value=[])
+    def test_failed_cycle_backs_off_and_continues(self, mock_load_rules, mock_sync, mock_apply, mock_delays,
+                                                  mock_print):
+        error = HttpError(MagicMock(status=500), b'Backend Error')
+        mock_sync.side_effect = [error, {'messages': 1, 'deleted': 0}, {'messages': 0, 'deleted': 0}]
+        mock_apply.side_effect = [{'id1'}, set()]
+        daemon = make_daemon(min_interval=2, max_interval=60)
+
+        daemon.run(cycles=3)
+
+        waits = [args[0] for args, _ in daemon.source.wait.call_args_list]
+        self.assertEqual(waits, [4, 2, 4])
+        self.assertEqual(mock_apply.call_count, 2)
+        mock_print.assert_any_call(f"Watch cycle failed: {error}")
+
+    @patch('watch_daemon.os.path.getmtime', side_effect=[1.0, 1.0, 2.0])
+    @patch('watch_daemon.os.path.exists', return_value=True)
+    @patch('watch_daemon.load_rules', side_effect=[['old'], ['new']])
+    def test_rules_reloaded_on_change(self, mock_load_rules, mock_exists, mock_getmtime):
+        daemon = make_daemon()
+
+        daemon.reload_rules()
+        daemon.reload_rules()
+        self.assertEqual(daemon.rules, ['old'])
+        daemon.reload_rules()
+        self.assertEqual(daemon.rules, ['new'])
+        self.assertEqual(mock_load_rules.call_count, 2)
+
+    @patch('watch_daemon.time.time', return_value=1010.0)
+    @patch('watch_daemon.arrival_delays', return_value=[3.0, 5.0])
+    @patch('watch_daemon.apply_rules', return_value={'id1', 'id2'})
+    @patch('watch_daemon.sync_emails', return_value={'messages': 2, 'deleted': 0})
+    @patch('watch_daemon.load_rules', return_value=[])
+    def test_run_once_records_latency(self, mock_load_rules, mock_sync, mock_apply, mock_delays, mock_time):
+        daemon = make_daemon()
+
+        self.assertTrue(daemon.run_once())
+        mock_delays.assert_called_once_with({'id1', 'id2'}, 1010.0)
+        self.assertEqual(daemon.metrics.summary()['max'], 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import os
+import socket
+import sqlite3
+import sys
+import time
+from gmail_client import DB_PATH, authenticate_gmail_api, chunked, load_rules, sync_emails
+from rule_filter_client import apply_rules
+
+# NOTE: Polling backs off from MIN_INTERVAL to MAX_INTERVAL seconds while the mailbox is idle and drops back to
+# MIN_INTERVAL as soon as a cycle finds work, a notification wakes the daemon up at any point
+MIN_INTERVAL = 2
+MAX_INTERVAL = 60
+RULES_FILE = 'rules.json'
+
+
+class PollSource:
+    # No notifications, every cycle waits the whole interval
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+
+class FileSource:
+    # Local stand-in for push notifications, touching the file wakes the daemon
+
+    def __init__(self, path, check_every=0.1):
+        self.path = path
+        self.check_every = check_every
+        self.mtime = self.current_mtime()
+
+    def current_mtime(self):
+        return os.path.getmtime(self.path) if os.path.exists(self.path) else None
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            mtime = self.current_mtime()
+            if mtime != self.mtime:
+                self.mtime = mtime
+                return True
+            time.sleep(min(self.check_every, max(0.0, deadline - time.monotonic())))
+        return False
+
+
+class SocketSource:
+    # Any UDP datagram on the port wakes the daemon, a Gmail watch() Pub/Sub subscriber can forward its pushes here
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+
+    def wait(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.recv(1024)
+        except socket.timeout:
+            return False
+
+        # Several notifications for the same burst of mail need one cycle only
+        self.sock.setblocking(False)
+        try:
+            while self.sock.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+class LatencyMetrics:
+    # Delay from a message arriving in Gmail (internalDate) to its actions being applied
+
+    def __init__(self):
+        self.delays = []
+
+    def record(self, delays):
+        self.delays.extend(delays)
+
+    def summary(self):
+        if not self.delays:
+            return None
+        delays = sorted(self.delays)
+
+        def percentile(fraction):
+            return delays[min(len(delays) - 1, int(fraction * len(delays)))]
+        return {'count': len(delays), 'p50': percentile(0.5), 'p95': percentile(0.95), 'max': delays[-1]}
+
+
+def arrival_delays(email_ids, now):
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        delays = []
+        for chunk in chunked(list(email_ids), 500):
+            delays.extend(now - received_at for (received_at,) in conn.execute(
+                f"SELECT received_at FROM emails WHERE id IN ({', '.join('?' * len(chunk))}) "
+                f"AND received_at IS NOT NULL", chunk))
+        return delays
+    finally:
+        conn.close()
+
+
+class WatchDaemon:
+    # Keeps both authenticated services and the compiled rules loaded, every cycle pulls the incremental changes and
+    # applies the rules to them, so a new message is acted on within seconds of the cycle that sees it
+
+    def __init__(self, source=None, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.source = source or PollSource()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.read_service = authenticate_gmail_api('read_token.json', ['https://www.googleapis.com/auth/gmail.readonly'])
+        self.write_service = authenticate_gmail_api('write_token.json', ['https://www.googleapis.com/auth/gmail.modify'])
+        self.rules, self.rules_mtime = None, None
+        self.metrics = LatencyMetrics()
+
+    def reload_rules(self):
+        # Rules are compiled again only when rules.json changed on disk
+        mtime = os.path.getmtime(RULES_FILE) if os.path.exists(RULES_FILE) else None
+        if self.rules is None or mtime != self.rules_mtime:
+            self.rules, self.rules_mtime = load_rules(RULES_FILE), mtime
+
+    def run_once(self):
+        # One sync and apply cycle, returns True when it found something to do
+        self.reload_rules()
+        stats = sync_emails(gmail_service=self.read_service, rules=self.rules)
+        applied = apply_rules(service=self.write_service, rules=self.rules)
+
+        delays = arrival_delays(applied, time.time())
+        self.metrics.record(delays)
+        if delays:
+            summary = self.metrics.summary()
+            print(f"Applied actions to {len(applied)} email(s), arrival to action {max(delays):.1f}s this cycle, "
+                  f"p50 {summary['p50']:.1f}s p95 {summary['p95']:.1f}s over {summary['count']}")
+        return bool(stats['messages'] or stats['deleted'] or applied)
+
+    def run(self, cycles=None):
+        while cycles is None or cycles > 0:
+            try:
+                busy = self.run_once()
+            except Exception as e:
+                # A failed Gmail call or a broken rules.json must not end the daemon, the next cycle tries again
+                # after a longer wait, like an idle one
+                print(f"Watch cycle failed: {e}")
+                busy = False
+            self.interval = self.min_interval if busy else min(self.max_interval, self.interval * 2)
+            self.source.wait(self.interval)
+            if cycles is not None:
+                cycles -= 1
+
+
+if __name__ == '__main__':
+    # --notify-file PATH or --notify-port PORT wake the daemon early, it polls on its adaptive interval either way
+    if '--notify-file' in sys.argv:
+        notification_source = FileSource(sys.argv[sys.argv.index('--notify-file') + 1])
+    elif '--notify-port' in sys.argv:
+        notification_source = SocketSource(int(sys.argv[sys.argv.index('--notify-port') + 1]))
+    else:
+        notification_source = PollSource()
+    WatchDaemon(notification_source).run()